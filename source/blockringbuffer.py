@@ -0,0 +1,44 @@
+from fileringbuffer import FileRingBuffer
+
+class BlockRingBuffer(FileRingBuffer):
+  """Base of the file-based ring buffers of fixed-size items,
+  `FixedSlotRingBuffer` and `CompactRingBuffer`.
+
+  Their positions start at 0 and are taken as they are, without the
+  wrapping of `FileRingBuffer`, and their items are read in batches by
+  `_read_reserved()`, which single item reads and writes go through.
+  """
+
+  def _initial_position(self):
+    return 0
+
+  def _end_position(self, position):
+    return position
+
+  def put(self, item):
+    self.put_many([item])
+
+  def get(self):
+    items = self.get_many(1)
+    if len(items) == 0:
+      return None
+    return items[0]
+
+  def peek(self):
+    items = self.peek_many(1)
+    if len(items) == 0:
+      return None
+    return items[0]
+
+  def get_many(self, n, max_len = None):
+    with self.iolock:
+      if self.empty():
+        return []
+      with self._file() as buffer_file:
+        items, ends = self._read_reserved(buffer_file, self.read_position, self.write_position, n, max_len)
+        if len(items) > 0:
+          self.read_position = ends[-1]
+          self.item_count = max(0, self.item_count - len(items))
+          if self._header_changed(buffer_file):
+            buffer_file.flush()
+        return items
@@ -0,0 +1,443 @@
+from fileringbufferconstants import _HEADER_LEN, _READ_POS_IDX, _WRITE_POS_IDX, _LAST_POS_IDX
+from blockringbuffer import BlockRingBuffer
+import varint
+
+# Record flags, in the low bits of the record head.
+_KEYFRAME = 1                                   # the block itself, no previous record needed
+_SAME_CMD = 2                                   # delta without command: same as the previous record
+_NEXT_ID  = 4                                   # delta without ID delta: the previous ID + 1
+_FLAG_BITS = 3
+
+_END = 0                                        # head found at the write position
+_BLOCK_HEADER_LEN = 7                           # <id 0..1> <cmd> <time 0..3>
+
+def _trim(data):
+  """Return `data` without trailing zero bytes."""
+  n = len(data)
+  while n > 0 and data[n - 1] == 0:
+    n -= 1
+  return data[:n]
+
+class CompactRingBuffer(BlockRingBuffer):
+  """A file-based ring buffer of event log blocks, stored compactly.
+
+  Items are blocks in the format of the event log, `<id 0..1> <cmd>
+  <time 0..3> <data>` padded with zeros to `block_size`. They are stored
+  as records of a byte stream that wraps around at the end of the file:
+
+      <head (varint)> <body>
+      head = body length << 3 | flags
+
+  Every `keyframe_every`-th record (and the first one after the buffer
+  ran empty) is a keyframe, whose body is the block without its padding.
+  The others hold the differences to the record before them:
+
+      [<cmd>] [<ID delta (varint)>] <time delta (zigzag varint)> <data>
+
+  without the command if it did not change (`_SAME_CMD`) and without the
+  ID delta if it is 1 (`_NEXT_ID`). A record is decoded by reading
+  forward from the keyframe before it, so positions (`items()`,
+  `last_position`, the tokens of `reserve()` and the positions in the
+  header) are `offset + capacity * distance`, the offset of the record
+  in the stream and its distance from the keyframe; `position % capacity`
+  is the offset. The keyframe of the read position is not overwritten
+  until the reader moved past the next one.
+
+  Like `FileRingBuffer`, every write leaves an end marker (a zero head)
+  behind the records, and the header is committed the same way. Since
+  records carry no CRC, items written after the last commit can only be
+  rolled forward on restart if a `follows(previous, item)` function is
+  given; without it, use `commit_every=1`.
+  """
+
+  nvs_prefix = "wkc"
+
+  def __init__(self, file_path, capacity, block_size, keep_open = True, commit_every = 1, commit_interval_ms = 0, follows = None, mapped = False, keyframe_every = 32):
+    try:
+      """
+      Parameters
+      ----------
+      file_path : path to a file to use in the buffer
+      capacity : size, in bytes, of the byte stream holding the records
+      block_size : size, in bytes, of every item
+      follows : optional function used to roll forward at startup
+      keyframe_every : number of records from one keyframe to the next
+      See `FileRingBuffer` for the remaining parameters.
+      """
+      self.file_path = file_path
+      self.mode = "r+b"
+      self.capacity = capacity
+      self.buffer_size = _HEADER_LEN + capacity
+      self.block_size = block_size
+      self.follows = follows
+      self.keyframe_every = keyframe_every
+      self._previous = None                     # block written last, None to write a keyframe next
+      self._run = 0                             # records from the keyframe of the write position on
+      self._open_buffer(keep_open, commit_every, commit_interval_ms, mapped)
+    except Exception as e:
+      print("> __init__: ", "failed:", e.args[0], e)
+
+  def _join(self, key, offset):
+    """Return the position of the record at `offset` decoded from the keyframe at `key`."""
+    return offset + self.capacity * ((offset - key) % self.capacity)
+
+  def _split(self, position):
+    """Return the keyframe and the offset of `position`."""
+    distance, offset = divmod(position, self.capacity)
+    return (offset - distance) % self.capacity, offset
+
+  def _get_stored_read_position(self, buffer_file):
+    return self._get_stored_record(buffer_file, _READ_POS_IDX)
+
+  def _get_stored_write_position(self, buffer_file):
+    return self._get_stored_record(buffer_file, _WRITE_POS_IDX)
+
+  def _get_stored_record(self, buffer_file, index):
+    position = self._get_stored_value(buffer_file, index)
+    if position < 0 or position >= self.capacity * self.capacity:
+      print("> _get_stored_record: ", "invalid position", position, "reset to 0")
+      return 0
+    return position
+
+  def _get_stored_last_position(self, buffer_file):
+    position = self._get_stored_value(buffer_file, _LAST_POS_IDX)
+    if position < 0 or position >= self.capacity * self.capacity:
+      return 0
+    return position
+
+  def _read_stream(self, buffer_file, offset, n):
+    """Read `n` bytes of the stream from `offset` on, with at most two reads."""
+    run = min(n, self.capacity - offset)
+    buffer_file.seek(_HEADER_LEN + offset)
+    data = bytes(buffer_file.read(run))
+    if run < n:
+      buffer_file.seek(_HEADER_LEN)
+      data += bytes(buffer_file.read(n - run))
+    return data
+
+  def _write_stream(self, buffer_file, offset, data):
+    """Write `data` to the stream from `offset` on, with at most two writes."""
+    run = min(len(data), self.capacity - offset)
+    buffer_file.seek(_HEADER_LEN + offset)
+    buffer_file.write(data[:run])
+    if run < len(data):
+      buffer_file.seek(_HEADER_LEN)
+      buffer_file.write(data[run:])
+
+  def _stream(self, buffer_file):
+    """Return a function reading the stream of `buffer_file`. Not thread safe."""
+    return lambda offset, n: self._read_stream(buffer_file, offset, n)
+
+  def _read_locked(self, offset, n):
+    """Read the stream, holding `iolock` only for this read."""
+    with self.iolock:
+      with self._file() as buffer_file:
+        return self._read_stream(buffer_file, offset, n)
+
+  def _encode(self, block, previous):
+    """Return the record of `block`, a keyframe if `previous` is None."""
+    data = _trim(block[_BLOCK_HEADER_LEN:])
+    if previous == None:
+      flags = _KEYFRAME
+      body = bytearray(block[:_BLOCK_HEADER_LEN])
+    else:
+      flags = 0
+      body = bytearray()
+      if block[2] == previous[2]:
+        flags |= _SAME_CMD
+      else:
+        body.append(block[2])
+      id_delta = ((block[0] | block[1] << 8) - (previous[0] | previous[1] << 8)) & 0xFFFF
+      if id_delta == 1:
+        flags |= _NEXT_ID
+      else:
+        body.extend(varint.encode(id_delta))
+      time_delta = int.from_bytes(block[3:7], "little") - int.from_bytes(previous[3:7], "little")
+      body.extend(varint.encode(time_delta << 1 if time_delta >= 0 else (-time_delta << 1) - 1))
+    body.extend(data)
+    return varint.encode(len(body) << _FLAG_BITS | flags) + body
+
+  def _decode(self, flags, data, i, end, previous):
+    """Return the block of the record body `data[i:end]`, or None if it
+    is not valid."""
+    if flags & _KEYFRAME:
+      if end - i < _BLOCK_HEADER_LEN or end - i > self.block_size:
+        return None
+      return bytes(data[i:end]) + bytes(self.block_size - (end - i))
+    if previous == None:
+      return None
+    if flags & _SAME_CMD:
+      cmd = previous[2]
+    elif i < end:
+      cmd = data[i]
+      i += 1
+    else:
+      return None
+    id_delta = 1
+    if not flags & _NEXT_ID:
+      id_delta, i = varint.decode(data, i, end)
+    time_delta, i = varint.decode(data, i, end)
+    if id_delta == None or time_delta == None or _BLOCK_HEADER_LEN + end - i > self.block_size:
+      return None
+    time_delta = time_delta >> 1 if time_delta & 1 == 0 else -((time_delta + 1) >> 1)
+    event_id = ((previous[0] | previous[1] << 8) + id_delta) & 0xFFFF
+    event_time = (int.from_bytes(previous[3:7], "little") + time_delta) & 0xFFFFFFFF
+    return (event_id.to_bytes(2, "little") + bytes([cmd]) + event_time.to_bytes(4, "little") +
+      bytes(data[i:end]) + bytes(self.block_size - _BLOCK_HEADER_LEN - (end - i)))
+
+  def _walk(self, read, position, stop, chunk_size = 1024, check = None):
+    """Yield `(position, item, next position)` for every record from
+    `position` on that ends before the offset `stop`, decoding from the
+    keyframe of `position` on. `read(offset, n)` reads the stream, in
+    chunks of about `chunk_size` bytes.
+
+    Stops at an end marker, at anything that is not a valid record and,
+    with `check`, at a record for which `check(previous, item)` is false.
+    """
+    capacity = self.capacity
+    key, offset = self._split(position)
+    total = (stop - key) % capacity
+    skip = (offset - key) % capacity
+    max_record = self.block_size + 8
+    data = b""
+    i = 0
+    done = 0                                    # bytes decoded from key on
+    group = key
+    previous = None
+    while done < total:
+      if len(data) - i < max_record and done + len(data) - i < total:
+        fetched = done + len(data) - i
+        data = data[i:] + read((key + fetched) % capacity, min(max(chunk_size, max_record), total - fetched))
+        i = 0
+      end = min(len(data), i + total - done)
+      head, j = varint.decode(data, i, end)
+      if head == None or head == _END:
+        return
+      body_end = j + (head >> _FLAG_BITS)
+      if body_end > end:
+        return
+      flags = head & ((1 << _FLAG_BITS) - 1)
+      item = self._decode(flags, data, j, body_end, previous)
+      if item == None or (check != None and previous != None and not check(previous, item)):
+        return
+      record = (key + done) % capacity
+      if flags & _KEYFRAME:
+        group = record
+      if done >= skip:
+        following = (record + body_end - i) % capacity
+        following_key = group
+        if body_end < end and data[body_end] & _KEYFRAME:
+          following_key = following
+        yield self._join(group, record), item, self._join(following_key, following)
+      done += body_end - i
+      i = body_end
+      previous = item
+
+  def _protected(self):
+    """Return the offset of the keyframe of the read position, the first
+    byte a write must not overwrite."""
+    return self._split(self.read_position)[0]
+
+  def _free(self):
+    """Return the bytes that can be written before the protected ones,
+    with the end marker."""
+    return (self._protected() - self.write_position - 1) % self.capacity
+
+  def empty(self):
+    return self.read_position % self.capacity == self.write_position % self.capacity
+
+  def bytes_used(self):
+    return (self.write_position - self.read_position) % self.capacity
+
+  def _count_items(self, buffer_file, start, stop):
+    count = 0
+    for item in self._walk(self._stream(buffer_file), start, stop % self.capacity):
+      count += 1
+    return count
+
+  def _roll_forward(self, buffer_file):
+    """Restore the block written last from the keyframe of the write
+    position on, then advance the write position over the records that
+    were written after the last header commit and follow it."""
+    key, offset = self._split(self.write_position)
+    read = self._stream(buffer_file)
+    self._previous = None
+    self._run = 0
+    for position, item, following in self._walk(read, self._join(key, key), offset):
+      self._previous = item
+      self._run += 1
+    if self.follows == None or (self._previous == None and key != offset):
+      return 0
+    recovered = 0
+    for position, item, following in self._walk(read, self.write_position, (self._protected() - 1) % self.capacity,
+        check = self.follows):
+      if position % self.capacity == self._split(position)[0]:
+        self._run = 0
+      self._previous = item
+      self._run += 1
+      self.last_position = position
+      self.write_position = following
+      recovered += 1
+    return recovered
+
+  def _drop(self, buffer_file, n):
+    """Drop the oldest items until `n` bytes can be written and return
+    whether any item was dropped."""
+    lapped = False
+    if self._free() >= n:
+      return lapped
+    for position, item, following in self._walk(self._stream(buffer_file), self.read_position, self.write_position % self.capacity):
+      self.read_position = following
+      self.item_count = max(0, self.item_count - 1)
+      lapped = True
+      if self._free() >= n:
+        break
+    if lapped:
+      self.laps += 1
+    return lapped
+
+  def _overwrites(self, position, n):
+    """Return whether writing `n` bytes at the write position overwrites
+    the keyframe of `position`."""
+    return (self._split(position)[0] - self.write_position) % self.capacity < n
+
+  def _encode_many(self, items, keyframe):
+    """Return the records of `items` written from the write position on,
+    their positions, the item written last and the records from its
+    keyframe on. With `keyframe`, the first record is a keyframe."""
+    capacity = self.capacity
+    offset = self.write_position % capacity
+    key = self._split(self.write_position)[0]
+    previous = None if keyframe else self._previous
+    run = 0 if keyframe else self._run
+    data = bytearray()
+    positions = []
+    for item in items:
+      record = (offset + len(data)) % capacity
+      if previous == None or run >= self.keyframe_every:
+        previous = None
+        run = 0
+        key = record
+      data.extend(self._encode(item, previous))
+      positions.append(self._join(key, record))
+      previous = bytes(item)
+      run += 1
+    return data, positions, previous, run
+
+  def put_many(self, items):
+    """Put the items in the buffer; if they do not fit, only the newest
+    ones are kept."""
+    try:
+      for item in items:
+        assert len(item) == self.block_size, "items must be exactly block_size bytes"
+      with self.iolock:
+        with self._file() as buffer_file:
+          if len(items) == 0:
+            return
+          lapped = False
+          if len(self._encode_many(items, True)[0]) + 1 >= self.capacity:
+            # keep the newest items that fit, as keyframes, and drop
+            # the older ones in the buffer
+            size = 1
+            n = 0
+            while n < len(items) and size + len(self._encode(items[-1 - n], None)) < self.capacity:
+              size += len(self._encode(items[-1 - n], None))
+              n += 1
+            items = items[len(items) - max(n, 1):]
+            while len(items) > 1 and len(self._encode_many(items, True)[0]) + 1 >= self.capacity:
+              items = items[1:]
+            self.read_position = self.write_position
+            self.item_count = 0
+            self.laps += 1
+            lapped = True
+          was_empty = self.empty()
+          if was_empty:
+            # the reader starts at the keyframe written now
+            self.read_position = self.write_position % self.capacity
+          records = self._encode_many(items, was_empty)
+          if self._drop(buffer_file, len(records[0]) + 1):
+            lapped = True
+          if lapped and self.empty() and not was_empty:
+            self.read_position = self.write_position % self.capacity
+            records = self._encode_many(items, True)
+          data, positions, previous, run = records
+          if self._committed != None and (self._overwrites(self._committed[0], len(data) + 1) or
+              self._overwrites(self._committed[1], len(data) + 1)):
+            self._commit_header(buffer_file, self.read_position, self.write_position)
+          # the end marker first, so that the records are never followed by stale ones
+          end = (self.write_position + len(data)) % self.capacity
+          self._write_stream(buffer_file, end, bytes([_END]))
+          self._write_stream(buffer_file, self.write_position % self.capacity, data)
+          self.last_position = positions[-1]
+          self.write_position = self._join(self._split(positions[-1])[0], end)
+          self._previous = previous
+          self._run = run
+          self.item_count += len(items)
+          self._header_changed(buffer_file, lapped)
+          buffer_file.flush()
+    except Exception as e:
+      print("> put_many: ", "failed:", e.args[0], e)
+
+  def _read_reserved(self, buffer_file, start, stop, n, max_len):
+    items = []
+    ends = []
+    if n <= 0:
+      return items, ends
+    for position, item, following in self._walk(self._stream(buffer_file), start, stop % self.capacity):
+      items.append(item)
+      ends.append(following)
+      if len(items) == n:
+        break
+    return items, ends
+
+  def peekLast(self, blockSize = None):
+    """Peek the item written last, decoded from the keyframe of the write position."""
+    with self.iolock:
+      with self._file() as buffer_file:
+        key, offset = self._split(self.write_position)
+        last = self._previous
+        for position, item, following in self._walk(self._stream(buffer_file), self._join(key, key), offset):
+          last = item
+        return last
+
+  def items(self, start = None, stop = None, chunk_size = 1024):
+    """Yield `(position, item)` for every item from `start` (the read
+    position) up to `stop` (the write position), reading chunks of about
+    `chunk_size` bytes with `iolock` held only while a chunk is read."""
+    if start == None:
+      start = self.read_position
+    if stop == None:
+      stop = self.write_position
+    for position, item, following in self._walk(self._read_locked, start, stop % self.capacity, chunk_size):
+      yield position, item
+
+  def _next_position(self, buffer_file, position):
+    for position, item, following in self._walk(self._stream(buffer_file), position, self.write_position % self.capacity):
+      return following
+    return self.write_position
+
+  def advanceReadPositionFrom(self, position):
+    with self.iolock:
+      with self._file() as buffer_file:
+        self.read_position = self._next_position(buffer_file, position)
+        self.item_count = self._count_items(buffer_file, self.read_position, self.write_position)
+        self.laps += 1
+        self._header_changed(buffer_file)
+        buffer_file.flush()
+
+  def clear(self):
+    """Remove all elements from the buffer."""
+    with self.iolock:
+      with self._file() as buffer_file:
+        buffer_file.seek(0)
+        buffer_file.write(b"\0" * self.buffer_size)
+        self.read_position = 0
+        self.write_position = 0
+        self.last_position = 0
+        self.item_count = 0
+        self.laps += 1
+        self._previous = None
+        self._run = 0
+        self._committed = None
+        self._header_changed(buffer_file, True)
+        buffer_file.flush()
@@ -24,15 +24,45 @@ LORA_RANDOMIZE_SLEEP = 0.2                      # randomize LORA_SLEEPTIME by 20
 LORA_SLEEPTIME_WHEN_NOT_CONNECTED = 20          # number of seconds to sleep when not otaa joined
 LORA_USE_ABP = False                            # by default use OTAA
 LORA_SEND_STATUS_INTERVAL = 3120                # send at least one packet every hour - should be alittle different than timesync
+LORA_DUTY_CYCLE = 0.01                          # max fraction of time on air (1% in the EU868 g1 sub-band)
+LORA_DUTY_CYCLE_WINDOW = 3600                   # seconds of time on air budget that can be used in a burst, at LORA_DUTY_CYCLE
+LORA_BACKOFF_MIN = 10                           # seconds to wait after a failed uplink, doubled for every further failure
+LORA_BACKOFF_MAX = 600                          # max seconds to wait after failed uplinks
+LORA_IDLE_WAKEUP_INTERVAL = 60                  # seconds between wakeups of the event sender while there are no events
+LORA_UPLINK_TIMEOUT = 20                        # seconds to wait for the end of an uplink and its receive windows
+LORA_NVRAM_SAVE_EVERY = 10                      # save the LoRaWAN frame counters after n uplinks
+LORA_NVRAM_SAVE_INTERVAL = 600                  # ... or when the last save is older than n seconds
+LORA_BATCH_EVENTS = 1                           # max tag events packed into one uplink (CMD 0x06, see LoraController.makeBatchPayload; 1 sends one event per uplink)
+LORA_ACK_MODE = False                           # keep sent events until a downlink acknowledges them (CMD 0x10, see EventSender)
+LORA_ACK_TIMEOUT = 900                          # seconds without acknowledgement after which the unacknowledged events are sent again
 
 # RFID Settings ---------------------------------------------------------
 RFID_SCAN_INTERVAL = 0.2                        # tag scan interval (200ms default)
 RFID_LOG_UART = False                           # True to log UART communication
 RFID_PAUSE_SCANNING_BUFFER_LEVEL = 90           # pause scanning when event buffer level is abofe 95%
 RFID_WARN_LED_BUFFER_LEVEL = 80                 # LED orange when buffer level above 80%
+TAG_DEDUP_WINDOW = 0                            # seconds before a tag staying in the field is reported again (0 reports every detection; > 0 sends CMD 0x07, see TagFilter)
+TAG_DEDUP_SLOTS = 32                            # tags tracked by the duplicate filter (multiple of 4)
 
 # Logging Settings ---------------------------------------------------------
 EVENT_LOG_PATH = '/flash/data/events.bin'
+EVENT_LOG_SLOT_PATH = '/flash/data/events.slt'  # event log file of the "slots" engine
+EVENT_LOG_WIRE_PATH = '/flash/data/events.wir'  # event log file of the "wire" engine
+EVENT_LOG_COMPACT_PATH = '/flash/data/events.cmp' # event log file of the "compact" engine
+EVENT_LOG_ENGINE = "file"                       # "file" (length prefixed items), "slots" (fixed-size slots), "wire" (uplink payloads) or "compact" (delta encoded)
 EVENT_LOG_BLOCKSIZE = 18                        # size (bytes) of one event log block (7 bytes header: ID + CMD + TS)
 EVENT_LOG_MAX_EVENTS = 1000                     # number of events in log ringbuffer
 EVENT_LOG_MAX_EVENT_ID = 0xFFFE                 # max value for Event ID until it rolls over
+EVENT_LOG_COMMIT_EVERY = 16                     # commit buffer positions and seq/ack after n changes
+EVENT_LOG_COMMIT_INTERVAL_MS = 5000             # ... or when older than n ms
+EVENT_LOG_INDEX_EVERY = 16                      # index the buffer position of every n-th event, see EventLog.seekToEventId
+EVENT_LOG_KEYFRAME_EVERY = 32                   # events from one keyframe to the next (compact engine)
+EVENT_LOG_READ_AHEAD = 8                        # events read at once and kept in RAM for the event sender (file engine)
+EVENT_QUEUE_SIZE = 64                           # events staged in RAM until written to the event log, scanning pauses at RFID_PAUSE_SCANNING_BUFFER_LEVEL
+
+# Debug Log Settings -------------------------------------------------------
+LOG_LEVEL = 3                                   # messages logged: 1 = ERROR, 2 = WARN, 3 = TRACE, 4 = DEBUG (payload dumps)
+LOG_LEVELS = {}                                 # level by topic, e.g. {"LORA": 2}
+LOG_PRINT = False                               # print log messages, for debugging (False: binary log ring only, see LOG_DUMP_PATH)
+LOG_RING_SIZE = 256                             # messages kept in the binary log ring (32 bytes each)
+LOG_DUMP_PATH = '/flash/log.bin'                # binary log ring written on a crash, see tools/logdecode.py
@@ -7,7 +7,10 @@ import os
 import binascii
 import _thread
 import config
+import logcodes
 from fileringbuffer import FileRingBuffer
+from fixedslotringbuffer import FixedSlotRingBuffer
+from compactringbuffer import CompactRingBuffer
 import fileringbufferconstants
 
 # Event Block Format
@@ -23,16 +26,166 @@ CMD_TIME_REQUEST        = 0x03
 CMD_TIME_REQUEST2       = 0x04
 CMD_TIME_CHANGED        = 0x05
 
+# uplink commands of a tag event, see LoraController.makePayload
+UPLINK_TAG_DETECTED     = 0x01
+UPLINK_TAG_REPEATED     = 0x07                  # with the detections suppressed before it
+
+# data byte of a tag event with the number of detections suppressed
+# before it (see TagFilter), after the UID
+TAG_HITS_OFFSET         = 10
+
+# Wire Format (ENGINE_WIRE)
+# <uplink cmd> <id 0..1> <time 0..3> <data 0..n>
+# the uplink payload of the event: the tag UID without trailing ZEROes
+# (preceded by the suppressed detections for UPLINK_TAG_REPEATED), the
+# data of other commands trimmed to WIRE_DATA_SIZE, no padding
+WIRE_DATA_SIZE = {CMD_TIME_CHANGED: 4}
+
+# ring buffer engines
+ENGINE_FILE             = "file"                # length prefixed items (FileRingBuffer)
+ENGINE_SLOTS            = "slots"               # fixed-size slots (FixedSlotRingBuffer)
+ENGINE_WIRE             = "wire"                # length prefixed uplink payloads (FileRingBuffer)
+ENGINE_COMPACT          = "compact"             # delta encoded records with keyframes (CompactRingBuffer)
+
+# NVS key prefix of the FileRingBuffer of the wire engine, which is open
+# side by side with the file engine one while migrating
+WIRE_NVS_PREFIX         = "wkw"
+
+# returns the UID of a tag event without trailing 0x00 (at least 4 bytes)
+def trimUid(data):
+    uid_size = min(len(data), 10)
+    while uid_size > 4 and data[uid_size - 1] == 0x00:
+        uid_size = uid_size - 1
+    return data[:uid_size]
+
+# event fields by the keys of the event dicts, see Event.__getitem__
+EVENT_FIELDS = {'ID': 'id', 'Command': 'command', 'Time': 'time', 'Data': 'data'}
+
+# an event of the log, a view over its raw block which decodes the fields
+# only when they are accessed
+class Event:
+    __slots__ = ('block',)
+
+    def __init__(self, block):
+        self.block = block
+
+    @property
+    def id(self):
+        return self.block[0] | (self.block[1] << 8)
+
+    @property
+    def command(self):
+        return self.block[2]
+
+    @property
+    def time(self):
+        return int.from_bytes(self.block[3:7], 'little')
+
+    # raw ID, as sent in the uplinks
+    @property
+    def idBytes(self):
+        return self.block[0:2]
+
+    # data and padding, without copying the block
+    @property
+    def data(self):
+        return memoryview(self.block)[7:]
+
+    # detections of the tag suppressed before a tag event
+    @property
+    def hits(self):
+        if len(self.block) > 7 + TAG_HITS_OFFSET:
+            return self.block[7 + TAG_HITS_OFFSET]
+        return 0
+
+    # read access like to the event dicts, e.g. event['ID']
+    def __getitem__(self, key):
+        return getattr(self, EVENT_FIELDS[key])
+
+# an event of a ENGINE_WIRE log, stored as its uplink payload: the ID
+# follows the command, time and data are where they are in the blocks
+class WireEvent(Event):
+    __slots__ = ()
+
+    @property
+    def id(self):
+        return self.block[1] | (self.block[2] << 8)
+
+    @property
+    def command(self):
+        command = self.block[0]
+        if command == UPLINK_TAG_DETECTED or command == UPLINK_TAG_REPEATED:
+            return CMD_TAG_DETECTED
+        return command
+
+    @property
+    def idBytes(self):
+        return self.block[1:3]
+
+    @property
+    def data(self):
+        if self.block[0] == UPLINK_TAG_REPEATED:
+            return memoryview(self.block)[8:]
+        return memoryview(self.block)[7:]
+
+    @property
+    def hits(self):
+        if self.block[0] == UPLINK_TAG_REPEATED:
+            return self.block[7]
+        return 0
+
 # represents a circular event log buffer
+#
+# Events are added by the main thread and the interrupt handlers (the
+# producers, serialized by bufferLock) and consumed by the EventSender
+# thread. The ring buffer is thread safe on its own, so consumers take
+# no lock of the event log.
 class EventLog:
-    def __init__(self, logger, path):
+    # legacyPath: file engine event log whose pending events are moved
+    # into a new slots engine event log
+    def __init__(self, logger, path, engine = None, legacyPath = None):
         self.logger = logger
-        self.eventIdLock = _thread.allocate_lock()
         self.enabled = True
         self.eventSender = None
-        self.bufferLock = _thread.allocate_lock()
-        self.ringBuffer = FileRingBuffer(path, config.EVENT_LOG_MAX_EVENTS * (config.EVENT_LOG_BLOCKSIZE + fileringbufferconstants._ITEM_SIZE_LEN))
-        self.log("Initialized event log file", path, "with capacity for", config.EVENT_LOG_MAX_EVENTS, "events")
+        self.bufferLock = _thread.allocate_lock()   # held by producers, see addEvent
+        self.eventSignal = _thread.allocate_lock()  # released when events are added, see waitForEvents
+        self.eventSignal.acquire()
+        self.levelLock = _thread.allocate_lock()
+        self.levelCallbacks = []                    # [level, callback, above], see addLevelCallback
+        self.indexLock = _thread.allocate_lock()
+        self.idIndex = None                         # [eventId, position] of every EVENT_LOG_INDEX_EVERY-th event, oldest first, see seekToEventId
+        if engine == None:
+            engine = config.EVENT_LOG_ENGINE
+        self.engine = engine
+        self.idOffset = 1 if engine == ENGINE_WIRE else 0     # offset of the ID in the stored events
+        self.commandOffset = 0 if engine == ENGINE_WIRE else 2  # offset of the command in the stored events
+        # most events the buffer can hold: 11 bytes per wire event, 2 bytes per compact record
+        self.maxEvents = config.EVENT_LOG_MAX_EVENTS
+        if engine == ENGINE_WIRE:
+            self.maxEvents = config.EVENT_LOG_MAX_EVENTS * (config.EVENT_LOG_BLOCKSIZE + fileringbufferconstants._ITEM_SIZE_LEN) // 11
+        elif engine == ENGINE_COMPACT:
+            self.maxEvents = config.EVENT_LOG_MAX_EVENTS * (config.EVENT_LOG_BLOCKSIZE + fileringbufferconstants._ITEM_SIZE_LEN) // 2
+        if engine == ENGINE_SLOTS:
+            self.ringBuffer = FixedSlotRingBuffer(path, config.EVENT_LOG_MAX_EVENTS, config.EVENT_LOG_BLOCKSIZE,
+                commit_every=config.EVENT_LOG_COMMIT_EVERY, commit_interval_ms=config.EVENT_LOG_COMMIT_INTERVAL_MS,
+                follows=self._followsEvent)
+            if legacyPath != None:
+                self._migrateLegacyLog(legacyPath)
+        elif engine == ENGINE_WIRE:
+            self.ringBuffer = self._openFileRingBuffer(path, WIRE_NVS_PREFIX)
+            if legacyPath != None:
+                self._migrateLegacyLog(legacyPath)
+        elif engine == ENGINE_COMPACT:
+            # the file size of the file engine, holding about 3 times the events
+            self.ringBuffer = CompactRingBuffer(path, config.EVENT_LOG_MAX_EVENTS * (config.EVENT_LOG_BLOCKSIZE + fileringbufferconstants._ITEM_SIZE_LEN),
+                config.EVENT_LOG_BLOCKSIZE, commit_every=config.EVENT_LOG_COMMIT_EVERY,
+                commit_interval_ms=config.EVENT_LOG_COMMIT_INTERVAL_MS, follows=self._followsEvent,
+                keyframe_every=config.EVENT_LOG_KEYFRAME_EVERY)
+            if legacyPath != None:
+                self._migrateLegacyLog(legacyPath)
+        else:
+            self.ringBuffer = self._openFileRingBuffer(path)
+        self.log("Initialized", engine, "event log file", path, "with capacity for up to", self.maxEvents, "events")
         self.log("> read position :", self.ringBuffer.read_position)
         self.log("> write position:", self.ringBuffer.write_position)
 
@@ -53,8 +206,14 @@ class EventLog:
                 self.log("WARN: unable to determine last used event id, resetting at 0")
                 self.lastAckEventID = 0
             else:
-                self.eventId = lastEvent['ID']
+                self.eventId = lastEvent.id
                 self.log("Restored eventID to", self.eventId)
+        elif self.ringBuffer.recovered > 0:
+            # events written after the last header commit carry newer IDs
+            lastEvent = self.peekLastEvent()
+            if lastEvent != None:
+                self.eventId = lastEvent.id
+                self.log("Restored eventID to", self.eventId, "after recovering", self.ringBuffer.recovered, "events")
 
         if self.lastAckEventID > self.eventId and self.eventId >= 0:
             self.log("Resetted lastAckEventID to", self.eventId, "from", self.lastAckEventID)
@@ -63,18 +222,71 @@ class EventLog:
     def log(self, *text):
         self.logger.log("Eventlog", *text)
 
-    def _advanceEventId(self):
-        with self.eventIdLock:
-            if self.eventId < config.EVENT_LOG_MAX_EVENT_ID:
-                self.eventId = self.eventId + 1
-            else:
-                self.eventId = 0
-            self.log("Advanced Event ID to", self.eventId)
+    # logs a message of logcodes
+    def event(self, code, *values):
+        self.logger.event("Eventlog", code, *values)
+
+    # nvsPrefix: see FileRingBuffer, None for the one of the class
+    def _openFileRingBuffer(self, path, nvsPrefix = None):
+        return FileRingBuffer(path, config.EVENT_LOG_MAX_EVENTS * (config.EVENT_LOG_BLOCKSIZE + fileringbufferconstants._ITEM_SIZE_LEN),
+            commit_every=config.EVENT_LOG_COMMIT_EVERY, commit_interval_ms=config.EVENT_LOG_COMMIT_INTERVAL_MS,
+            follows=self._followsEvent, read_ahead=config.EVENT_LOG_READ_AHEAD, nvs_prefix=nvsPrefix)
+
+    # ID of a stored event
+    def _blockId(self, block):
+        return block[self.idOffset] | (block[self.idOffset + 1] << 8)
+
+    # is block the event written right after previous? (used to recover uncommitted events)
+    def _followsEvent(self, previous, block):
+        if block[self.commandOffset] == 0:
+            return False
+        previousId = self._blockId(previous)
+        eventId = self._blockId(block)
+        if previousId < config.EVENT_LOG_MAX_EVENT_ID:
+            return eventId == previousId + 1
+        return eventId == 0
+
+    # moves the pending events and the seq/ack numbers of a file engine
+    # event log into the (empty) ring buffer and removes the old file
+    def _migrateLegacyLog(self, legacyPath):
+        try:
+            os.stat(legacyPath)
+        except:
+            return
+        try:
+            legacy = self._openFileRingBuffer(legacyPath)
+            if self.ringBuffer.empty() and self.ringBuffer.getSequenceNumber() == 0:
+                moved = 0
+                while not legacy.empty():
+                    blocks = legacy.peek_many(32, config.EVENT_LOG_BLOCKSIZE)
+                    if len(blocks) == 0:
+                        break
+                    self.ringBuffer.put_many([self._encodeBlock(block) for block in blocks])
+                    legacy.get_many(len(blocks), config.EVENT_LOG_BLOCKSIZE)
+                    moved += len(blocks)
+                self.ringBuffer.storeSeqAck(legacy.getSequenceNumber(), legacy.getAckNumber())
+                self.ringBuffer.sync()
+                self.log("Migrated", moved, "events from", legacyPath)
+            legacy.close()
+            os.remove(legacyPath)
+        except Exception as e:
+            self.log("ERROR: Unable to migrate event log", legacyPath, e.args[0], e)
+
+    # called with bufferLock held
+    def _advanceEventId(self, persist = True):
+        if self.eventId < config.EVENT_LOG_MAX_EVENT_ID:
+            self.eventId = self.eventId + 1
+        else:
+            self.eventId = 0
+        if persist:
+            self.event(logcodes.EVENTLOG_ADVANCED_ID, self.eventId)
             self.ringBuffer.storeSeqAck(self.eventId, self.lastAckEventID)
     
     def _formatEvent(self, cmd, data = None):
         id_raw = self.eventId.to_bytes(2, 'little')
         ts_raw = time.time().to_bytes(4, 'little')
+        if self.engine == ENGINE_WIRE:
+            return self._formatWireEvent(id_raw, cmd, ts_raw, data)
         buffer = id_raw + bytes([cmd]) + ts_raw
         if data != None:
             buffer = buffer + data
@@ -86,13 +298,36 @@ class EventLog:
             buffer = buffer[:config.EVENT_LOG_BLOCKSIZE]
         return buffer
 
-    # unpacks the binary event
+    # returns the uplink payload of the event, see WireEvent
+    def _formatWireEvent(self, id_raw, cmd, ts_raw, data):
+        if data == None:
+            data = b''
+        if cmd == CMD_TAG_DETECTED:
+            cmd = UPLINK_TAG_DETECTED
+            hits = data[TAG_HITS_OFFSET] if len(data) > TAG_HITS_OFFSET else 0
+            data = trimUid(data)
+            if hits > 0:
+                cmd = UPLINK_TAG_REPEATED
+                data = bytes([hits]) + bytes(data)
+        else:
+            data = data[:WIRE_DATA_SIZE.get(cmd, config.EVENT_LOG_BLOCKSIZE - 7)]
+        return bytes([cmd]) + id_raw + ts_raw + bytes(data)
+
+    # returns the block formatted by _formatEvent in the format stored
+    def _encodeBlock(self, block):
+        if self.engine == ENGINE_WIRE:
+            return self._formatWireEvent(block[0:2], block[2], block[3:7], block[7:])
+        return block
+
+    # returns the binary event as Event
     def _unpackEventPayload(self, block):
         if block != None and len(block) > 0:
-            if len(block) == config.EVENT_LOG_BLOCKSIZE:
-                eventId = int.from_bytes(block[0:2], 'little')
-                eventTime = int.from_bytes(block[3:7], 'little')
-                return {'ID':eventId, 'Command':block[2] ,'Time':eventTime, 'Data': block[7:len(block)]}
+            if self.engine == ENGINE_WIRE:
+                if len(block) >= 7 and len(block) <= config.EVENT_LOG_BLOCKSIZE:
+                    return WireEvent(block)
+                self.log("ERROR: Invalid event size. Expected: 7 to", config.EVENT_LOG_BLOCKSIZE, ", actual:", len(block))
+            elif len(block) == config.EVENT_LOG_BLOCKSIZE:
+                return Event(block)
             else:
                 self.log("ERROR: Invalid event block size. Expected:", config.EVENT_LOG_BLOCKSIZE, ", actual:", len(block))
 
@@ -104,38 +339,293 @@ class EventLog:
                 self._advanceEventId()
                 event_raw = self._formatEvent(cmd, data)
                 self.ringBuffer.put(event_raw)
-                self.log("Added Event", self.eventId, "to buffer, cmd =", cmd)
+                self._indexLastEvent()
+                self.event(logcodes.EVENTLOG_ADDED, self.eventId, cmd)
+            self._signalEvents()
+            self._checkBufferLevel()
         except Exception as e:
             print("addEvent exception")
 
+    # percentage of the event buffer in use
+    def bufferLevel(self):
+        return int(self.ringBuffer.fill_ratio() * 100)
+
+    # calls callback(True, level) once the buffer level (percent) rises to
+    # level or above, and callback(False, level) once it drops below again,
+    # so that ingestion can be throttled before events are overwritten
+    def addLevelCallback(self, level, callback):
+        with self.levelLock:
+            self.levelCallbacks.append([level, callback, False])
+        self._checkBufferLevel()
+
+    # calls the level callbacks whose level was crossed
+    def _checkBufferLevel(self):
+        if len(self.levelCallbacks) == 0:
+            return
+        with self.levelLock:
+            level = self.bufferLevel()
+            for entry in self.levelCallbacks:
+                above = level >= entry[0]
+                if above != entry[2]:
+                    entry[2] = above
+                    try:
+                        entry[1](above, level)
+                    except Exception as e:
+                        self.log("ERROR: buffer level callback failed", e.args[0], e)
+
+    # wakes up a thread blocked in waitForEvents
+    def _signalEvents(self):
+        try:
+            if self.eventSignal.locked():
+                self.eventSignal.release()
+        except RuntimeError:
+            # released by another thread in the meantime
+            pass
+
+    # blocks until events were added since the last call or timeout seconds passed,
+    # returns True if events were added
+    def waitForEvents(self, timeout):
+        return self.eventSignal.acquire(1, timeout)
+
+    # commits buffer positions and sequence numbers held in RAM,
+    # without force only if a commit is due
+    def sync(self, force = True):
+        self.ringBuffer.sync(force)
+
+    # adds one event per payload with a single buffer write
+    def addEvents(self, cmd, payloads):
+        try:
+            with self.bufferLock:
+                blocks = []
+                for data in payloads:
+                    self._advanceEventId(False)
+                    blocks.append(self._formatEvent(cmd, data))
+                self.ringBuffer.storeSeqAck(self.eventId, self.lastAckEventID)
+                self.ringBuffer.put_many(blocks)
+                self._indexLastEvent()
+                self.event(logcodes.EVENTLOG_ADDED_MANY, len(blocks), self.eventId, cmd)
+            self._signalEvents()
+            self._checkBufferLevel()
+        except Exception as e:
+            print("addEvents exception")
+
+    # adds events queued by EventQueue, formatted like by _formatEvent but
+    # without ID, assigning the IDs in order, with a single buffer write
+    def addBlocks(self, blocks):
+        try:
+            with self.bufferLock:
+                for i in range(len(blocks)):
+                    self._advanceEventId(False)
+                    blocks[i] = self._encodeBlock(self.eventId.to_bytes(2, 'little') + blocks[i][2:])
+                self.ringBuffer.storeSeqAck(self.eventId, self.lastAckEventID)
+                self.ringBuffer.put_many(blocks)
+                self._indexLastEvent()
+                self.event(logcodes.EVENTLOG_ADDED_QUEUED, len(blocks), self.eventId)
+            self._signalEvents()
+            self._checkBufferLevel()
+        except Exception as e:
+            print("addBlocks exception")
+
     # are there new events?
     def hasEvents(self):
-        with self.bufferLock:
-            return not self.ringBuffer.empty()
+        return not self.ringBuffer.empty()
 
     def setEventSender(self, eventSender):
         self.eventSender = eventSender
 
     def peekNextEvent(self):
-        with self.bufferLock:
-            if not self.ringBuffer.empty():
-                block = self.ringBuffer.peek()
-                if block != None:
-                    return self._unpackEventPayload(block)
-            return None
+        if not self.ringBuffer.empty():
+            block = self.ringBuffer.peek()
+            if block != None:
+                return self._unpackEventPayload(block)
+        return None
 
     def pullNextEvent(self):
-        with self.bufferLock:
-            if not self.ringBuffer.empty():
-                block = self.ringBuffer.get()
-                if block != None:
-                    return self._unpackEventPayload(block)
+        if not self.ringBuffer.empty():
+            block = self.ringBuffer.get()
+            self._checkBufferLevel()
+            if block != None:
+                return self._unpackEventPayload(block)
+        return None
+
+    def peekNextEvents(self, n):
+        return self.reserveEvents(n)[0]
+
+    # returns the next n events without removing them, and a token for
+    # commitEvents to remove them once they have been sent
+    def reserveEvents(self, n):
+        blocks, token = self.ringBuffer.reserve(n, config.EVENT_LOG_BLOCKSIZE)
+        events = []
+        for block in blocks:
+            event = self._unpackEventPayload(block)
+            if event == None:
+                break
+            events.append(event)
+        return events, token
+
+    # removes the first count events returned by reserveEvents with one
+    # header update; returns False if the events were dropped or removed
+    # in the meantime
+    def commitEvents(self, token, count):
+        committed = self.ringBuffer.commit(token, count)
+        self._checkBufferLevel()
+        return committed
+
+    # removes the next n events
+    def pullNextEvents(self, n):
+        events = []
+        for block in self.ringBuffer.get_many(n, config.EVENT_LOG_BLOCKSIZE):
+            event = self._unpackEventPayload(block)
+            if event != None:
+                events.append(event)
+        self._checkBufferLevel()
+        return events
+
+    # iterates over the pending events without removing them, each event
+    # is decoded only when it is reached
+    def events(self):
+        for position, block in self.ringBuffer.items():
+            event = self._unpackEventPayload(block)
+            if event != None:
+                yield event
+
+    # events from eventId back to the newest event, 0 for the newest,
+    # across the rollover at EVENT_LOG_MAX_EVENT_ID
+    def _eventAge(self, eventId, newestId):
+        return (newestId - eventId) % (config.EVENT_LOG_MAX_EVENT_ID + 1)
+
+    # called with bufferLock held, after putting events: indexes the
+    # newest event if the last indexed one is EVENT_LOG_INDEX_EVERY or
+    # more events older, so that batches put at once get one entry
+    def _indexLastEvent(self):
+        with self.indexLock:
+            index = self.idIndex
+            if index == None:
+                return
+            if len(index) > 0 and self._eventAge(index[-1][0], self.eventId) < config.EVENT_LOG_INDEX_EVERY:
+                return
+            index.append([self.eventId, self.ringBuffer.last_position])
+            # entries older than the buffer can hold are gone
+            while self._eventAge(index[0][0], self.eventId) > self.maxEvents:
+                index.pop(0)
+
+    # builds the index from the pending events, with one pass of chunked reads
+    def _buildIndex(self):
+        index = []
+        for position, block in self.ringBuffer.items():
+            eventId = self._blockId(block)
+            if len(index) == 0 or self._eventAge(index[-1][0], eventId) >= config.EVENT_LOG_INDEX_EVERY:
+                index.append([eventId, position])
+        return index
+
+    # returns the buffer position of the pending event eventId, or None if
+    # it is not pending (sent and removed, dropped, or not yet added)
+    def seekToEventId(self, eventId):
+        first = self.peekNextEvent()
+        if first == None:
+            return None
+        return self._seek(eventId, first.id, self.eventId)
+
+    # The nearest indexed event at or before eventId is found by a binary
+    # search over the event ages, and the events are read from there on,
+    # at most about EVENT_LOG_INDEX_EVERY (usually with a single read).
+    def _seek(self, eventId, firstId, newestId):
+        age = self._eventAge(eventId, newestId)
+        firstAge = self._eventAge(firstId, newestId)
+        if age > firstAge:
+            return None
+        if self.idIndex == None:
+            index = self._buildIndex()
+            with self.indexLock:
+                if self.idIndex == None:
+                    self.idIndex = index
+        start = None
+        startId = firstId
+        with self.indexLock:
+            index = self.idIndex
+            # drop the entries of the events removed meanwhile
+            while len(index) > 0 and self._eventAge(index[0][0], newestId) > firstAge:
+                index.pop(0)
+            low = 0
+            high = len(index)
+            while low < high:
+                middle = (low + high) // 2
+                if self._eventAge(index[middle][0], newestId) >= age:
+                    low = middle + 1
+                else:
+                    high = middle
+            if low > 0:
+                startId, start = index[low - 1]
+        for position, block in self.ringBuffer.items(start):
+            blockId = self._blockId(block)
+            if blockId == eventId:
+                return position
+            if blockId != startId:
+                if start == None:
+                    return None
+                # overwritten since it was indexed
+                with self.indexLock:
+                    self.idIndex = None
+                return self._seek(eventId, firstId, newestId)
+            startId = (startId + 1) % (config.EVENT_LOG_MAX_EVENT_ID + 1)
+        return None
+
+    # returns the pending event eventId, or None
+    def peekEvent(self, eventId):
+        position = self.seekToEventId(eventId)
+        if position == None:
             return None
+        for position, block in self.ringBuffer.items(position):
+            return self._unpackEventPayload(block)
+        return None
+
+    # returns up to n pending events from eventId on, or from the first
+    # pending event if eventId was removed (None: from the first one);
+    # empty if eventId follows the newest event
+    def peekEventsFrom(self, eventId, n):
+        first = self.peekNextEvent()
+        if first == None:
+            return []
+        newestId = self.eventId
+        position = None
+        if eventId != None:
+            if eventId == (newestId + 1) % (config.EVENT_LOG_MAX_EVENT_ID + 1):
+                return []
+            position = self._seek(eventId, first.id, newestId)
+        events = []
+        for position, block in self.ringBuffer.items(position):
+            event = self._unpackEventPayload(block)
+            if event == None:
+                break
+            events.append(event)
+            if len(events) == n:
+                break
+        return events
+
+    # removes the pending events up to and including eventId, e.g. once the
+    # server acknowledged them, with one header update that also stores
+    # eventId as the last acknowledged event; returns the number of events
+    # removed (0 if eventId is not pending, or the events were removed
+    # by the sender meanwhile)
+    def ackUpTo(self, eventId):
+        with self.bufferLock:
+            events, token = self.reserveEvents(1)
+            if len(events) == 0:
+                return 0
+            firstId = events[0].id
+            position = self._seek(eventId, firstId, self.eventId)
+            if position == None:
+                return 0
+            n = self._eventAge(firstId, self.eventId) - self._eventAge(eventId, self.eventId) + 1
+            if not self.ringBuffer.skip(position, n, eventId, token[0]):
+                return 0
+            self.lastAckEventID = eventId
+        self._checkBufferLevel()
+        return n
 
     # peeks the last event in the log
     def peekLastEvent(self):
-        with self.bufferLock:
-            block = self.ringBuffer.peekLast(config.EVENT_LOG_BLOCKSIZE)
-            if block != None:
-                return self._unpackEventPayload(block)
-            return None
+        block = self.ringBuffer.peekLast(config.EVENT_LOG_BLOCKSIZE)
+        if block != None:
+            return self._unpackEventPayload(block)
+        return None
@@ -0,0 +1,154 @@
+"""
+ Copyright © 2019 TimeTool AG. All rights reserved.
+"""
+import config
+import time
+import struct
+import _thread
+import logcodes
+
+# stages events in RAM, so that interrupt handlers and the RFID scanner
+# add events in constant time without allocating, while a writer thread
+# puts them into the event log in batches
+#
+# Slots hold event blocks in the format of the event log, stamped with
+# the time they were added; the event ID is assigned by the event log
+# when they are written (see EventLog.addBlocks).
+class EventQueue:
+    def __init__(self, logger, eventLog, size = None):
+        if size == None:
+            size = config.EVENT_QUEUE_SIZE
+        self.logger = logger
+        self.eventLog = eventLog
+        self.size = size
+        self.slots = bytearray(size * config.EVENT_LOG_BLOCKSIZE)
+        self.view = memoryview(self.slots)
+        self.head = 0                   # slot the next event is added to
+        self.tail = 0                   # slot of the oldest event
+        self.count = 0                  # events queued
+        self.lock = _thread.allocate_lock()
+        self.writeLock = _thread.allocate_lock()
+        self.signal = _thread.allocate_lock()   # released when events are added
+        self.signal.acquire()
+        self._writerThread = None
+        self.dropped = 0                # events dropped because the queue was full
+        self.loggedDropped = 0
+        self.maxCount = 0               # high water mark of count
+        self.paused = False             # level above RFID_PAUSE_SCANNING_BUFFER_LEVEL
+        self.eventLogFull = False       # event log level above it, see pauseScanning
+        self.pauses = 0                 # times scanning was paused
+
+    # logging
+    def log(self, *text):
+        self.logger.log("EventQueue", *text)
+
+    # logs a message of logcodes
+    def event(self, code, *values):
+        self.logger.event("EventQueue", code, *values)
+
+    # starts the writer thread
+    def start(self):
+        if self._writerThread == None:
+            _thread.stack_size(16384)
+            self._writerThread = _thread.start_new_thread(self.writeQueuedEvents, ())
+            _thread.stack_size(0)
+            self.log("EventQueue started with", self.size, "slots")
+
+    # percentage of the slots in use
+    def level(self):
+        return self.count * 100 // self.size
+
+    # should the RFID scanner pause until the writer (or the event sender) caught up?
+    def isScanningPaused(self):
+        return self.paused or self.eventLogFull
+
+    # pauses scanning while the event log is above RFID_PAUSE_SCANNING_BUFFER_LEVEL,
+    # see EventLog.addLevelCallback
+    def pauseScanning(self, paused):
+        if paused != self.eventLogFull:
+            self.log("Scanning", "paused" if paused else "resumed", "by event log level")
+        self.eventLogFull = paused
+
+    # queues an event, returns False if it was dropped because the queue is full
+    def addEvent(self, cmd, data = None):
+        size = config.EVENT_LOG_BLOCKSIZE
+        with self.lock:
+            if self.count == self.size:
+                self.dropped = self.dropped + 1
+                return False
+            offset = self.head * size
+            slots = self.slots
+            slots[offset] = 0
+            slots[offset + 1] = 0
+            slots[offset + 2] = cmd
+            struct.pack_into("<I", slots, offset + 3, time.time())
+            n = 0
+            if data != None:
+                n = min(len(data), size - 7)
+            for i in range(size - 7):
+                if i < n:
+                    slots[offset + 7 + i] = data[i]
+                else:
+                    slots[offset + 7 + i] = 0
+            self.head = (self.head + 1) % self.size
+            self.count = self.count + 1
+            if self.count > self.maxCount:
+                self.maxCount = self.count
+            if not self.paused and self.count * 100 >= config.RFID_PAUSE_SCANNING_BUFFER_LEVEL * self.size:
+                self.paused = True
+                self.pauses = self.pauses + 1
+        self._signal()
+        return True
+
+    # queues one event per payload, returns the number of events queued
+    def addEvents(self, cmd, payloads):
+        queued = 0
+        for data in payloads:
+            if self.addEvent(cmd, data):
+                queued = queued + 1
+        return queued
+
+    # wakes up the writer thread
+    def _signal(self):
+        try:
+            if self.signal.locked():
+                self.signal.release()
+        except RuntimeError:
+            # released by another thread in the meantime
+            pass
+
+    # puts the queued events into the event log with one buffer write,
+    # returns the number of events written
+    def flush(self):
+        size = config.EVENT_LOG_BLOCKSIZE
+        with self.writeLock:
+            with self.lock:
+                tail = self.tail
+                n = self.count
+            if n == 0:
+                return 0
+            # the slots of these events are not reused before count drops
+            blocks = []
+            for i in range(n):
+                offset = ((tail + i) % self.size) * size
+                blocks.append(bytes(self.view[offset:offset + size]))
+            self.eventLog.addBlocks(blocks)
+            with self.lock:
+                self.tail = (tail + n) % self.size
+                self.count = self.count - n
+                if self.paused and self.count * 100 < config.RFID_PAUSE_SCANNING_BUFFER_LEVEL * self.size:
+                    self.paused = False
+                dropped = self.dropped
+            if dropped != self.loggedDropped:
+                self.event(logcodes.QUEUE_DROPPED, dropped - self.loggedDropped, dropped)
+                self.loggedDropped = dropped
+            return n
+
+    # writer thread: writes the queued events as soon as they are added
+    def writeQueuedEvents(self):
+        while True:
+            self.signal.acquire()
+            try:
+                self.flush()
+            except Exception as e:
+                self.log("ERROR", "Unable to write queued events", e.args[0], e)
@@ -2,6 +2,7 @@
  Copyright © 2019 TimeTool AG. All rights reserved.
 """
 import config
+import logcodes
 import pycom
 import _thread
 import time
@@ -22,11 +23,23 @@ class EventSender:
         self.lock = _thread.allocate_lock()
         self._publisherThread = None
         self.lastSendEvent = time.time()
+        self.failedSends = 0            # consecutive failed uplinks, for the backoff
+        self.lastAirtime = 0            # time on air (ms) of the last uplink, to estimate the next one
+        self.airtimeBudgetSize = config.LORA_DUTY_CYCLE * config.LORA_DUTY_CYCLE_WINDOW * 1000
+        self.airtimeBudget = self.airtimeBudgetSize     # time on air (ms) that can be used right now
+        self.airtimeBudgetUpdated = time.ticks_ms()
+        self.nextEventId = None         # ID of the next event to send with LORA_ACK_MODE, None for the first pending one
+        self.missingEventIds = []       # IDs of the events to send again, from the acks
+        self.lastAck = time.time()      # when the last ack arrived, or nothing awaited one
 
     # logging
     def log(self, *text):
         self.logger.log("EventSender", *text)
 
+    # logs a message of logcodes
+    def event(self, code, *values):
+        self.logger.event("EventSender", code, *values)
+
     def updateLastSendTime(self):
         self.lastSendEvent = time.time()
 
@@ -42,50 +55,138 @@ class EventSender:
             self._publisherThread = _thread.start_new_thread(self.sendPendingEvents, ())
             _thread.stack_size(0)
 
-    # sends the eventlog entries that have not yet been transmitted
+    # refills the time on air budget at the duty cycle rate and charges
+    # the uplinks sent since the last update
+    def updateAirtimeBudget(self):
+        now = time.ticks_ms()
+        elapsed = time.ticks_diff(now, self.airtimeBudgetUpdated)
+        self.airtimeBudgetUpdated = now
+        self.airtimeBudget = min(self.airtimeBudgetSize, self.airtimeBudget + elapsed * config.LORA_DUTY_CYCLE)
+        used = self.lora.airtimeUsed()
+        if used > 0:
+            self.airtimeBudget = self.airtimeBudget - used
+            self.lastAirtime = used
+
+    # seconds to wait before the next uplink: the backoff after failed
+    # uplinks, or until the budget covers another uplink like the last one
+    def nextSendDelay(self):
+        if self.failedSends > 0:
+            backoff = min(config.LORA_BACKOFF_MIN * (2 ** (self.failedSends - 1)), config.LORA_BACKOFF_MAX)
+            return backoff * (1 + config.LORA_RANDOMIZE_SLEEP * (os.urandom(1)[0] / 256))
+        self.updateAirtimeBudget()
+        missing = self.lastAirtime - self.airtimeBudget
+        if missing <= 0:
+            return 0
+        return missing / config.LORA_DUTY_CYCLE / 1000
+
+    # sends the eventlog entries that have not yet been transmitted, as
+    # soon as they are added and the duty cycle allows
     def sendPendingEvents(self):
         while True:
-            sleeptime = self.options['send_interval'] * (1 + config.LORA_RANDOMIZE_SLEEP * (os.urandom(1)[0] / 256))
-            time.sleep(sleeptime)
+            sleeptime = self.nextSendDelay()
+            if sleeptime > 0:
+                self.log("waiting", sleeptime, "seconds before next uplink")
+                time.sleep(sleeptime)
 
             # update in order to detect time
             self.lastSendEvent = time.time()
-            if self.enabled:
-                # get next event to be sent
-                hasEvents = self.eventLog.hasEvents()
-                self.log("pending events:", hasEvents)
-                if hasEvents:
-                    event = self.eventLog.peekNextEvent()
-                    if event == None:
-                        self.led.ok()
-                        self.log("ERROR: Unable to peek next event")
-                    else:
-                        eventId = event['ID']
-                        command = event['Command']
-                        self.log("Publishing event #", eventId, " with CMD", command)
-                        pos = self.eventLog.ringBuffer.read_position
-                        try:
-                            if self.onPublish(event):
-                                if pos == self.eventLog.ringBuffer.read_position:
-                                    if self.eventLog.pullNextEvent() == None:
-                                        self.log("ERROR: Unable to PULL next event in order to mark it as being sent")
-                        except Exception as e:
-                            self.log("ERROR", "Unable to publish event", e.args[0], e)
-                    
+            if not self.enabled:
+                time.sleep(self.options['send_interval'])
+            elif not self.eventLog.hasEvents():
+                # sleep until events are added
+                self.lastAck = time.time()
+                self.eventLog.waitForEvents(config.LORA_IDLE_WAKEUP_INTERVAL)
+            elif config.LORA_ACK_MODE:
+                try:
+                    self.sendUnacknowledgedEvents()
+                except Exception as e:
+                    self.log("ERROR", "Unable to publish event", e.args[0], e)
+            else:
+                # reserve next events to be sent
+                events, token = self.eventLog.reserveEvents(config.LORA_BATCH_EVENTS)
+                if len(events) == 0:
+                    self.led.ok()
+                    self.log("ERROR: Unable to peek next event")
+                    time.sleep(self.options['send_interval'])
+                else:
+                    eventId = events[0].id
+                    command = events[0].command
+                    self.event(logcodes.SENDER_PUBLISHING, eventId, command)
+                    try:
+                        count = self.onPublish(events)
+                        if count == 0:
+                            self.failedSends = self.failedSends + 1
+                        else:
+                            self.failedSends = 0
+                            # one header update for all events sent
+                            if not self.eventLog.commitEvents(token, count):
+                                self.event(logcodes.SENDER_COMMIT_FAILED)
+                    except Exception as e:
+                        self.log("ERROR", "Unable to publish event", e.args[0], e)
+                
         
-    def onPublish(self, e):
-        self.log("Handling event #", e['ID'], " with CMD", e['Command'])
-        isHandled = False
+    # LORA_ACK_MODE: sends the events the server reported missing, else the
+    # events not sent yet; the events stay in the event log until an ack
+    # downlink removes them (see LoraController.handleAck)
+    def sendUnacknowledgedEvents(self):
+        now = time.time()
+        if now - self.lastAck > config.LORA_ACK_TIMEOUT:
+            # the acks were lost: start over from the first pending event
+            first = self.eventLog.peekNextEvent()
+            self.event(logcodes.SENDER_ACK_TIMEOUT, now - self.lastAck, first.id if first != None else 0)
+            self.nextEventId = None
+            self.missingEventIds = []
+            self.lastAck = now
+        retransmitting = len(self.missingEventIds) > 0
+        if retransmitting:
+            events = []
+            for eventId in self.missingEventIds[:config.LORA_BATCH_EVENTS]:
+                event = self.eventLog.peekEvent(eventId)
+                if event != None:
+                    events.append(event)
+            if len(events) == 0:
+                # acknowledged or dropped meanwhile
+                self.missingEventIds = []
+                return
+            self.event(logcodes.SENDER_RETRANSMITTING, len(events), events[0].id)
+        else:
+            events = self.eventLog.peekEventsFrom(self.nextEventId, config.LORA_BATCH_EVENTS)
+            if len(events) == 0:
+                # everything was sent, sleep until events are added or the ack times out
+                self.eventLog.waitForEvents(config.LORA_IDLE_WAKEUP_INTERVAL)
+                return
+        self.event(logcodes.SENDER_PUBLISHING, events[0].id, events[0].command)
+        count = self.onPublish(events)
+        if count == 0:
+            self.failedSends = self.failedSends + 1
+        else:
+            self.failedSends = 0
+            if retransmitting:
+                sent = [event.id for event in events[:count]]
+                self.missingEventIds = [eventId for eventId in self.missingEventIds if eventId not in sent]
+            else:
+                self.nextEventId = (events[count - 1].id + 1) % (config.EVENT_LOG_MAX_EVENT_ID + 1)
+        ack = self.lora.takeAck()
+        if ack != None:
+            self.lastAck = time.time()
+            for eventId in ack[1]:
+                if eventId not in self.missingEventIds:
+                    self.missingEventIds.append(eventId)
+
+    # sends the first events, returns the number of events sent
+    def onPublish(self, events):
+        self.event(logcodes.SENDER_HANDLING, events[0].id, events[0].command)
+        isHandled = 0
         try:
             if self.lora.hasJoined():
-                isHandled = self.lora.sendEvent(e)
+                isHandled = self.lora.sendEvents(events)
             else:
                 self.log("Unsupported uplink:", self.options['uplink'])
         except Exception as e:
             self.log("ERROR", "Unable to send event via", self.options['uplink'], e.args[0], e)
 
         # Flash the LED
-        if isHandled:
+        if isHandled > 0:
             color = self.led.ok()
             time.sleep(0.05)
             self.led.setColor(color)
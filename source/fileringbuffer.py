@@ -1,22 +1,161 @@
 from fileringbufferconstants import (
   _HEADER_LEN, _ITEM_SIZE_FORMAT, _ITEM_SIZE_LEN, _POS_VALUE_FORMAT,
-  _POS_VALUE_LEN, _READ_POS_IDX, _WRITE_POS_IDX, _SEQ_ID_IDX, _ACK_ID_IDX
+  _POS_VALUE_LEN, _READ_POS_IDX, _WRITE_POS_IDX, _SEQ_ID_IDX, _ACK_ID_IDX,
+  _LAST_POS_IDX, _COUNT_IDX, _TAIL_LEN, _COUNT_BITS, _COUNT_CHECK_MASK,
+  _COMMIT_VALUES, _COMMIT_LEN, _COMMIT_FORMAT, _COMMIT_CRC_FORMAT,
+  _ITEM_LEN_MASK, _ITEM_CHECK_SHIFT, _ITEM_CHECK_MASK, _END_MARKER, _WRAP_MARKER
 )
+import array
 import os
 import struct
+import time
 import _thread
 import pycom
 import ubinascii
 import binascii
+try:
+  import mmap
+except ImportError:
+  # MicroPython: the mapped backend keeps a bytearray mirror instead
+  mmap = None
+
+def _crc32_table():
+  """Return the lookup table of `_crc32()`."""
+  table = array.array("I", [0] * 256)
+  for i in range(256):
+    c = i
+    for _ in range(8):
+      c = (c >> 1) ^ 0xEDB88320 if c & 1 else c >> 1
+    table[i] = c
+  return table
+
+# CRC-32 (the one of zlib), which the firmware's ubinascii does not have
+_CRC32_TABLE = _crc32_table()
+
+def _crc32(data):
+  """Return the CRC-32 of `data`, the value of CPython's `binascii.crc32()`."""
+  table = _CRC32_TABLE
+  crc = 0xFFFFFFFF
+  for b in data:
+    crc = table[(crc ^ b) & 0xFF] ^ (crc >> 8)
+  return crc ^ 0xFFFFFFFF
+
+_END_MARKER_BYTES = struct.pack(_ITEM_SIZE_FORMAT, _END_MARKER)
+_WRAP_MARKER_BYTES = struct.pack(_ITEM_SIZE_FORMAT, _WRAP_MARKER)
+
+class _KeptOpenFile(object):
+  """Context manager around a file handle that must outlive the `with` block."""
+
+  def __init__(self, buffer_file):
+    self.buffer_file = buffer_file
+
+  def __enter__(self):
+    return self.buffer_file
+
+  def __exit__(self, *args):
+    return False
+
+
+class _MappedReader(object):
+  """Reads the memoryview `view` at a position of its own, so that a
+  reader does not share the position of the writer (see `reserve()`)."""
+
+  def __init__(self, view):
+    self.view = view
+    self.position = 0
+
+  def seek(self, position):
+    self.position = position
+
+  def tell(self):
+    return self.position
+
+  def read(self, n):
+    start = self.position
+    self.position = min(start + n, len(self.view))
+    return self.view[start:self.position]
+
+
+class _MappedFile(_MappedReader):
+  """File-like access to the buffer file through a memory map, or where
+  there is none (MicroPython) through a bytearray mirror of the file that
+  writes through to it. The file is extended to `size` bytes if needed.
+
+  `read()` returns `memoryview` slices of the mapping without copying;
+  they show later writes to the same bytes. `flush()` does nothing for
+  a memory map, which is flushed by `close()`.
+  """
+
+  def __init__(self, file_path, size):
+    self.file = open(file_path, "r+b")
+    self.file.seek(0, 2)
+    file_size = self.file.tell()
+    if file_size < size:
+      self.file.write(b"\0" * (size - file_size))
+      self.file.flush()
+    if mmap != None:
+      self.data = mmap.mmap(self.file.fileno(), size)
+    else:
+      self.data = bytearray(size)
+      self.file.seek(0)
+      self.file.readinto(self.data)
+    _MappedReader.__init__(self, memoryview(self.data))
+
+  def write(self, data):
+    end = self.position + len(data)
+    self.data[self.position:end] = data
+    if mmap == None:
+      self.file.seek(self.position)
+      self.file.write(data)
+    self.position = end
+
+  def flush(self):
+    if mmap == None:
+      self.file.flush()
+
+  def close(self):
+    if mmap != None:
+      self.data.flush()
+      try:
+        self.view.release()
+        self.data.close()
+      except BufferError:
+        # slices handed out are still in use; the map is closed once
+        # they are released
+        pass
+    self.file.close()
+
 
 class FileRingBuffer(object):
   """A file-based ring buffer.
 
-  The underlying file buffer is prefixed with a header containing two
-  64-bit integers representing the current read and write positions
-  within the buffer. These positions are updated with each read and
-  write in order to make buffer state fully reflected in the on-disk
-  format.
+  The header state consists of the current read and write positions
+  within the buffer, followed by the sequence and ack numbers of the
+  event log. These values are kept in RAM and committed as one record
+  every `commit_every` changes, every `commit_interval_ms` milliseconds,
+  when the reader is lapped, or when `sync()` is called.
+
+  A commit record carries a generation counter and a CRC32, and two of
+  them are stored behind the buffer (or in NVS) and written in turn, so
+  that a reset in the middle of a commit leaves the previous record
+  intact. At startup the newest valid record is used. Buffers written
+  by older versions have the values in the first 32 bytes of the file
+  (or in single NVS values) instead, which are read if there is no
+  valid record.
+
+  Every write leaves an end marker (a zero item size) at the new write
+  position, and a writer that wraps around early leaves a wrap marker
+  behind the last item. Items written after the last header commit can
+  therefore be recovered on restart by scanning forward from the
+  committed write position up to the first end marker. The size field
+  of every item carries a CRC of the item, so that the scan also stops
+  at an item torn by a reset. Items read after the last commit are
+  delivered again after a restart.
+
+  The position of the item written last and the number of items are
+  committed together with the header as a tail index, stored behind the
+  buffer, so that neither `peekLast` nor `count()` needs a scan whatever
+  the size of the buffer.
 
   A single logical slot in the ring buffer is always left unallocated
   in order to ensure that the read and write positions are only ever
@@ -25,24 +164,90 @@ class FileRingBuffer(object):
   Because of these two conditions, the actual size of the underlying
   file, in terms of the arguments to `__init__`, is equal to
 
-      8 + 8 + capacity + 1
+      8 + 8 + 8 + 8 + capacity + 1 + 2 * 56
+
+  For one producer and one consumer thread, `reserve()` hands out the
+  next items together with a token, which `commit()` takes to remove
+  them without reading them again. A put that drops items (lapping the
+  reader) voids the tokens handed out before. With `mapped`, the
+  consumer reads the mapping without holding `iolock`, so that it does
+  not wait for the producer's writes (see `reserve()`).
 
   [1] http://en.wikipedia.org/wiki/Circular_buffer#Always_keep_one_slot_open
   """
 
   use_nvs = True
+  nvs_prefix = "wkb"                              # NVS keys are nvs_prefix + record slot (a, b) + value index
+  read_ahead = 0                                  # items cached at the read position, see _read_ahead
 
   def _get_stored_value(self, buffer_file, index):
+    """Return the value at header `index` of the newest valid commit
+    record."""
+    if self._stored == None:
+      self._stored = self._load_commit(buffer_file)
+    return self._stored[index // _POS_VALUE_LEN]
+
+  def _read_commit_record(self, buffer_file, slot):
+    """Return the generation and the values of the commit record in
+    `slot` (0 or 1), or None if it is not valid."""
     if self.use_nvs:
       try:
-        value = pycom.nvs_get("wkb"+str(index))
+        key = self.nvs_prefix + "ab"[slot]
+        values = []
+        for i in range(_COMMIT_VALUES + 2):
+          value = pycom.nvs_get(key + str(i))
+          if value == None:
+            return None
+          values.append(value)
+        # the values the slot holds, so that unchanged ones are not written again
+        self._slots[slot] = tuple(values)
+        data = struct.pack(_COMMIT_FORMAT, *values[:_COMMIT_VALUES + 1])
+        crc = values[_COMMIT_VALUES + 1]
+      except Exception as e:
+        print("> _read_commit_record: ", "failed:", e.args[0], e)
+        return None
+    else:
+      buffer_file.seek(self.buffer_size + slot * _COMMIT_LEN)
+      data = buffer_file.read(_COMMIT_LEN)
+      if len(data) < _COMMIT_LEN:
+        return None
+      crc = struct.unpack_from(_COMMIT_CRC_FORMAT, data, _COMMIT_LEN - 4)[0]
+      data = bytes(data[:_COMMIT_LEN - 4])
+    if _crc32(data) != crc:
+      return None
+    values = struct.unpack(_COMMIT_FORMAT, data)
+    return values[_COMMIT_VALUES], values[:_COMMIT_VALUES]
+
+  def _load_commit(self, buffer_file):
+    """Return the values of the newest valid commit record and note its
+    generation; without one, return the values stored by older versions."""
+    newest = None
+    for slot in (0, 1):
+      record = self._read_commit_record(buffer_file, slot)
+      # generations are compared as serial numbers, in case they wrap
+      if record != None and (newest == None or (record[0] - newest[0]) & 0xFFFFFFFF < 0x80000000):
+        newest = record
+    if newest == None:
+      self._generation = 0
+      return tuple([self._get_legacy_value(buffer_file, i * _POS_VALUE_LEN) for i in range(_COMMIT_VALUES)])
+    self._generation = newest[0]
+    return newest[1]
+
+  def _get_legacy_value(self, buffer_file, index):
+    """Return a header value as stored by versions without commit records."""
+    if self.use_nvs:
+      try:
+        value = pycom.nvs_get(self.nvs_prefix+str(index))
         if value == None:
           return 0
         return value
       except Exception as e:
-        print("> _get_stored_value: ", "failed:", e.args[0], e)
+        print("> _get_legacy_value: ", "failed:", e.args[0], e)
         return 0
 
+    if index >= _HEADER_LEN:
+      # the tail index followed the buffer
+      index = self.buffer_size + index - _HEADER_LEN
     buffer_file.seek(index)
     value = struct.unpack(
       _POS_VALUE_FORMAT,
@@ -91,103 +296,403 @@ class FileRingBuffer(object):
   def _get_stored_ack_number(self, buffer_file):
     return self._get_stored_value(buffer_file, _ACK_ID_IDX)
 
-  def _record_rw_positions(self, buffer_file):
-    """Record the current read and write positions to the buffer
-    header.
+  def _get_stored_last_position(self, buffer_file):
+    """Return the position of the item written last that is recorded in
+    the tail index, or 0 if it is unknown or does not match the item
+    ending at the write position.
+    """
+    position = self._get_stored_value(buffer_file, _LAST_POS_IDX)
+    if position < _HEADER_LEN or position + _ITEM_SIZE_LEN > self.buffer_size - 1:
+      return 0
+    buffer_file.seek(position)
+    item_len = struct.unpack(
+      _ITEM_SIZE_FORMAT,
+      buffer_file.read(_ITEM_SIZE_LEN)
+    )[0]
+    if item_len <= 0 or self._wrapped(position + _ITEM_SIZE_LEN + (item_len & _ITEM_LEN_MASK)) != self.write_position:
+      return 0
+    return position
+
+  def _count_check(self, read_position, write_position):
+    """Return the check value stored with the count for the positions."""
+    return (read_position * 31 + write_position) & _COUNT_CHECK_MASK
+
+  def _get_stored_count(self, buffer_file):
+    """Return the number of items recorded in the tail index if it was
+    committed for the read and write positions of the header, otherwise
+    count the items."""
+    record = self._get_stored_value(buffer_file, _COUNT_IDX)
+    count = record & ((1 << _COUNT_BITS) - 1)
+    if record >> _COUNT_BITS == self._count_check(self.read_position, self.write_position) and (
+      (count == 0) == self.empty()):
+      return count
+    return self._count_items(buffer_file, self.read_position, self.write_position)
+
+  def _count_items(self, buffer_file, start, stop):
+    """Count the items from `start` up to `stop` by following their size
+    fields. Not thread safe."""
+    count = 0
+    pos = start
+    # bounded, in case the buffer holds garbage
+    for _ in range(self.capacity // (_ITEM_SIZE_LEN + 1) + 2):
+      if pos == stop:
+        break
+      if pos + _ITEM_SIZE_LEN > self.buffer_size - 1:
+        pos = _HEADER_LEN
+        continue
+      buffer_file.seek(pos)
+      item_len = struct.unpack(
+        _ITEM_SIZE_FORMAT,
+        buffer_file.read(_ITEM_SIZE_LEN)
+      )[0]
+      if item_len == _WRAP_MARKER and pos != _HEADER_LEN:
+        pos = _HEADER_LEN
+        continue
+      if item_len <= 0:
+        break
+      pos = self._wrapped(pos + _ITEM_SIZE_LEN + (item_len & _ITEM_LEN_MASK))
+      count += 1
+    return count
+
+  def _item_check(self, item):
+    """Return the CRC of an item stored in its size field."""
+    return _crc32(item) & _ITEM_CHECK_MASK
+
+  def _item_size_field(self, item):
+    """Return the packed size field of `item`."""
+    return struct.pack(_ITEM_SIZE_FORMAT, len(item) | self._item_check(item) << _ITEM_CHECK_SHIFT)
+
+  def _commit_header(self, buffer_file, read_position = None, write_position = None):
+    """Record the current read and write positions and the sequence
+    and ack numbers to the buffer header as one record, along with the
+    tail index. The positions can be overridden to commit an
+    intermediate state, which `count()` must match.
     """
+    if read_position == None:
+      read_position = self.read_position
+    if write_position == None:
+      write_position = self.write_position
+    count = self.count()
+    if count >> _COUNT_BITS == 0:
+      count |= self._count_check(read_position, write_position) << _COUNT_BITS
+    else:
+      # too many to record, counted again at startup
+      count = 0
+    header = (read_position, write_position, self.seq, self.ack, self.last_position, count)
+    # the record goes to the slot of the record before the previous one
+    generation = (self._generation + 1) & 0xFFFFFFFF
+    slot = generation % 2
+    data = struct.pack(_COMMIT_FORMAT, *(header + (generation,)))
+    crc = _crc32(data)
     if self.use_nvs:
-      try: 
-        pycom.nvs_set("wkb"+str(_READ_POS_IDX), self.read_position)
-        pycom.nvs_set("wkb"+str(_WRITE_POS_IDX), self.write_position)
+      try:
+        # the CRC goes last, and only values that differ from the ones
+        # in the slot are written
+        values = header + (generation, crc)
+        key = self.nvs_prefix + "ab"[slot]
+        previous = self._slots[slot]
+        self._slots[slot] = None
+        for i in range(len(values)):
+          if previous == None or previous[i] != values[i]:
+            pycom.nvs_set(key + str(i), values[i])
+        self._slots[slot] = values
       except Exception as e:
-        print("> _record_rw_positions: ", "failed:", e.args[0], e)
-      return
-      
-
-    packed_read_position = struct.pack(_POS_VALUE_FORMAT, self.read_position)
-    packed_write_position = struct.pack(_POS_VALUE_FORMAT, self.write_position)
-    buffer_file.seek(_READ_POS_IDX)
-    buffer_file.write(packed_read_position)
-    buffer_file.seek(_WRITE_POS_IDX)
-    buffer_file.write(packed_write_position)
-
-
-  def _record_seq_ack(self, buffer_file, seq, ack):
-    if self.use_nvs:
-      pycom.nvs_set("wkb"+str(_SEQ_ID_IDX), seq)
-      pycom.nvs_set("wkb"+str(_ACK_ID_IDX), ack)
-      return
+        print("> _commit_header: ", "failed:", e.args[0], e)
+        return
+    else:
+      buffer_file.seek(self.buffer_size + slot * _COMMIT_LEN)
+      buffer_file.write(data + struct.pack(_COMMIT_CRC_FORMAT, crc))
 
-    packed_seq_id = struct.pack(_POS_VALUE_FORMAT, seq)
-    packed_ack_id = struct.pack(_POS_VALUE_FORMAT, ack)
-    buffer_file.seek(_SEQ_ID_IDX)
-    buffer_file.write(packed_seq_id)
-    buffer_file.seek(_ACK_ID_IDX)
-    buffer_file.write(packed_ack_id)
+    self._generation = generation
+    self._committed = header
+    self._pending = 0
+    self._last_commit = time.ticks_ms()
 
-  def _get_stored_sequence_number(self, buffer_file):
-    return self._get_stored_value(buffer_file, _SEQ_ID_IDX)
 
-  def _get_stored_ack_number(self, buffer_file):
-    return self._get_stored_value(buffer_file, _ACK_ID_IDX)
+  def _commit_due(self):
+    """Return `True` if the header state held in RAM has to be committed."""
+    if self._pending >= self.commit_every:
+      return True
+    return self.commit_interval_ms > 0 and time.ticks_diff(time.ticks_ms(), self._last_commit) >= self.commit_interval_ms
 
 
-  def __init__(self, file_path, capacity):
+  def _header_changed(self, buffer_file, force = False):
+    """Note a change of the header state held in RAM and commit it if
+    `force` is set or a commit is due. Returns whether it was committed:
+    reading writes nothing else, so readers only need to flush then.
+    """
+    self._pending += 1
+    if force or self._commit_due():
+      self._commit_header(buffer_file)
+      return True
+    return False
+
+
+  def _roll_forward(self, buffer_file):
+    """Advance the write position over the items that were written
+    after the last header commit and return their number.
+
+    The scan follows wrap markers and stops at the first end marker, at
+    anything that does not look like an item (or whose CRC does not
+    match), or before it would reach the read position. With a `follows`
+    function, it also stops at an item that was not written right after
+    the previous one: a write torn between two items leaves intact items
+    of the previous lap behind them.
+    """
+    data_end = self.buffer_size - 1
+    pos = self.write_position
+    if pos + _ITEM_SIZE_LEN > data_end:
+      # written by a version that did not place an end marker here
+      return 0
+
+    previous = None
+    if self.follows != None and self.last_position != 0:
+      buffer_file.seek(self.last_position)
+      item_len = struct.unpack(_ITEM_SIZE_FORMAT, buffer_file.read(_ITEM_SIZE_LEN))[0]
+      previous = buffer_file.read(item_len & _ITEM_LEN_MASK)
+
+    recovered = 0
+    max_steps = self.capacity // (_ITEM_SIZE_LEN + 1)
+    for _ in range(max_steps):
+      buffer_file.seek(pos)
+      item_len = struct.unpack(
+        _ITEM_SIZE_FORMAT,
+        buffer_file.read(_ITEM_SIZE_LEN)
+      )[0]
+      if item_len == _WRAP_MARKER and pos != _HEADER_LEN:
+        pos = _HEADER_LEN
+        continue
+      size = item_len & _ITEM_LEN_MASK
+      if item_len <= 0 or pos + _ITEM_SIZE_LEN + size > data_end:
+        break
+      item = buffer_file.read(size)
+      if self._item_check(item) != item_len >> _ITEM_CHECK_SHIFT:
+        # torn by a reset
+        break
+      if self.follows != None and previous != None and not self.follows(previous, item):
+        break
+      previous = item
+      next_pos = self._wrapped(pos + _ITEM_SIZE_LEN + size)
+      if next_pos == self.read_position:
+        break
+      self.last_position = pos
+      pos = next_pos
+      recovered += 1
+
+    if recovered > 0:
+      self.write_position = pos
+    return recovered
+
+
+  def __init__(self, file_path, capacity, keep_open = True, commit_every = 1, commit_interval_ms = 0, mapped = False, follows = None, read_ahead = 0, nvs_prefix = None):
     try:
       """
       Parameters
       ----------
       file_path : path to a file to use in the buffer
       capacity : total size, in bytes, of the data set stored in the buffer
+      keep_open : keep a single file handle open for the lifetime of the
+        buffer instead of opening the file for every operation
+      commit_every : number of header changes after which the header is
+        committed
+      commit_interval_ms : commit pending header changes once this many
+        milliseconds passed since the last commit (0 to disable)
+      mapped : access the file through a memory map (or a bytearray
+        mirror, see `_MappedFile`), implies `keep_open`. Items read are
+        then `memoryview` slices, valid until the buffer overwrites them.
+      follows : optional function `follows(previous, item)` telling whether
+        `item` was written right after `previous`, used to roll forward
+        at startup (see `_roll_forward`)
+      read_ahead : number of items from the read position on that
+        `peek()`, `get()`, `reserve()` and `get_many()` keep in RAM, read
+        with one chunked read (see `_read_ahead`); ignored with `mapped`
+      nvs_prefix : NVS key prefix of the header, instead of the one of
+        the class, for buffers used side by side
       """
       self.file_path = file_path
       self.mode = "r+b"
       self.capacity = capacity
+      self.follows = follows
+      self.read_ahead = read_ahead
+      if nvs_prefix != None:
+        self.nvs_prefix = nvs_prefix
       self.buffer_size = _HEADER_LEN + capacity + 1
-      self.iolock = _thread.allocate_lock()       # IO lock
-      path = "/flash/data"
-      
+      self._open_buffer(keep_open, commit_every, commit_interval_ms, mapped)
+    except Exception as e:
+      print("> __init__: ", "failed:", e.args[0], e)
+
+  def _initial_position(self):
+    """Return the read and write position of an empty buffer."""
+    return _HEADER_LEN
+
+  def _open_buffer(self, keep_open, commit_every, commit_interval_ms, mapped = False):
+    """Create or open the buffer file of `self.buffer_size` bytes and
+    restore the header state from it (see `__init__` for the parameters).
+    """
+    self.iolock = _thread.allocate_lock()       # IO lock
+    self.mapped = mapped
+    self.keep_open = keep_open or mapped
+    self._handle = None                         # persistent file handle, see _file()
+    self._reader = None                         # reader of the consumer, see _read_handle()
+    self._read_lock = _thread.allocate_lock()   # held by the consumer while reading, see reserve()
+    self.laps = 0                               # read position moves by writers and resets, see commit()
+    self.commit_every = commit_every
+    self.commit_interval_ms = commit_interval_ms
+    self.seq = 0
+    self.ack = 0
+    self.last_position = 0                      # position of the item written last, 0 if unknown
+    self.recovered = 0                          # items rolled forward at startup
+    self.item_count = 0                         # items in the buffer, see count()
+    self._committed = None                      # header record as last committed
+    self._stored = None                         # header record loaded at startup, see _get_stored_value
+    self._generation = 0                        # generation of the last commit record
+    self._slots = [None, None]                  # NVS values of the commit record slots, if known
+    self._pending = 0                           # header changes since the last commit
+    self._ahead = None                          # (read position, laps, items, ends, max_len), see _read_ahead
+    self._last_commit = time.ticks_ms()
+    path = self.file_path.rsplit("/", 1)[0]
+
+    if path != self.file_path:
       try:
         os.stat(path)
       except:
         os.mkdir(path)
 
-      try:
-        os.stat(self.file_path)
-      except:
-        t = open(self.file_path, "w")
-        t.close()
+    try:
+      os.stat(self.file_path)
+    except:
+      t = open(self.file_path, "w")
+      t.close()
+
+    with self.iolock:
+      current_file_size = os.stat(self.file_path)[6]
+      with self._file() as buffer_file:
+        file_size = self.buffer_size + _TAIL_LEN
+        if self.buffer_size <= current_file_size < file_size:
+          # written by a version without commit records
+          buffer_file.seek(current_file_size)
+          buffer_file.write(b"\0" * (file_size - current_file_size))
+          current_file_size = file_size
+
+        # Open the file and ensure that its length is equal to `self.buffer_size`.
+        #buffer_file.truncate(self.buffer_size)
+
+        # expand file if size does not match desired buffer
+        # TODO: if we ever change MAX_ITEMS in the field we'll lose data
+        if current_file_size != file_size and (file_size - current_file_size) > 0:
+          print("**** eventfile expanding buffer_size", self.buffer_size, "vs file_size",current_file_size)
+          buffer_file.seek(current_file_size)
+          buffer_file.write(b"\0" * (file_size - current_file_size))
+          buffer_file.flush()
+          self.read_position = self._initial_position()
+          self.write_position = self._initial_position()
+          # commit records of a lost file may be left in NVS: count on from
+          # their generation and overwrite both slots, so that neither is
+          # loaded at the next start
+          self._load_commit(buffer_file)
+          self._commit_header(buffer_file)
+        else:
+          # initialize the read and write positions.
+          self.read_position = self._get_stored_read_position(buffer_file)
+          self.write_position = self._get_stored_write_position(buffer_file)
+          self.seq = self._get_stored_sequence_number(buffer_file)
+          self.ack = self._get_stored_ack_number(buffer_file)
+          self.last_position = self._get_stored_last_position(buffer_file)
+          self.item_count = self._get_stored_count(buffer_file)
+          self._committed = (self.read_position, self.write_position, self.seq, self.ack, self.last_position,
+            self._get_stored_value(buffer_file, _COUNT_IDX))
+          self._stored = None
+          self.recovered = self._roll_forward(buffer_file)
+          self.item_count += self.recovered
+        self._commit_header(buffer_file)
+
+  def _file(self):
+    """Return a context manager yielding the handle of the buffer file.
+
+    With `keep_open` the file is opened once and the same handle is
+    handed out until `close()` is called; otherwise a fresh handle is
+    opened (and closed again on exit) for every operation. Callers must
+    hold `iolock`.
+    """
+    if not self.keep_open:
+      return open(self.file_path, self.mode)
+    if self._handle == None:
+      if self.mapped:
+        self._handle = _KeptOpenFile(_MappedFile(self.file_path, self.buffer_size + _TAIL_LEN))
+        self._reader = _MappedReader(self._handle.buffer_file.view)
+      else:
+        self._handle = _KeptOpenFile(open(self.file_path, self.mode))
+    return self._handle
+
+  def _read_handle(self):
+    """Return the reader of the consumer, a view of the mapping, or
+    `None` if it reads through the handle of the writer, holding `iolock`.
+
+    There is no second file handle to read through: FatFS and LittleFS
+    keep caches per handle and do not promise that one handle sees the
+    data flushed through another, and a stale item of the previous lap
+    would still pass its CRC check.
+    """
+    if self.mapped:
+      self._file()
+      return self._reader
+    return None
 
+  def sync(self, force = True):
+    """Commit the header state held in RAM.
+
+    Without `force` the header is only committed if `commit_every` or
+    `commit_interval_ms` is due, which makes it cheap to call
+    periodically.
+    """
+    with self.iolock:
+      if self._pending > 0 and (force or self._commit_due()):
+        with self._file() as buffer_file:
+          self._commit_header(buffer_file)
+          buffer_file.flush()
+
+  def close(self):
+    """Commit pending header changes, then flush and close the
+    persistent file handle, if one is open.
+
+    The buffer stays usable; the next operation reopens the file.
+    """
+    self.sync()
+    with self._read_lock:
       with self.iolock:
-        with open(self.file_path, self.mode) as buffer_file:
-          dummy = True
-        current_file_size = os.stat(file_path)[6]
-        with open(self.file_path, self.mode) as buffer_file:
-          # Open the file and ensure that its length is equal to `self.buffer_size`.
-          #buffer_file.truncate(self.buffer_size)
-          
-          # expand file if size does not match desired buffer
-          # TODO: if we ever change MAX_ITEMS in the field we'll lose data
-          if current_file_size != self.buffer_size and (self.buffer_size - current_file_size) > 0:
-            print("**** eventfile expanding buffer_size", self.buffer_size, "vs file_size",current_file_size)
-            buffer_file.seek(current_file_size)
-            buffer_file.write("\0" * (self.buffer_size - current_file_size))
-            buffer_file.flush()
-            self.read_position = _HEADER_LEN
-            self.write_position = _HEADER_LEN
-            self._record_seq_ack(buffer_file, 0, 0)
-          else:
-            # initialize the read and write positions.
-            self.read_position = self._get_stored_read_position(buffer_file)
-            self.write_position = self._get_stored_write_position(buffer_file)
-          self._record_rw_positions(buffer_file)
-    except Exception as e:
-      print("> __init__: ", "failed:", e.args[0], e)
+        self._reader = None
+        if self._handle != None:
+          self._handle.buffer_file.flush()
+          self._handle.buffer_file.close()
+          self._handle = None
 
   def empty(self):
     """Return `True` if the buffer is empty, `False` otherwise."""
     return self.read_position == self.write_position
 
+  def count(self):
+    """Return the number of items in the buffer."""
+    return self.item_count
+
+  def bytes_used(self):
+    """Return the number of bytes between the read and the write
+    position, e.g. of the items with their size fields, and of the end
+    of the buffer left unused by a writer that wrapped around early."""
+    if self.write_position >= self.read_position:
+      return self.write_position - self.read_position
+    return self.capacity + 1 - (self.read_position - self.write_position)
+
+  def fill_ratio(self):
+    """Return the share of the capacity in use, from 0.0 to 1.0."""
+    return min(1.0, self.bytes_used() / self.capacity)
+
+  def _wrapped(self, position):
+    """Return `_HEADER_LEN` if no item can start at `position` because
+    it is too close to the end of the buffer, `position` otherwise."""
+    if position + _ITEM_SIZE_LEN > self.buffer_size - 1:
+      return _HEADER_LEN
+    return position
+
   def _advance_read_position(self, buffer_file):
     """Advances the reader position by one item."""
     buffer_file.seek(self.read_position)
@@ -195,17 +700,117 @@ class FileRingBuffer(object):
       _ITEM_SIZE_FORMAT,
       buffer_file.read(_ITEM_SIZE_LEN)
     )[0]
-    self.read_position += (_ITEM_SIZE_LEN + read_position_delta)
+    if read_position_delta == _WRAP_MARKER and self.read_position != _HEADER_LEN:
+      # the item at the read position is at the start of the buffer
+      self.read_position = _HEADER_LEN
+      self._advance_read_position(buffer_file)
+      return
+    self.read_position = self._wrapped(self.read_position + _ITEM_SIZE_LEN + (read_position_delta & _ITEM_LEN_MASK))
 
 
-  def _reader_needs_advancing(self, n):
+  def _overwrites(self, position, n):
     """Given the precondition that there is at least `n` bytes between
     the write position and the end of the buffer, returns `True` if
-    there is enough space between the write and read positions to
-    allocate `n` bytes.
+    the item at `position` would be overwritten by writing `n` bytes
+    and the end marker that follows them.
+    """
+    if self._wrapped(self.write_position + n) == _HEADER_LEN:
+      # The end marker goes to the start of the buffer, and everything
+      # behind the written bytes is abandoned until the next lap.
+      return position >= self.write_position or position == _HEADER_LEN
+    return position >= self.write_position and (
+      position - self.write_position < n + _ITEM_SIZE_LEN)
+
+
+  def _reader_needs_advancing(self, n):
+    """Returns `True` if writing `n` bytes would overwrite the item at
+    the read position."""
+    return self._overwrites(self.read_position, n)
+
+
+  def _make_room(self, buffer_file, n):
+    """Prepare the write position for writing `n` bytes of length
+    prefixed items, wrapping the writer around and advancing the reader
+    past every item that would be overwritten.
+
+    Returns a tuple of the position a wrap marker has to be written to
+    once the items are in place (or None), and whether the reader had
+    to be advanced.
+    """
+    assert n + _ITEM_SIZE_LEN <= self.capacity, "item size exceeds buffer capacity"
+    was_empty = self.empty()
+    prev_write_position = self.write_position
+    wrap_position = None
+    lapped = False
+    # If there isn't enough space from the write position to the end
+    # of the buffer, then wrap around.
+    if self.write_position + n > self.buffer_size - 1:
+      if self.write_position + _ITEM_SIZE_LEN <= self.buffer_size - 1:
+        wrap_position = self.write_position
+      self.write_position = _HEADER_LEN
+      if was_empty:
+        # Buffer was empty, so reset read position to reflect emptiness.
+        self.read_position = _HEADER_LEN
+      elif self.read_position > prev_write_position:
+        # In wrapping around, the write position lapped the read
+        # position, so the latter must be advanced one past
+        # _HEADER_LEN.
+        self.item_count -= self._count_items(buffer_file, self.read_position, _HEADER_LEN)
+        self.read_position = _HEADER_LEN
+        lapped = True
+
+    # If the buffer wasn't empty and there isn't enough space between
+    # the write and read positions to fit the items, then advance the
+    # read position until it fits.
+    while not was_empty and self._reader_needs_advancing(n):
+      self._advance_read_position(buffer_file)
+      self.item_count -= 1
+      lapped = True
+      if self.read_position == prev_write_position:
+        # every item was dropped, so the buffer is empty now
+        self.read_position = self.write_position
+        self.item_count = 0
+        break
+
+    # Items consumed since the last commit are still reachable from the
+    # committed read position, so that one must not be overwritten or
+    # abandoned either. Commit a header that is valid both before and
+    # after the write: the new read position with the old write position.
+    if self._committed != None:
+      committed_read_position = self._committed[0]
+      if (self.write_position != prev_write_position and committed_read_position > prev_write_position) or (
+        self._overwrites(committed_read_position, n)):
+        read_position = self.read_position
+        if self.empty():
+          read_position = prev_write_position
+        self._commit_header(buffer_file, read_position, prev_write_position)
+    if lapped:
+      self.laps += 1
+    return wrap_position, lapped
+
+
+  def _write_records(self, buffer_file, records, wrap_position, last_offset = 0):
+    """Write the length prefixed items in `records` at the write
+    position followed by an end marker, and advance the write position.
+    `last_offset` is the offset of the last item within `records`.
+
+    The end marker is written before the items and the wrap marker
+    after them, so that an interrupted write never makes stale data
+    reachable from the committed write position: items cut off right
+    before their end marker would otherwise be followed by an intact
+    item of the previous lap, which the roll forward on restart takes
+    as new.
     """
-    return self.read_position > self.write_position and (
-      self.read_position - self.write_position < _ITEM_SIZE_LEN + n)
+    position = self.write_position
+    self.write_position = self._wrapped(position + len(records))
+    self.last_position = position + last_offset
+    buffer_file.seek(self.write_position)
+    buffer_file.write(_END_MARKER_BYTES)
+    buffer_file.seek(position)
+    buffer_file.write(records)
+    if wrap_position != None:
+      buffer_file.seek(wrap_position)
+      buffer_file.write(_WRAP_MARKER_BYTES)
 
 
   def putString(self, item):
@@ -217,65 +822,253 @@ class FileRingBuffer(object):
   def simulateDestruction(self):
     try:
       with self.iolock:
-        with open(self.file_path, self.mode) as buffer_file:
+        with self._file() as buffer_file:
           buffer_file.seek(0)
-          buffer_file.write('\0' * (self.buffer_size))
+          buffer_file.write(b'\0' * (self.buffer_size + _TAIL_LEN))
           buffer_file.flush()
     except Exception as e:
       print("> simulatedesctruction ", e.args[0], e)
       raise e
 
   def put(self, item):
-    try: 
+    try:
       """Put the bytes of the string `item` in the buffer."""
       assert type(item) is bytes, "items put into ring buffer must be bytes"
       with self.iolock:
-        with open(self.file_path, self.mode) as buffer_file:
+        with self._file() as buffer_file:
           item_len = len(item)
-          assert _ITEM_SIZE_LEN + item_len <= self.capacity, "item size exceeds buffer capacity"
-          # If there isn't enough space from the write position to the end
-          # of the buffer, then wrap around.
-          prev_write_position = self.write_position
-          was_empty = self.empty()
-          if self.write_position + _ITEM_SIZE_LEN + item_len + 1 > self.buffer_size:
-            self.write_position = _HEADER_LEN
-            if was_empty:
-              # Buffer was empty, so reset read position to reflect emptiness.
-              self.read_position = _HEADER_LEN
-            elif self.read_position > prev_write_position:
-              # In wrapping around, the write position lapped the read
-              # position, so the latter must be advanced one past
-              # _HEADER_LEN.
-              self.read_position = _HEADER_LEN
-              self._advance_read_position(buffer_file)
-          # If the buffer wasn't empty and there isn't enough space between
-          # the write and read positions to fit the item, then advance the
-          # read position until it fits.
-          while not was_empty and self._reader_needs_advancing(item_len):
-            self._advance_read_position(buffer_file)
-          
+          assert item_len <= _ITEM_LEN_MASK, "item size exceeds 64 KiB"
+          wrap_position, lapped = self._make_room(buffer_file, _ITEM_SIZE_LEN + item_len)
+
           # Now that enough writer headroom has been ensured, it is safe to
           # write the item.
-          
-          eventId = int.from_bytes(item[0:2], 'little')
-          eventTime = int.from_bytes(item[3:7], 'little')
-          event = {'ID':eventId, 'Command':item[2] ,'Time':eventTime, 'Data': item[7:len(item)]}
-          
-          buffer_file.seek(self.write_position)
-          buffer_file.write(struct.pack(_ITEM_SIZE_FORMAT, item_len))
-          buffer_file.write(item)
-          
-          if buffer_file.tell() >= self.buffer_size:
-            self.write_position = _HEADER_LEN
-            
-          else:
-            self.write_position = buffer_file.tell()
-          
-          self._record_rw_positions(buffer_file)
+          self._write_records(buffer_file, self._item_size_field(item) + item, wrap_position)
+          self.item_count += 1
+
+          # lapping the reader drops items, which must not be undone by a restart
+          self._header_changed(buffer_file, lapped)
           buffer_file.flush()
     except Exception as e:
       print("> put: ", "failed:", e.args[0], e)
 
+  def put_many(self, items):
+    """Put all byte strings in `items` in the buffer, with one write per
+    contiguous run of the buffer and a single header update."""
+    try:
+      with self.iolock:
+        with self._file() as buffer_file:
+          lapped = False
+          i = 0
+          while i < len(items):
+            # collect the items that fit up to the end of the buffer; if
+            # not even the first one does, it wraps around on its own.
+            # Runs are limited to half the capacity so that a run never
+            # overwrites itself.
+            records = []
+            size = 0
+            while i < len(items):
+              item = items[i]
+              assert type(item) is bytes, "items put into ring buffer must be bytes"
+              assert len(item) <= _ITEM_LEN_MASK, "item size exceeds 64 KiB"
+              record_len = _ITEM_SIZE_LEN + len(item)
+              if len(records) > 0 and (self.write_position + size + record_len > self.buffer_size - 1 or
+                size + record_len > self.capacity // 2):
+                break
+              records.append(self._item_size_field(item))
+              records.append(item)
+              size += record_len
+              i += 1
+            wrap_position, chunk_lapped = self._make_room(buffer_file, size)
+            self._write_records(buffer_file, b"".join(records), wrap_position, size - _ITEM_SIZE_LEN - len(records[-1]))
+            self.item_count += len(records) // 2
+            lapped = lapped or chunk_lapped
+
+          self._header_changed(buffer_file, lapped)
+          buffer_file.flush()
+    except Exception as e:
+      print("> put_many: ", "failed:", e.args[0], e)
+
+  def _read_items(self, buffer_file, n, max_len, start = None, stop = None, ends = None):
+    """Read up to `n` consecutive items from `start` (the read position)
+    on up to `stop` (the write position), with one read per contiguous
+    run of the buffer. Returns the items and the position following the
+    last one; the position following every item is appended to `ends`,
+    if given. Not thread safe.
+
+    `max_len` is the expected maximum item size, used to size the reads.
+    """
+    if start == None:
+      start = self.read_position
+    if stop == None:
+      stop = self.write_position
+    items = []
+    pos = start
+    while len(items) < n and pos != stop:
+      if pos + _ITEM_SIZE_LEN > self.buffer_size - 1:
+        pos = _HEADER_LEN
+        continue
+      end = stop if stop > pos else self.buffer_size - 1
+      buffer_file.seek(pos)
+      chunk = buffer_file.read(min(end - pos, (n - len(items)) * (_ITEM_SIZE_LEN + max_len)))
+      offset = 0
+      wrap = False
+      while len(items) < n and offset + _ITEM_SIZE_LEN <= len(chunk):
+        item_len = struct.unpack_from(_ITEM_SIZE_FORMAT, chunk, offset)[0]
+        if item_len == _WRAP_MARKER and pos + offset != _HEADER_LEN:
+          wrap = True
+          break
+        if item_len <= 0:
+          break
+        item_len &= _ITEM_LEN_MASK
+        if offset + _ITEM_SIZE_LEN + item_len > len(chunk):
+          break
+        item = chunk[offset + _ITEM_SIZE_LEN:offset + _ITEM_SIZE_LEN + item_len]
+        items.append(item)
+        offset += _ITEM_SIZE_LEN + item_len
+        if ends != None:
+          ends.append(pos + offset)
+      if wrap:
+        pos = _HEADER_LEN
+      elif offset == 0:
+        # unreadable item, or one larger than max_len
+        break
+      else:
+        pos += offset
+    return items, pos
+
+  def _caching(self):
+    """Return whether items are read through the read-ahead cache."""
+    return self.read_ahead > 0 and not self.mapped
+
+  def _read_ahead(self, buffer_file, n, max_len):
+    """Return up to `n` items from the read position on, and the
+    position following every item, from the read-ahead cache. Holding
+    `iolock`.
+
+    The cache is refilled with the next `max(n, read_ahead)` items by one
+    chunked read when it does not hold them. It is only valid for the
+    read position and `laps` it was filled at, so a put that laps the
+    reader, `clear()` and `setReadPosition()` invalidate it, while
+    consuming items drops them from it (see `_consume_ahead`).
+    """
+    ahead = self._cached_ahead(n, max_len)
+    if ahead == None:
+      items, ends = self._read_reserved(buffer_file, self.read_position, self.write_position, max(n, self.read_ahead), max_len)
+      ahead = (self.read_position, self.laps, items, ends, max_len)
+      self._ahead = ahead
+    return ahead[2][:n], ahead[3][:n]
+
+  def _cached_ahead(self, n, max_len):
+    """Return the read-ahead cache if it holds the next `n` items (or
+    all items up to the write position), `None` otherwise. Holding
+    `iolock`."""
+    ahead = self._ahead
+    if ahead == None or ahead[0] != self.read_position or ahead[1] != self.laps or ahead[4] < max_len or (
+        len(ahead[2]) < n and self._end_position(ahead[3][-1] if len(ahead[3]) > 0 else ahead[0]) != self.write_position):
+      return None
+    return ahead
+
+  def _consume_ahead(self, start, n):
+    """Drop the first `n` items from the read-ahead cache after the read
+    position moved past them from `start`."""
+    ahead = self._ahead
+    if ahead != None and ahead[0] == start and ahead[1] == self.laps and len(ahead[2]) >= n:
+      self._ahead = (self.read_position, self.laps, ahead[2][n:], ahead[3][n:], ahead[4])
+    else:
+      self._ahead = None
+
+  def peek_many(self, n, max_len = 100):
+    """Return up to `n` items from the read position on, without
+    removing them."""
+    return self.reserve(n, max_len)[0]
+
+  def _end_position(self, position):
+    """Return the read position following an item that ends at `position`."""
+    if position != self.write_position:
+      return self._wrapped(position)
+    return position
+
+  def _read_reserved(self, buffer_file, start, stop, n, max_len):
+    """Read up to `n` items from `start` on up to `stop` and return them
+    with the position following every item. Not thread safe."""
+    ends = []
+    items = self._read_items(buffer_file, n, max_len, start, stop, ends)[0]
+    return items, ends
+
+  def _reserve(self, buffer_file, n, max_len):
+    """`reserve()` holding `iolock`."""
+    start = self.read_position
+    if self._caching():
+      items, ends = self._read_ahead(buffer_file, n, max_len)
+    else:
+      items, ends = self._read_reserved(buffer_file, start, self.write_position, n, max_len)
+    return items, (start, ends, self.laps)
+
+  def reserve(self, n, max_len = 100):
+    """Return up to `n` items from the read position on, without
+    removing them, and a token that `commit()` takes to remove them.
+
+    With `mapped`, `iolock` is only held to take the positions; the
+    items are read from the mapping (see `_read_handle()`), so that a
+    consumer does not wait for concurrent puts, nor a put for the reads.
+    If a put overwrote the items meanwhile, or not all of them could be
+    read, they are read again holding `iolock`.
+    """
+    with self._read_lock:
+      with self.iolock:
+        start = self.read_position
+        stop = self.write_position
+        laps = self.laps
+        if start == stop:
+          return [], (start, [], laps)
+        if self._caching():
+          ahead = self._cached_ahead(n, max_len)
+          if ahead != None:
+            return ahead[2][:n], (start, ahead[3][:n], laps)
+        reader = self._read_handle()
+        if reader == None:
+          with self._file() as buffer_file:
+            return self._reserve(buffer_file, n, max_len)
+      items, ends = self._read_reserved(reader, start, stop, n, max_len)
+      end = ends[-1] if len(ends) > 0 else start
+      complete = len(items) == n or end == stop or self._wrapped(end) == stop
+      with self.iolock:
+        if laps == self.laps and start == self.read_position and complete:
+          return items, (start, ends, laps)
+        with self._file() as buffer_file:
+          return self._reserve(buffer_file, n, max_len)
+
+  def commit(self, token, n = None):
+    """Remove the first `n` (by default all) items reserved with `token`.
+
+    Returns `False`, removing nothing, if the read position was moved
+    since `reserve()` by anything else than a commit of the same token,
+    e.g. by a put that dropped the items.
+    """
+    start, ends, laps = token
+    if n == None or n > len(ends):
+      n = len(ends)
+    with self.iolock:
+      if laps != self.laps or start != self.read_position:
+        return False
+      if n > 0:
+        self.read_position = self._end_position(ends[n - 1])
+        self.item_count -= n
+        self._consume_ahead(start, n)
+        with self._file() as buffer_file:
+          if self._header_changed(buffer_file):
+            buffer_file.flush()
+      return True
+
+  def get_many(self, n, max_len = 100):
+    """Remove and return up to `n` items from the buffer, read like
+    `reserve()` does."""
+    while True:
+      items, token = self.reserve(n, max_len)
+      # reserved again if a put dropped them meanwhile
+      if len(items) == 0 or self.commit(token):
+        return items
+
   def getString(self):
     """Remove and return the next string from the buffer."""
     data = self.get()
@@ -284,26 +1077,38 @@ class FileRingBuffer(object):
 
   def get(self):
     """Remove and return the next item from the buffer."""
+    items, token = self.reserve(1)
+    if len(items) > 0 and self.commit(token):
+      return items[0]
+    if self.empty():
+      return None
+    # dropped by a put meanwhile, or not handed out by reserve(), e.g.
+    # larger than 100 bytes
     with self.iolock:
-      with open(self.file_path, self.mode) as buffer_file:
+      with self._file() as buffer_file:
         # Read the current item.
+        start = self.read_position
         result = self._readItemAtPosition(buffer_file, self.read_position)
+        end = buffer_file.tell()
 
         # Update the read position.
-        if buffer_file.tell() >= self.buffer_size - 1:
+        if end + _ITEM_SIZE_LEN > self.buffer_size - 1:
           self.read_position = _HEADER_LEN
           # 27.07.2019 - inifity loop sending events
           # when buffer is exactly filled and only as long it is.:
           # WRITE POS will point to END - Once last element is send, READ_POS will point to START by upper line
           # WRITE POS will be moved, once new element gets added
-          # because WRITE_POS != READ_POS means not empty, events will be send again through
-          if self.write_position >= self.buffer_size-1:
+          # because WRITE_POS != READ_POS means not empty, events will be send again through
+          if self.write_position + _ITEM_SIZE_LEN > self.buffer_size - 1:
             self.write_position = _HEADER_LEN
         else:
-          self.read_position = buffer_file.tell()
+          self.read_position = end
+        if result != None and self.item_count > 0:
+          self.item_count -= 1
+        self._consume_ahead(start, 1)
 
-        self._record_rw_positions(buffer_file)
-        buffer_file.flush()
+        if self._header_changed(buffer_file):
+          buffer_file.flush()
         return result
 
   def printReadWritePos(self):
@@ -319,7 +1124,8 @@ class FileRingBuffer(object):
     self.printSeqAck()
 
   def _readItemAtPosition(self, buffer_file, position, max_len = 100):
-    """Reads the item at the specified position in the buffer. Not thread safe."""
+    """Reads the item at the specified position in the buffer, following
+    a wrap marker to the start of the buffer. Not thread safe."""
     if position >= self.buffer_size - 1:
       return None
 
@@ -329,8 +1135,11 @@ class FileRingBuffer(object):
         _ITEM_SIZE_FORMAT,
         buffer_file.read(_ITEM_SIZE_LEN)
       )[0]
+      if item_len == _WRAP_MARKER and position != _HEADER_LEN:
+        return self._readItemAtPosition(buffer_file, _HEADER_LEN, max_len)
       if item_len <= 0:
         return None
+      item_len &= _ITEM_LEN_MASK
       if item_len > max_len:
         item_len = max_len
       return buffer_file.read(item_len)
@@ -350,9 +1159,12 @@ class FileRingBuffer(object):
     # not accepted
     if self.empty():
       return None
+    items = self.reserve(1)[0]
+    if len(items) > 0:
+      return items[0]
 
     with self.iolock:
-      with open(self.file_path, "r+b") as buffer_file:
+      with self._file() as buffer_file:
         # 27.07.2019 - if a device is stuck at the end
         # no events can be peeked anymore
         # should not longer happen because of fixing the advanceReadPositionFrom
@@ -360,7 +1172,7 @@ class FileRingBuffer(object):
         # this helps to let the device recover
         # if the READ_POS is moved, we need to check again whether it is empty
         # preventing from looping again through
-        if self.read_position >= self.buffer_size-1:
+        if self.read_position + _ITEM_SIZE_LEN > self.buffer_size-1:
           self.read_position = _HEADER_LEN
           if self.empty():
             return None
@@ -368,84 +1180,179 @@ class FileRingBuffer(object):
 
 
   def peekLast(self, blockSize):
-    """Peek the last item written to the buffer, e.g. the item at `write_position - blockSite`."""
-    pos = self.write_position - blockSize - _ITEM_SIZE_LEN
-    if pos < _HEADER_LEN:
-      # TODO: roll over
-      pos = self.buffer_size - 1 - blockSize - _ITEM_SIZE_LEN
-      #return None
+    """Peek the last item written to the buffer, e.g. the item at `last_position`.
+
+    If the tail index is unknown (buffers written by older versions),
+    the item is assumed at `write_position - blockSize`.
+    """
+    pos = self.last_position
+    if pos == 0:
+      pos = self.write_position - blockSize - _ITEM_SIZE_LEN
+      if pos < _HEADER_LEN:
+        # TODO: roll over
+        pos = self.buffer_size - 1 - blockSize - _ITEM_SIZE_LEN
+        #return None
 
     with self.iolock:
-      with open(self.file_path, "r+b") as buffer_file:
+      with self._file() as buffer_file:
         return self._readItemAtPosition(buffer_file, pos, blockSize)
 
 
-  # TODO: use iterable / yield
-  def iterate(self, callback):
-    """Remove and return the next item from the buffer."""
+  def _read_chunk(self, position, needed, chunk_size):
+    """Read the aligned chunk of at least `chunk_size` bytes that holds
+    `needed` bytes from `position` on. Returns the offset of the chunk
+    and its data."""
+    start = position - (position - _HEADER_LEN) % chunk_size
+    end = start + chunk_size
+    while end < position + needed:
+      end += chunk_size
+    end = min(end, self.buffer_size - 1)
     with self.iolock:
-      with open(self.file_path, "r+b") as buffer_file:
-        pos = _HEADER_LEN
-        while pos < self.buffer_size - _ITEM_SIZE_LEN - 1:
-            data = self._readItemAtPosition(buffer_file, pos)
-            if data == None or len(data) == 0:
-              return
+      with self._file() as buffer_file:
+        buffer_file.seek(start)
+        return start, buffer_file.read(end - start)
 
-            if not callback(data, pos):
-              return
+  def items(self, start = None, stop = None, chunk_size = 1024):
+    """Yield `(position, item)` for every item from `start` (the read
+    position) up to `stop` (the write position), following the wrap.
 
-            pos = pos + _ITEM_SIZE_LEN + len(data)
+    The file is read in aligned chunks of `chunk_size` bytes and `iolock`
+    is only held while a chunk is read, so items put or removed while
+    iterating may or may not be seen.
+    """
+    if start == None:
+      start = self.read_position
+    if stop == None:
+      stop = self.write_position
+    pos = start
+    chunk_pos = 0
+    chunk = b""
+    # bounded, in case the buffer holds garbage
+    for _ in range(self.capacity // (_ITEM_SIZE_LEN + 1) + 3):
+      if pos == stop:
+        return
+      if pos + _ITEM_SIZE_LEN > self.buffer_size - 1:
+        pos = _HEADER_LEN
+        continue
+      offset = pos - chunk_pos
+      if offset < 0 or offset + _ITEM_SIZE_LEN > len(chunk):
+        chunk_pos, chunk = self._read_chunk(pos, _ITEM_SIZE_LEN, chunk_size)
+        offset = pos - chunk_pos
+      item_len = struct.unpack_from(_ITEM_SIZE_FORMAT, chunk, offset)[0]
+      if item_len == _WRAP_MARKER and pos != _HEADER_LEN:
+        pos = _HEADER_LEN
+        continue
+      if item_len <= 0:
+        # end marker
+        return
+      item_len &= _ITEM_LEN_MASK
+      if pos + _ITEM_SIZE_LEN + item_len > self.buffer_size - 1:
+        # no item
+        return
+      if offset + _ITEM_SIZE_LEN + item_len > len(chunk):
+        chunk_pos, chunk = self._read_chunk(pos, _ITEM_SIZE_LEN + item_len, chunk_size)
+        offset = pos - chunk_pos
+      yield pos, chunk[offset + _ITEM_SIZE_LEN:offset + _ITEM_SIZE_LEN + item_len]
+      pos = self._wrapped(pos + _ITEM_SIZE_LEN + item_len)
+
+  def iterate(self, callback):
+    """Call `callback(item, position)` for every item from the read
+    position on until it returns a false value."""
+    for pos, data in self.items():
+      if not callback(data, pos):
+        return
 
 
   def setReadPosition(self, position):
     with self.iolock:
       self.read_position = position
-      with open(self.file_path, self.mode) as buffer_file:
-        self._record_rw_positions(buffer_file)
+      self.laps += 1
+      with self._file() as buffer_file:
+        self.item_count = self._count_items(buffer_file, self.read_position, self.write_position)
+        self._header_changed(buffer_file)
         buffer_file.flush()
 
 
+  def _next_position(self, buffer_file, position):
+    """Return the position following the item at `position`."""
+    buffer_file.seek(position)
+    item_len = struct.unpack(_ITEM_SIZE_FORMAT, buffer_file.read(_ITEM_SIZE_LEN))[0]
+    if item_len == _WRAP_MARKER and position != _HEADER_LEN:
+      return self._next_position(buffer_file, _HEADER_LEN)
+    return self._wrapped(position + _ITEM_SIZE_LEN + (item_len & _ITEM_LEN_MASK))
+
+  def skip(self, position, n, ack = None, start = None):
+    """Remove the items from the read position up to and including the
+    one at `position`, which the caller knows to be the `n`-th, reading
+    only its size field. With `ack`, the ack number is set along with the
+    read position, in the same header change.
+
+    Returns `False`, removing nothing, if the read position is no longer
+    `start` (e.g. the position of a `reserve()` token).
+    """
+    with self.iolock:
+      if start != None and start != self.read_position:
+        return False
+      with self._file() as buffer_file:
+        self.read_position = self._next_position(buffer_file, position)
+        self.item_count = max(0, self.item_count - n)
+        self.laps += 1
+        if ack != None:
+          self.ack = ack
+        if self._header_changed(buffer_file):
+          buffer_file.flush()
+      return True
+
+
   def advanceReadPositionFrom(self, position):
     with self.iolock:
       self.read_position = position
-      with open(self.file_path, self.mode) as buffer_file:
+      self.laps += 1
+      with self._file() as buffer_file:
         self._advance_read_position(buffer_file)
         # 25.07.2019 - Device gets stuck in eventLog.peekNext()
         # Cause: if a ACK moves the read pointer to the last element in the fileringbuffer
         # advanceReadPositionFrom doesn't check for END
         if self.read_position >= self.buffer_size - 1:
           self.read_position = _HEADER_LEN
-        self._record_rw_positions(buffer_file)
+        self.item_count = self._count_items(buffer_file, self.read_position, self.write_position)
+        self._header_changed(buffer_file)
         buffer_file.flush()
 
 
   def clear(self):
     """Remove all elements from the buffer."""
     with self.iolock:
-      with open(self.file_path, self.mode) as buffer_file:
+      with self._file() as buffer_file:
         buffer_file.seek(0)
-        buffer_file.write("\0" * self.buffer_size)
+        buffer_file.write(b"\0" * self.buffer_size)
         self.read_position = _HEADER_LEN
         self.write_position = _HEADER_LEN
-        self._record_rw_positions(buffer_file)
+        self.last_position = 0
+        self.item_count = 0
+        self.laps += 1
+        self._ahead = None
+        self._committed = None
+        self._header_changed(buffer_file, True)
+        buffer_file.flush()
 
 
   def storeSeqAck(self, seq, ack):
     try:
       with self.iolock:
-        with open(self.file_path, self.mode) as buffer_file:
-          self._record_seq_ack(buffer_file, seq, ack)
+        self.seq = seq
+        self.ack = ack
+        with self._file() as buffer_file:
+          self._header_changed(buffer_file)
     except Exception as e:
       print("> storeSeqAck failed:", e.args[0], e)
       raise e
 
   def getSequenceNumber(self):
     with self.iolock:
-      with open(self.file_path, self.mode) as buffer_file:
-        return self._get_stored_sequence_number(buffer_file)
+      return self.seq
 
 
   def getAckNumber(self):
     with self.iolock:
-      with open(self.file_path, self.mode) as buffer_file:
-        return self._get_stored_ack_number(buffer_file)
+      return self.ack
@@ -6,9 +6,37 @@ _SEQ_ID_IDX     = _POS_VALUE_LEN * 2
 _ACK_ID_IDX     = _POS_VALUE_LEN * 3
 _HEADER_LEN     = _POS_VALUE_LEN * 4
 
-# Item size constants.
+# Tail index, committed together with the header.
+_LAST_POS_IDX   = _POS_VALUE_LEN * 4            # position of the item written last
+_COUNT_IDX      = _POS_VALUE_LEN * 5            # number of items, see _COUNT_BITS
+
+# Commit records: the header and tail index values, a generation counter
+# and a CRC32 of both. Two records are stored behind the buffer (file) or
+# in NVS and written alternately, so that one of them is always valid.
+_COMMIT_VALUES  = 6                             # read pos, write pos, seq, ack, last pos, count
+_COMMIT_LEN     = _POS_VALUE_LEN * _COMMIT_VALUES + 4 + 4
+_TAIL_LEN       = _COMMIT_LEN * 2
+
+# The count is stored in the low _COUNT_BITS bits, above them a check
+# value of the read and write positions it was counted for (so that it
+# fits the 32 bits of an NVS value).
+_COUNT_BITS     = 20
+_COUNT_CHECK_MASK = 0xFFF
+
+# Item size constants. The size field holds the item size in the low
+# 16 bits and a 15 bit CRC of the item above them, so that it stays
+# positive.
 _ITEM_SIZE_LEN = 4
+_ITEM_LEN_MASK = 0xFFFF
+_ITEM_CHECK_SHIFT = 16
+_ITEM_CHECK_MASK = 0x7FFF
+
+# Item size values with a special meaning.
+_END_MARKER     = 0                             # no item follows (found at the write position)
+_WRAP_MARKER    = -1                            # next item is at _HEADER_LEN
 
 # struct.[un]pack format string for length fields
 _POS_VALUE_FORMAT = "q"
 _ITEM_SIZE_FORMAT = "i"
+_COMMIT_FORMAT    = "<" + _POS_VALUE_FORMAT * _COMMIT_VALUES + "I"   # values, generation
+_COMMIT_CRC_FORMAT = "<I"                       # follows the record it checks
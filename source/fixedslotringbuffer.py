@@ -0,0 +1,213 @@
+from fileringbufferconstants import _HEADER_LEN, _READ_POS_IDX, _WRITE_POS_IDX
+from blockringbuffer import BlockRingBuffer
+
+class FixedSlotRingBuffer(BlockRingBuffer):
+  """A file-based ring buffer of fixed-size items.
+
+  The file has the same header as `FileRingBuffer`, followed by
+  `max_items + 1` slots of `slot_size` bytes each. Items are stored
+  without a length prefix, and the read and write positions are slot
+  indices, so that locating, skipping and dropping items never needs
+  to read the file.
+
+  Header changes are committed in batches like in `FileRingBuffer`.
+  Since slots carry no end marker, items written after the last commit
+  can only be rolled forward on restart if a `follows(previous, item)`
+  function is given that tells whether `item` was written right after
+  `previous`; without it, use `commit_every=1`.
+  """
+
+  nvs_prefix = "wks"
+
+  def __init__(self, file_path, max_items, slot_size, keep_open = True, commit_every = 1, commit_interval_ms = 0, follows = None, mapped = False):
+    try:
+      """
+      Parameters
+      ----------
+      file_path : path to a file to use in the buffer
+      max_items : number of items the buffer holds
+      slot_size : size, in bytes, of every item
+      follows : optional function used to roll forward at startup
+      See `FileRingBuffer` for the remaining parameters.
+      """
+      self.file_path = file_path
+      self.mode = "r+b"
+      self.slot_size = slot_size
+      self.slots = max_items + 1
+      self.capacity = self.slots * slot_size
+      self.buffer_size = _HEADER_LEN + self.capacity
+      self.follows = follows
+      self._open_buffer(keep_open, commit_every, commit_interval_ms, mapped)
+    except Exception as e:
+      print("> __init__: ", "failed:", e.args[0], e)
+
+  def _get_stored_read_position(self, buffer_file):
+    return self._get_stored_slot(buffer_file, _READ_POS_IDX)
+
+  def _get_stored_write_position(self, buffer_file):
+    return self._get_stored_slot(buffer_file, _WRITE_POS_IDX)
+
+  def _get_stored_slot(self, buffer_file, index):
+    slot = self._get_stored_value(buffer_file, index)
+    if slot < 0 or slot >= self.slots:
+      print("> _get_stored_slot: ", "invalid slot", slot, "reset to 0")
+      return 0
+    return slot
+
+  def _get_stored_last_position(self, buffer_file):
+    # the item written last is always in the slot before the write
+    # position, so the tail index is not used
+    return 0
+
+  def _get_stored_count(self, buffer_file):
+    # the count follows from the positions
+    return 0
+
+  def _offset(self, slot):
+    return _HEADER_LEN + slot * self.slot_size
+
+  def _read_slots(self, buffer_file, slot, n):
+    """Read `n` consecutive items from `slot` on, with at most two reads."""
+    items = []
+    while n > 0:
+      run = min(n, self.slots - slot)
+      buffer_file.seek(self._offset(slot))
+      data = buffer_file.read(run * self.slot_size)
+      for i in range(run):
+        items.append(data[i * self.slot_size:(i + 1) * self.slot_size])
+      n -= run
+      slot = 0
+    return items
+
+  def _roll_forward(self, buffer_file):
+    if self.follows == None:
+      return 0
+    recovered = 0
+    previous = self._read_slots(buffer_file, (self.write_position - 1) % self.slots, 1)[0]
+    while True:
+      next_slot = (self.write_position + 1) % self.slots
+      if next_slot == self.read_position:
+        break
+      item = self._read_slots(buffer_file, self.write_position, 1)[0]
+      if not self.follows(previous, item):
+        break
+      previous = item
+      self.write_position = next_slot
+      recovered += 1
+    return recovered
+
+  def count(self):
+    """Return the number of items in the buffer."""
+    return (self.write_position - self.read_position) % self.slots
+
+  def bytes_used(self):
+    return self.count() * self.slot_size
+
+  def fill_ratio(self):
+    return self.count() / (self.slots - 1)
+
+  def _make_slots(self, buffer_file, n):
+    """Drop the oldest items until `n` more fit and return whether any
+    item was dropped. Commits an intermediate header first if the
+    write would overwrite the item at the committed read position or
+    move the write position onto it."""
+    prev_write_position = self.write_position
+    lapped = False
+    free = self.slots - 1 - self.count()
+    if n > free:
+      self.read_position = (self.read_position + n - free) % self.slots
+      self.laps += 1
+      lapped = True
+    if n == self.slots - 1:
+      # the slot before the write position, which anchors the roll
+      # forward at startup, gets overwritten as well
+      lapped = True
+    if self._committed != None and (self._committed[0] - prev_write_position) % self.slots <= n:
+      self._commit_header(buffer_file, self.read_position, prev_write_position)
+    return lapped
+
+  def _write_slots(self, buffer_file, items):
+    """Write `items` from the write position on, with at most two writes."""
+    data = b"".join(items)
+    run = min(len(items), self.slots - self.write_position) * self.slot_size
+    buffer_file.seek(self._offset(self.write_position))
+    buffer_file.write(data[:run])
+    if run < len(data):
+      buffer_file.seek(_HEADER_LEN)
+      buffer_file.write(data[run:])
+    self.write_position = (self.write_position + len(items)) % self.slots
+    self.last_position = (self.write_position - 1) % self.slots
+
+  def put_many(self, items):
+    """Put the items in the buffer; if there are more than fit, only
+    the newest ones are kept."""
+    try:
+      for item in items:
+        assert type(item) is bytes, "items put into ring buffer must be bytes"
+        assert len(item) == self.slot_size, "items must be exactly slot_size bytes"
+      if len(items) > self.slots - 1:
+        items = items[len(items) - (self.slots - 1):]
+      if len(items) == 0:
+        return
+      with self.iolock:
+        with self._file() as buffer_file:
+          lapped = self._make_slots(buffer_file, len(items))
+          self._write_slots(buffer_file, items)
+          self._header_changed(buffer_file, lapped)
+          buffer_file.flush()
+    except Exception as e:
+      print("> put_many: ", "failed:", e.args[0], e)
+
+  def _read_reserved(self, buffer_file, start, stop, n, max_len):
+    n = min(n, (stop - start) % self.slots)
+    items = self._read_slots(buffer_file, start, n)
+    return items, [(start + i) % self.slots for i in range(1, n + 1)]
+
+  def peekLast(self, blockSize = None):
+    """Peek the item written last, e.g. the one in the slot before `write_position`."""
+    with self.iolock:
+      with self._file() as buffer_file:
+        return self._read_slots(buffer_file, (self.write_position - 1) % self.slots, 1)[0]
+
+  def items(self, start = None, stop = None, chunk_size = 1024):
+    """Yield `(slot, item)` for every item from `start` (the read slot) up
+    to `stop` (the write slot), reading chunks of about `chunk_size` bytes
+    with `iolock` held only while a chunk is read."""
+    if start == None:
+      start = self.read_position
+    if stop == None:
+      stop = self.write_position
+    per_chunk = max(1, chunk_size // self.slot_size)
+    slot = start
+    while slot != stop:
+      n = min((stop - slot) % self.slots, per_chunk, self.slots - slot)
+      with self.iolock:
+        with self._file() as buffer_file:
+          items = self._read_slots(buffer_file, slot, n)
+      for item in items:
+        yield slot, item
+        slot = (slot + 1) % self.slots
+
+  def _next_position(self, buffer_file, slot):
+    return (slot + 1) % self.slots
+
+  def advanceReadPositionFrom(self, position):
+    with self.iolock:
+      self.read_position = (position + 1) % self.slots
+      self.laps += 1
+      with self._file() as buffer_file:
+        self._header_changed(buffer_file)
+        buffer_file.flush()
+
+  def clear(self):
+    """Remove all elements from the buffer."""
+    with self.iolock:
+      with self._file() as buffer_file:
+        buffer_file.seek(0)
+        buffer_file.write(b"\0" * self.buffer_size)
+        self.read_position = 0
+        self.write_position = 0
+        self.laps += 1
+        self._committed = None
+        self._header_changed(buffer_file, True)
+        buffer_file.flush()
@@ -0,0 +1,101 @@
+"""
+ Copyright © 2019 TimeTool AG. All rights reserved.
+"""
+
+# log levels, a message is logged if its level is at most the level of its topic
+ERROR = 1
+WARN = 2
+TRACE = 3
+DEBUG = 4
+LEVEL_NAMES = ("", "ERROR", "WARN", "TRACE", "DEBUG")
+
+# record of the binary log ring (see Logger.event):
+# <ticks_ms> <topic id> <code> <level> <number of values> <RECORD_VALUES values>
+RECORD_VALUES = 6
+RECORD_FORMAT = "<IBBBB" + "i" * RECORD_VALUES
+RECORD_LEN = 8 + 4 * RECORD_VALUES
+RECORD_VALUES_OFFSET = 8
+
+# dump of the log ring (see Logger.dump):
+# <magic> <version> <record length> <records> <next record> <records used>
+# <length of topic names> <topic names, separated by \n> <records>
+DUMP_MAGIC = b"WKLG"
+DUMP_FORMAT = "<4sBBHHHH"
+DUMP_HEADER_LEN = 14
+DUMP_VERSION = 1
+
+# message codes, never reuse a code for another message, as dumps are
+# decoded with the table of the current version
+EVENTLOG_ADDED = 1
+EVENTLOG_ADDED_MANY = 2
+EVENTLOG_ADDED_QUEUED = 3
+EVENTLOG_ADVANCED_ID = 4
+QUEUE_DROPPED = 10
+SENDER_PUBLISHING = 20
+SENDER_HANDLING = 21
+SENDER_COMMIT_FAILED = 22
+SENDER_RETRANSMITTING = 23
+SENDER_ACK_TIMEOUT = 24
+LORA_PREPARING = 30
+LORA_TAG = 31
+LORA_BATCH = 32
+LORA_SENDING = 33
+LORA_RECEIVED = 34
+LORA_NO_DOWNLINK = 35
+LORA_UPLINK_FAILED = 36
+LORA_STATS = 37
+LORA_TX_FAILED = 38
+LORA_ACK = 39
+LORA_TAG_UID = 40
+TAGFILTER_COALESCED = 50
+
+# returns the values of LORA_TAG_UID as formatted: <SEQ#> <uid as hex> <ts>,
+# the UID is logged as <length> and up to 3 big endian words of it
+def _tagUidValues(values):
+    if len(values) < 6:
+        return values
+    uid = b"".join([(value & 0xFFFFFFFF).to_bytes(4, "big") for value in values[3:6]])
+    return (values[0], "".join(["%02x" % b for b in uid[0:values[2]]]), values[1])
+
+# level and text of the messages, rendered like the text logged by Logger.log,
+# and optionally a function returning the values to format
+MESSAGES = {
+    EVENTLOG_ADDED: (TRACE, "Added Event {} to buffer, cmd = {}"),
+    EVENTLOG_ADDED_MANY: (TRACE, "Added {} Events up to {} to buffer, cmd = {}"),
+    EVENTLOG_ADDED_QUEUED: (TRACE, "Added {} queued Events up to {} to buffer"),
+    EVENTLOG_ADVANCED_ID: (TRACE, "Advanced Event ID to {}"),
+    QUEUE_DROPPED: (WARN, "dropped {} events because the queue was full, total {}"),
+    SENDER_PUBLISHING: (TRACE, "Publishing event # {}  with CMD {}"),
+    SENDER_HANDLING: (TRACE, "Handling event # {}  with CMD {}"),
+    SENDER_COMMIT_FAILED: (WARN, "Events sent were dropped or removed meanwhile"),
+    SENDER_RETRANSMITTING: (TRACE, "Retransmitting {} missing events from # {}"),
+    SENDER_ACK_TIMEOUT: (WARN, "No acknowledgement for {} s, sending again from # {}"),
+    LORA_PREPARING: (TRACE, "Preparing to send CMD = {} , SEQ_NO = {} , {} events pending"),
+    LORA_TAG: (TRACE, "CMD 0x01 [NFC_DETECTED] SEQ# {} . uid = {:08x} , ts = {}"),
+    LORA_TAG_UID: (TRACE, "CMD 0x01 [NFC_DETECTED] SEQ# {} . uid = {} , ts = {}", _tagUidValues),
+    LORA_BATCH: (TRACE, "CMD 0x06 [NFC_DETECTED_BATCH] SEQ# {} - {} . {} events in {} bytes"),
+    LORA_SENDING: (TRACE, "> sending {} bytes, CMD 0x{:02x}"),
+    LORA_RECEIVED: (TRACE, "< received {} bytes, CMD 0x{:02x}"),
+    LORA_NO_DOWNLINK: (TRACE, "< no downlink"),
+    LORA_UPLINK_FAILED: (ERROR, "LORA uplink failed"),
+    LORA_STATS: (TRACE, "rssi = {} , sftx = {} , tx_trials = {} , tx_time_on_air = {} , tx_counter = {}"),
+    LORA_TX_FAILED: (WARN, "Lora TX FAILED"),
+    LORA_ACK: (TRACE, "< ack up to # {} , {} missing , {} events removed"),
+    TAGFILTER_COALESCED: (TRACE, "{} detections coalesced into the event, {} suppressed in total"),
+}
+
+# returns the text of a message, as logged by Logger.log
+def render(code, values):
+    message = MESSAGES.get(code)
+    if message == None:
+        return "message " + str(code) + " " + " ".join([str(value) for value in values])
+    text = message[1]
+    if len(message) > 2:
+        values = message[2](values)
+    elif "x}" in text:
+        # hex fields show the values as unsigned
+        values = [value & 0xFFFFFFFF for value in values]
+    try:
+        return text.format(*values)
+    except Exception:
+        return text + " " + " ".join([str(value) for value in values])
@@ -1,12 +1,45 @@
 import config
 import pycom
+import struct
+import time
 import _thread
+from logcodes import ERROR, WARN, TRACE, DEBUG, LEVEL_NAMES, MESSAGES
+from logcodes import RECORD_FORMAT, RECORD_LEN, RECORD_VALUES, RECORD_VALUES_OFFSET
+from logcodes import DUMP_MAGIC, DUMP_FORMAT, DUMP_VERSION
+import logcodes
 
+# Messages are filtered by the level of their topic (config.LOG_LEVELS,
+# else config.LOG_LEVEL) before anything is formatted. Text is printed
+# only with config.LOG_PRINT, while the messages logged with event()
+# are also kept in a binary ring in RAM, which dump() writes to a file
+# for tools/logdecode.py to render as text.
 class Logger:
-    def __init__(self):
+    def __init__(self, size = None):
+        if size == None:
+            size = config.LOG_RING_SIZE
         self.lock = _thread.allocate_lock()
+        self.level = config.LOG_LEVEL
+        self.levels = dict(config.LOG_LEVELS)     # level by topic
+        self.printing = config.LOG_PRINT
+        self.topics = []                            # topic names, by topic id
+        self.topicIds = {}
+        self.size = size
+        self.ring = bytearray(size * RECORD_LEN)
+        self.head = 0                               # record written next
+        self.count = 0                              # records in the ring
         self.log("Logger started")
 
+    # sets the level of a topic, or of all topics without level
+    def setLevel(self, level, topic = None):
+        if topic == None:
+            self.level = level
+        else:
+            self.levels[topic] = level
+
+    # is a message of level logged for the topic?
+    def isEnabled(self, topic, level):
+        return level <= self.levels.get(topic, self.level)
+
     # display starting/booting condition
     def _append(self, level, topic, *text):
         with self.lock:
@@ -14,8 +47,69 @@ class Logger:
 
     # log text
     def log(self, topic, *text):
-        self._append("TRACE", topic, *text)
+        if self.printing and self.isEnabled(topic, TRACE):
+            self._append("TRACE", topic, *text)
 
     # log an error
     def error(self, topic, *text):
-        self._append("ERROR", topic, *text)
+        if self.printing and self.isEnabled(topic, ERROR):
+            self._append("ERROR", topic, *text)
+
+    # log details, e.g. payload dumps
+    def debug(self, topic, *text):
+        if self.printing and self.isEnabled(topic, DEBUG):
+            self._append("DEBUG", topic, *text)
+
+    # called with lock held
+    def _topicId(self, topic):
+        topicId = self.topicIds.get(topic)
+        if topicId == None:
+            topicId = len(self.topics) & 0xFF
+            self.topics.append(topic)
+            self.topicIds[topic] = topicId
+        return topicId
+
+    # logs message code of logcodes with up to RECORD_VALUES int values,
+    # recording it in the ring without formatting; values are stored as
+    # 32 bits, rendered signed unless the message shows them as hex
+    def event(self, topic, code, *values):
+        level = MESSAGES[code][0]
+        if level > self.levels.get(topic, self.level):
+            return
+        n = min(len(values), RECORD_VALUES)
+        with self.lock:
+            offset = self.head * RECORD_LEN
+            ring = self.ring
+            struct.pack_into("<IBBBB", ring, offset, time.ticks_ms() & 0xFFFFFFFF, self._topicId(topic), code, level, n)
+            for i in range(RECORD_VALUES):
+                struct.pack_into("<I", ring, offset + RECORD_VALUES_OFFSET + 4 * i, values[i] & 0xFFFFFFFF if i < n else 0)
+            self.head = (self.head + 1) % self.size
+            if self.count < self.size:
+                self.count = self.count + 1
+            if self.printing:
+                print(LEVEL_NAMES[level] + " [" + topic + "]", logcodes.render(code, values[:n]))
+
+    # returns the records of the ring, oldest first, as
+    # (ticks_ms, topic, code, level, values)
+    def records(self):
+        records = []
+        with self.lock:
+            start = (self.head - self.count) % self.size
+            for i in range(self.count):
+                record = struct.unpack_from(RECORD_FORMAT, self.ring, ((start + i) % self.size) * RECORD_LEN)
+                records.append((record[0], self.topics[record[1]], record[2], record[3], record[5:5 + record[4]]))
+        return records
+
+    # writes the ring to a file, e.g. before a reset
+    def dump(self, path):
+        try:
+            with self.lock:
+                names = "\n".join(self.topics).encode()
+                with open(path, "wb") as f:
+                    f.write(struct.pack(DUMP_FORMAT, DUMP_MAGIC, DUMP_VERSION, RECORD_LEN, self.size, self.head, self.count, len(names)))
+                    f.write(names)
+                    f.write(self.ring)
+            return True
+        except Exception as e:
+            print("> dump: ", "failed:", e.args[0], e)
+        return False
@@ -12,10 +12,76 @@ import utime
 import machine
 import os
 import config
+import logcodes
 import eventlog
+import varint
 import gc
 from eventlog import EventLog
 
+# uplink command of several tag events packed into one payload
+CMD_TAG_BATCH = 0x06
+
+# downlink acknowledging events, see decodeAck
+CMD_ACK = 0x10
+
+# event log commands sent by makePayload, events of other commands are skipped
+UPLINK_COMMANDS = (eventlog.CMD_TAG_DETECTED, eventlog.CMD_TIME_REQUEST2, eventlog.CMD_TIME_CHANGED)
+
+# max application payload per spreading factor (EU868)
+MAX_PAYLOAD_BY_SF = {7: 222, 8: 222, 9: 115, 10: 51, 11: 51, 12: 51}
+MIN_PAYLOAD_SIZE = 51
+
+# decodes an acknowledgement downlink:
+# <0x10> <Ack ID 0..1> <NACK bitmap 0..n>
+# all events up to and including Ack ID were received; bit i of the bitmap
+# (bit i % 8 of byte i // 8) is set if event Ack ID + 1 + i is missing,
+# the events up to the last bit set were received otherwise
+# returns the Ack ID and the IDs of the missing events, or None
+def decodeAck(data):
+    if len(data) < 3 or data[0] != CMD_ACK:
+        return None
+    ackId = data[1] | (data[2] << 8)
+    missing = []
+    for i in range((len(data) - 3) * 8):
+        if data[3 + i // 8] & (1 << (i % 8)):
+            missing.append((ackId + 1 + i) % (config.EVENT_LOG_MAX_EVENT_ID + 1))
+    return ackId, missing
+
+# completion of an uplink, set by the LoRa callback once the uplink and its
+# receive windows are done
+class PendingUplink:
+    def __init__(self):
+        self.done = False
+        self.failed = False
+        self.response = None            # downlink received, if any
+        self.signal = _thread.allocate_lock()
+        self.signal.acquire()
+        self.lock = _thread.allocate_lock()
+
+    # completes the uplink once; later calls, e.g. by the LoRa callback after
+    # wait() timed out, are ignored
+    def complete(self, failed = False):
+        with self.lock:
+            if self.done:
+                return
+            self.failed = failed
+            self.done = True
+        self.signal.release()
+
+    # blocks until the uplink is done or timeout seconds passed, returns
+    # the downlink (b'' if there was none) or False if the uplink failed
+    def wait(self, timeout):
+        if self.signal.acquire(1, timeout):
+            # let other waiters pass
+            self.signal.release()
+        else:
+            self.complete(True)
+        if self.failed:
+            return False
+        if self.response == None:
+            return b''
+        return self.response
+
 class LoraController:
     def __init__(self, options, logger, eventLog, ledController):
         self.options = options
@@ -34,11 +100,22 @@ class LoraController:
         self.noDownlinkCounter = 0
         self.lastUplinkTime = 0
         self.isAcking = False
+        self.lastSendFailed = False     # did the last uplink of events fail
+        self.lastTxCounter = 0          # tx_counter of the stats when airtimeUsed was called last
+        self.socket = None              # LoRa socket, reused for all uplinks
+        self.pendingUplink = None       # PendingUplink of the uplink in progress
+        self.unsavedUplinks = 0         # uplinks since the last nvram_save
+        self.ack = None                 # (Ack ID, missing IDs) of the last ack downlink, see takeAck
+        self.lastNvramSave = time.time()
 
     # logging
     def log(self, *text):
         self.logger.log("LORA", *text)
 
+    # logs a message of logcodes
+    def event(self, code, *values):
+        self.logger.event("LORA", code, *values)
+
     # start lora connectivity
     def start(self):
         # setup lorawan
@@ -63,8 +140,21 @@ class LoraController:
 
     def lora_callback(self, lora):
         events = lora.events()
+        uplink = self.pendingUplink
+        if events & LoRa.RX_PACKET_EVENT:
+            try:
+                data = self.socket.recv(64)
+                if uplink != None:
+                    uplink.response = data
+            except Exception as e:
+                self.log("ERROR", "Unable to receive LORA downlink", e)
         if events & LoRa.TX_FAILED_EVENT:
-            self.log('Lora TX FAILED')
+            self.event(logcodes.LORA_TX_FAILED)
+            if uplink != None:
+                uplink.complete(True)
+        elif events & LoRa.TX_PACKET_EVENT:
+            if uplink != None:
+                uplink.complete()
 
     # determines the LORA MAC address (string)
     def getDeviceEUI(self):
@@ -104,41 +194,85 @@ class LoraController:
     def stats(self):
         return self.lora.stats()
 
+    # time on air (ms) of the uplinks sent since the last call
+    def airtimeUsed(self):
+        stats = self.lora.stats()
+        frames = stats.tx_counter - self.lastTxCounter
+        self.lastTxCounter = stats.tx_counter
+        if frames <= 0:
+            # no uplink, or the counter was reset by a join
+            return 0
+        # tx_time_on_air is the time on air of the last frame, sent tx_trials times
+        return frames * stats.tx_time_on_air * max(1, stats.tx_trials)
+
+    # max payload size of the next uplink, from the data rate of the last one
+    def maxPayloadSize(self):
+        if self.lastSendFailed:
+            # the data rate may have dropped since
+            return MIN_PAYLOAD_SIZE
+        try:
+            return MAX_PAYLOAD_BY_SF.get(self.lora.stats().sftx, MIN_PAYLOAD_SIZE)
+        except Exception as e:
+            return MIN_PAYLOAD_SIZE
+
+    # returns the UID of a tag event without trailing 0x00 (at least 4 bytes)
+    def trimUid(self, data):
+        return eventlog.trimUid(data)
+
+    # logs a tag event with the UID as sent (up to 10 bytes), see logcodes.LORA_TAG_UID;
+    # never raises, so that logging cannot keep a payload from being sent
+    def logTag(self, event, uid):
+        try:
+            uid = bytes(uid[0:10])
+            words = uid + bytes(12 - len(uid))
+            self.event(logcodes.LORA_TAG_UID, event.id, event.time, len(uid),
+                int.from_bytes(words[0:4], 'big'), int.from_bytes(words[4:8], 'big'), int.from_bytes(words[8:12], 'big'))
+        except Exception as e:
+            self.log("ERROR: Unable to log tag event:", e.args[0], e)
+
+    # event: an eventlog.Event, or a dict with the same keys for time requests
     def makePayload(self, event):
         payload = None
         command = event['Command']
-        idbytes = event['ID'].to_bytes(2, 'little')
-        event_ts = event['Time']
         try:
+            if isinstance(event, eventlog.WireEvent):
+                # stored as the uplink payload, see eventlog.ENGINE_WIRE
+                if command == eventlog.CMD_TAG_DETECTED or command == eventlog.CMD_TIME_CHANGED:
+                    payload = event.block
+                    if command == eventlog.CMD_TAG_DETECTED:
+                        self.logTag(event, event.data)
+                    return payload
+
             if command == eventlog.CMD_TAG_DETECTED:
                 # Tag with 4-Byte UID detected
                 # <0x01> <Event ID 0..1> <Timestamp 0..3> <UID 0..3/6/9> 
-                timeBytes = event_ts.to_bytes(4, 'little')
-                uid = event['Data'][0:10]
+                # or, if detections of the tag were suppressed before (see TagFilter)
+                # <0x07> <Event ID 0..1> <Timestamp 0..3> <Suppressed 0> <UID 0..3/6/9>
+                # ID and timestamp are copied from the raw event block
+                block = event.block
+                uid = self.trimUid(event.data)
+                hits = event.hits
 
-                # remove trailing 0x00
-                uid_size = 10
-                for i in range(uid_size-1, 3, -1):
-                    if uid[i] != 0x00:
-                        break
-                    uid_size = uid_size - 1
-                uid = uid[:uid_size]
-
-                payload = bytes([0x01]) + idbytes + timeBytes + uid
-                uidText = ubinascii.hexlify(uid).decode()
-                self.log("CMD 0x01 [NFC_DETECTED] SEQ#", event['ID'], ". uid =", uidText, ", ts =", event_ts)   
+                if hits > 0:
+                    payload = bytes([eventlog.UPLINK_TAG_REPEATED]) + block[0:2] + block[3:7] + bytes([hits]) + uid
+                else:
+                    payload = bytes([eventlog.UPLINK_TAG_DETECTED]) + block[0:2] + block[3:7] + uid
+                self.logTag(event, uid)
 
             if command == eventlog.CMD_TIME_REQUEST2:
                 # ask backend for current time (new)
                 # <0x04> <ID 0..1> <Our Time 0..3>
+                idbytes = event['ID'].to_bytes(2, 'little')
                 mytime = time.time().to_bytes(4, 'little')
                 payload = bytes([command]) + idbytes + mytime
                 self.log("CMD 0x04 [TIME_REQUEST] ID#", event['ID'], ". our_time =", time.time(), utime.gmtime(time.time()) )
 
             if command == eventlog.CMD_TIME_CHANGED:
                 # <0x05> <Event ID 0..1> <Our Time 0..3> <Old Time 0..3>
+                event_ts = event['Time']
+                idbytes = event['ID'].to_bytes(2, 'little')
                 mytime = event_ts.to_bytes(4, 'little')
-                oldTime = event['Data'][0:4]
+                oldTime = bytes(event['Data'][0:4])
                 payload = bytes([eventlog.CMD_TIME_CHANGED]) + idbytes + mytime + oldTime
                 self.log("CMD 0x05 [TIME_CHANGED] SEQ#", event['ID'], ". our_time =", event_ts, utime.gmtime(event_ts), ", old_time =", oldTime)
 
@@ -146,22 +280,75 @@ class LoraController:
             self.log("ERROR: Unable to prepare LORA payload:", e.args[0], e)
         return payload
 
+    # packs consecutive tag events into one payload of at most maxSize bytes,
+    # returns the payload and the number of events in it
+    def makeBatchPayload(self, events, maxSize):
+        # <0x06> <Event ID 0..1> <Timestamp 0..3> followed by one entry per event:
+        # <ID delta << 4 | UID size> <Time delta (varint)> <UID 0..3/6/9>
+        # the deltas are relative to the previous entry (0 for the first)
+        # the header is copied from the raw block of the first event
+        # tag events with suppressed detections are sent on their own (0x07)
+        first = events[0]
+        payload = bytearray([CMD_TAG_BATCH])
+        payload.extend(first.idBytes)
+        payload.extend(first.block[3:7])
+        previousId = first.id
+        previousTime = first.time
+        count = 0
+        for event in events:
+            if event.command != eventlog.CMD_TAG_DETECTED or event.hits > 0:
+                break
+            eventId = event.id
+            eventTime = event.time
+            idDelta = (eventId - previousId) % (config.EVENT_LOG_MAX_EVENT_ID + 1)
+            timeDelta = eventTime - previousTime
+            if idDelta > 0x0F or timeDelta < 0:
+                break
+            uid = self.trimUid(event.data)
+            timeBytes = varint.encode(timeDelta)
+            if len(payload) + 1 + len(timeBytes) + len(uid) > maxSize:
+                break
+            payload.append((idDelta << 4) | len(uid))
+            payload.extend(timeBytes)
+            payload.extend(uid)
+            previousId = eventId
+            previousTime = eventTime
+            count = count + 1
+        self.event(logcodes.LORA_BATCH, first.id, previousId, count, len(payload))
+        return bytes(payload), count
+
     # attempts to send the given event
     def sendEvent(self, event):
+        return self.sendEvents([event]) > 0
+
+    # attempts to send the given events in one uplink, packing as many of
+    # them as fit; returns the number of events sent (0 on failure)
+    def sendEvents(self, events):
         with self.sendLock:
-            eventId = event['ID']
-            command = event['Command']
-            self.log("Preparing to send CMD =", command, ", SEQ_NO =", eventId)
-            if self.lastEventId > 0 and eventId > self.lastEventId + 1:
+            eventId = events[0].id
+            command = events[0].command
+            self.event(logcodes.LORA_PREPARING, command, eventId, len(events))
+            if self.lastEventId > 0 and eventId > self.lastEventId + 1 and not config.LORA_ACK_MODE:
                 self.log("ERROR", "Event IDs are not in sequence - last:", self.lastEventId, ", current:", eventId)
-            self.lastEventId = eventId
             # prepare lora payload for supported event log entries
-            payload = self.makePayload(event)
-            if payload == None:
+            count = 0
+            if len(events) > 1 and command == eventlog.CMD_TAG_DETECTED:
+                payload, count = self.makeBatchPayload(events, self.maxPayloadSize())
+            if count < 2:
+                payload = self.makePayload(events[0])
+                count = 1
+            self.lastEventId = events[count - 1].id
+        if payload == None:
+            if command not in UPLINK_COMMANDS:
                 self.log("WARN: Event payload is None and therefore ignored for lora transmission")
-                return True
-            # send payload
-            return self.sendAndHandleResponse(payload)
+                return count
+            # not sent, tried again by the event sender
+            return 0
+        # send payload
+        self.lastSendFailed = not self.sendAndHandleResponse(payload)
+        if self.lastSendFailed:
+            return 0
+        return count
 
 
     # sends the payload and handles the optional response
@@ -179,6 +366,8 @@ class LoraController:
         # handle response
         if responseData != None and len(responseData) > 0:
             try:
+                if responseData[0] == CMD_ACK:
+                    self.handleAck(responseData)
                 return True
             except Exception as e:
                 self.log("ERROR: Unable to handle LORA payload: ", e.args[0], e)
@@ -188,55 +377,100 @@ class LoraController:
         # the message has been sent
         return True
 
+    # removes the acknowledged events from the event log with one header
+    # update, and keeps the missing ones for the event sender (see takeAck)
+    def handleAck(self, data):
+        ack = decodeAck(data)
+        if ack == None:
+            self.log("ERROR", "Invalid ack downlink of", len(data), "bytes")
+            return
+        removed = self.eventLog.ackUpTo(ack[0])
+        self.event(logcodes.LORA_ACK, ack[0], len(ack[1]), removed)
+        self.ack = ack
+
+    # returns (Ack ID, missing IDs) of the ack received since the last call, or None
+    def takeAck(self):
+        ack = self.ack
+        self.ack = None
+        return ack
+
     def sendTimeRequest(self, clockSyncEvent, clockSyncRequests):
         clockSyncEvent['Command'] = eventlog.CMD_TIME_REQUEST2
         payload = self.makePayload(clockSyncEvent)
         try:
-            with self.sendLock:
-                # send lora uplink
-                responseData = self.sendPayload(payload, False)
-                if responseData == False:
-                    return None
+            # send lora uplink
+            responseData = self.sendPayload(payload, False)
+            if responseData == False:
+                return None
 
         except Exception as e:
             self.log("ERROR", "Unable to sync clock via LORA:", e.args[0], e)
         return None
 
 
-    # send the specified payload
+    # returns the LoRa socket, created on first use
+    def getSocket(self):
+        if self.socket == None:
+            self.socket = socket.socket(socket.AF_LORA, socket.SOCK_RAW)
+            self.socket.setblocking(False)
+        return self.socket
+
+    # starts sending the payload and returns its PendingUplink; waits for
+    # the previous uplink first, as the radio sends one at a time
+    def sendPayloadAsync(self, data):
+        with self.socketLock:
+            if self.pendingUplink != None and not self.pendingUplink.done:
+                self.pendingUplink.wait(config.LORA_UPLINK_TIMEOUT)
+            uplink = PendingUplink()
+            self.pendingUplink = uplink
+            self.event(logcodes.LORA_SENDING, len(data), data[0] if len(data) > 0 else 0)
+            if self.logger.isEnabled("LORA", logcodes.DEBUG):
+                self.logger.debug("LORA", ">", binascii.hexlify(data))
+            try:
+                self.getSocket().send(data)
+            except Exception as e:
+                self.log("ERROR", "LORA Socket Exception", e)
+                if self.socket != None:
+                    self.socket.close()
+                    self.socket = None
+                uplink.complete(True)
+            self.unsavedUplinks = self.unsavedUplinks + 1
+            return uplink
+
+    # saves the LoRaWAN state (frame counters) every LORA_NVRAM_SAVE_EVERY
+    # uplinks or LORA_NVRAM_SAVE_INTERVAL seconds, or with force (e.g. by
+    # the crash handler of main.py); a watchdog reset loses the counters
+    # of the uplinks since the last save
+    def saveNvram(self, force = False):
+        if self.unsavedUplinks == 0:
+            return
+        if force or self.unsavedUplinks >= config.LORA_NVRAM_SAVE_EVERY or time.time() - self.lastNvramSave >= config.LORA_NVRAM_SAVE_INTERVAL:
+            self.lora.nvram_save()
+            self.unsavedUplinks = 0
+            self.lastNvramSave = time.time()
+
+    # send the specified payload and wait for the end of its receive windows,
+    # returns the downlink (b'' if none) or False on failure
     def sendPayload(self, data, updateTime = True):
         try:
-            with self.socketLock:
-                self.log("> sending", len(data), "bytes:", binascii.hexlify(data))
-                responseData = None
-                # create a LoRa socket
-                s = socket.socket(socket.AF_LORA, socket.SOCK_RAW)
-                s.setblocking(False)
-                try:
-                    """free_memory = gc.mem_free()
-                    allocated_memory = gc.mem_alloc()
-                    print("Free Memory: " + str(free_memory) + " -- Allocated Memory : " + str(allocated_memory))"""
-                    s.send(data)
-                    time.sleep(5)
-                    responseData = s.recv(64)
-                except Exception as e:
-                    self.log("ERROR", "LORA Socket Exception", e)
-                s.close()
-                if responseData != None:
-                    responseLen = len(responseData)
-                    if responseLen > 0:
-                        self.log("< received", responseLen, "bytes:", binascii.hexlify(responseData))
-                    else:
-                        self.log("< no downlink")
-                # log
-                if updateTime == True:
-                    self.lastUplinkTime = time.time()
-                self.log(self.stats())
-                time.sleep_ms(10)
-                # save frame counters
-                self.lora.nvram_save()
-                time.sleep_ms(5)
-                return responseData
+            responseData = self.sendPayloadAsync(data).wait(config.LORA_UPLINK_TIMEOUT)
+            if responseData == False:
+                self.event(logcodes.LORA_UPLINK_FAILED)
+            elif len(responseData) > 0:
+                self.event(logcodes.LORA_RECEIVED, len(responseData), responseData[0])
+                if self.logger.isEnabled("LORA", logcodes.DEBUG):
+                    self.logger.debug("LORA", "<", binascii.hexlify(responseData))
+            else:
+                self.event(logcodes.LORA_NO_DOWNLINK)
+            # log
+            if updateTime == True:
+                self.lastUplinkTime = time.time()
+            if self.logger.isEnabled("LORA", logcodes.TRACE):
+                stats = self.stats()
+                self.event(logcodes.LORA_STATS, stats.rssi, stats.sftx, stats.tx_trials, stats.tx_time_on_air, stats.tx_counter)
+            # save frame counters
+            self.saveNvram()
+            return responseData
         except Exception as e:
             self.log("ERROR", "Unable to send payload", e.args[0], e)
         return False
@@ -22,6 +22,8 @@ from clockController import ClockController
 from eventsender import EventSender
 import eventlog
 from eventlog import EventLog
+from eventqueue import EventQueue
+from tagfilter import TagFilter
 
 from fileringbufferconstants import (
   _HEADER_LEN, _ITEM_SIZE_FORMAT, _ITEM_SIZE_LEN, _POS_VALUE_FORMAT,
@@ -65,7 +67,31 @@ options = {
 }
 
 # init event log
-eventLog = EventLog(logger, config.EVENT_LOG_PATH)
+if config.EVENT_LOG_ENGINE == eventlog.ENGINE_SLOTS:
+    eventLog = EventLog(logger, config.EVENT_LOG_SLOT_PATH, eventlog.ENGINE_SLOTS, config.EVENT_LOG_PATH)
+elif config.EVENT_LOG_ENGINE == eventlog.ENGINE_WIRE:
+    eventLog = EventLog(logger, config.EVENT_LOG_WIRE_PATH, eventlog.ENGINE_WIRE, config.EVENT_LOG_PATH)
+elif config.EVENT_LOG_ENGINE == eventlog.ENGINE_COMPACT:
+    eventLog = EventLog(logger, config.EVENT_LOG_COMPACT_PATH, eventlog.ENGINE_COMPACT, config.EVENT_LOG_PATH)
+else:
+    eventLog = EventLog(logger, config.EVENT_LOG_PATH)
+
+# events of interrupt handlers and the RFID scanner are staged in RAM
+# and written by the event queue thread
+eventQueue = EventQueue(logger, eventLog)
+# tags staying in the field are reported once per config.TAG_DEDUP_WINDOW,
+# if set (every detection is reported by default)
+tagFilter = TagFilter(logger, eventQueue)
+
+# backpressure: warn by LED and pause scanning before unsent events get overwritten
+def onBufferWarnLevel(above, level):
+    log("Event buffer level", level, "%")
+    if above:
+        led.warn()
+    else:
+        led.off()
+eventLog.addLevelCallback(config.RFID_WARN_LED_BUFFER_LEVEL, onBufferWarnLevel)
+eventLog.addLevelCallback(config.RFID_PAUSE_SCANNING_BUFFER_LEVEL, lambda above, level: eventQueue.pauseScanning(above))
 
 #init lora controller
 lora = LoraController(options, logger, eventLog, led)
@@ -109,7 +135,7 @@ def onNetworkTimeRequest(clockEvent):
     return returnVal
 
 # setup time synchronization controller
-clockService = ClockController(options, logger, eventLog, eventSender, eventLog, led, onNetworkTimeRequest)
+clockService = ClockController(options, logger, eventQueue, eventSender, eventLog, led, onNetworkTimeRequest)
 
 
 test_uid = 1
@@ -124,17 +150,18 @@ def timeSync(alarm):
     Timer.Alarm(timeSync, options['clock_sync_interval'], periodic=False)
 Timer.Alarm(timeSync, options['clock_sync_interval'], periodic=False)
 
-#adding 10 events
+#adding 30 events
 def interruptAddEvents():
     print("interruptAddEvents started")
     global test_uid   
+    if eventQueue.isScanningPaused():
+        print("> interruptAddEvents skipped, event queue level", eventQueue.level(), "%")
+        return
     for x in range(0, 30):
-        print("interruptAddEvents for " + str(x))
-        uuid_pass = test_uid.to_bytes(4, 'little')
+        tagFilter.addEvent(eventlog.CMD_TAG_DETECTED, test_uid.to_bytes(4, 'little'))
         test_uid += 1
-        eventLog.addEvent(eventlog.CMD_TAG_DETECTED, uuid_pass)
-        if (config.WDT_MAIN_TIMEOUT > 0):
-            wdt.feed()
+    if (config.WDT_MAIN_TIMEOUT > 0):
+        wdt.feed()
 
 def corePanicTest(alarm):
     print("Timer.Alarm(): corePanicTest started")
@@ -144,33 +171,49 @@ def corePanicTest(alarm):
 Timer.Alarm(corePanicTest, options['test_event_interval'], periodic=False)
 
 
-# start event sender
+# start event writer and sender
+eventQueue.start()
 eventSender.start()
 interruptAddEvents()
 #Main Loop
-while True:
+try:
+    while True:
 
-    # watchdog feed
-    if (config.WDT_MAIN_TIMEOUT > 0):
-        wdt.feed()
+        # watchdog feed
+        if (config.WDT_MAIN_TIMEOUT > 0):
+            wdt.feed()
     
-    # collect memory
-    gc.collect()
+        # collect memory
+        gc.collect()
+
+        # commit event log positions once due
+        eventLog.sync(False)
     
-    # sleep
-    time.sleep(config.RFID_SCAN_INTERVAL)
+        # sleep
+        time.sleep(config.RFID_SCAN_INTERVAL)
     
-    # Interrupt Based Code Execution via Flag for Adding Events
-    # --> Here you need to wrap your head --> once in mail loop time sync is executed
-    # even is triggered by alarm - main threat is still in clock sync
-    """if is_interrupt_add_events_triggerd:
-        is_interrupt_add_events_triggerd = False
-        interruptAddEvents()"""
+        # Interrupt Based Code Execution via Flag for Adding Events
+        # --> Here you need to wrap your head --> once in mail loop time sync is executed
+        # even is triggered by alarm - main threat is still in clock sync
+        """if is_interrupt_add_events_triggerd:
+            is_interrupt_add_events_triggerd = False
+            interruptAddEvents()"""
     
-    # Interrupt Based Code Execution via Flag for Time Synchronization
-    if is_interrupt_time_sync_triggered:
-        is_interrupt_time_sync_triggered = False
-        if clockService.isAlreadyRunning == False:
-            clockService.acquireNetworkTimeThread(wdt)
-        else:
-            print("> clockService.acquireNetworkTimeThread would be started, but is already running")
+        # Interrupt Based Code Execution via Flag for Time Synchronization
+        if is_interrupt_time_sync_triggered:
+            is_interrupt_time_sync_triggered = False
+            if clockService.isAlreadyRunning == False:
+                clockService.acquireNetworkTimeThread(wdt)
+            else:
+                print("> clockService.acquireNetworkTimeThread would be started, but is already running")
+except Exception as e:
+    # keep the log of what led to the crash, see tools/logdecode.py
+    logger.error("Main", "Main loop failed:", e.args[0], e)
+    # the frame counters of the uplinks since the last save would be
+    # lost otherwise, and the network server rejects reused ones
+    try:
+        lora.saveNvram(True)
+    except Exception as e2:
+        logger.error("Main", "Unable to save LORA nvram:", e2.args[0], e2)
+    logger.dump(config.LOG_DUMP_PATH)
+    raise
@@ -0,0 +1,124 @@
+"""
+ Copyright © 2019 TimeTool AG. All rights reserved.
+"""
+import config
+import time
+import _thread
+import logcodes
+import eventlog
+
+UID_SIZE = 10                   # max UID bytes, see LoraController.trimUid
+WAYS = 4                        # entries a UID can be stored in
+
+# suppresses repeated detections of a tag that stays in the field: a tag
+# is reported again only TAG_DEDUP_WINDOW seconds after its last event,
+# and the detections suppressed meanwhile are counted in the data byte
+# after the UID of its next event (eventlog.TAG_HITS_OFFSET, saturating
+# at 255), which is sent with the uplink (0x07, see
+# LoraController.makePayload), so that the dwell time can still be seen
+#
+# Stands in front of anything with addEvent (the EventQueue or the
+# EventLog). Tags are tracked in a fixed number of entries, WAYS per hash
+# value, replacing the tag seen least recently; lookups take constant
+# time and do not allocate, like EventQueue.addEvent.
+class TagFilter:
+    def __init__(self, logger, target, size = None, window = None):
+        if size == None:
+            size = config.TAG_DEDUP_SLOTS
+        if window == None:
+            window = config.TAG_DEDUP_WINDOW
+        self.logger = logger
+        self.target = target
+        self.sets = max(1, size // WAYS)
+        self.size = self.sets * WAYS
+        self.windowMs = int(window * 1000)
+        self.uids = bytearray(self.size * UID_SIZE)
+        self.uidLens = bytearray(self.size)     # 0 if the entry is unused
+        self.reported = [0] * self.size         # ticks_ms of the last event of the tag
+        self.seen = [0] * self.size             # ticks_ms of the last detection of the tag
+        self.hits = [0] * self.size             # detections suppressed since the last event
+        self.data = bytearray(UID_SIZE + 1)     # data of the event added, see addEvent
+        self.lock = _thread.allocate_lock()
+        self.suppressed = 0                     # detections suppressed in total
+
+    # logs a message of logcodes
+    def event(self, code, *values):
+        self.logger.event("TagFilter", code, *values)
+
+    # hash of the UID in data
+    def _hash(self, data, n):
+        h = n
+        for i in range(n):
+            h = (h * 31 + data[i]) & 0xFFFF
+        return h
+
+    # returns the entry holding the UID in data, or -1
+    def _find(self, first, data, n):
+        uids = self.uids
+        for entry in range(first, first + WAYS):
+            if self.uidLens[entry] == n:
+                offset = entry * UID_SIZE
+                i = 0
+                while i < n and uids[offset + i] == data[i]:
+                    i = i + 1
+                if i == n:
+                    return entry
+        return -1
+
+    # returns the entry of the set to store a new UID in: an unused one,
+    # else the one seen least recently
+    def _victim(self, first, now):
+        victim = first
+        for entry in range(first, first + WAYS):
+            if self.uidLens[entry] == 0:
+                return entry
+            if time.ticks_diff(now, self.seen[entry]) > time.ticks_diff(now, self.seen[victim]):
+                victim = entry
+        return victim
+
+    # adds the event unless it is a repeated detection of a tag within the
+    # window; returns False if the target dropped it
+    def addEvent(self, cmd, data = None):
+        if cmd != eventlog.CMD_TAG_DETECTED or data == None or self.windowMs <= 0:
+            return self.target.addEvent(cmd, data)
+        n = min(len(data), UID_SIZE)
+        now = time.ticks_ms()
+        with self.lock:
+            first = (self._hash(data, n) % self.sets) * WAYS
+            entry = self._find(first, data, n)
+            hits = 0
+            if entry >= 0:
+                self.seen[entry] = now
+                if time.ticks_diff(now, self.reported[entry]) < self.windowMs:
+                    self.hits[entry] = self.hits[entry] + 1
+                    self.suppressed = self.suppressed + 1
+                    return True
+                hits = self.hits[entry]
+            else:
+                entry = self._victim(first, now)
+                offset = entry * UID_SIZE
+                for i in range(n):
+                    self.uids[offset + i] = data[i]
+                self.uidLens[entry] = n
+                self.seen[entry] = now
+            self.reported[entry] = now
+            self.hits[entry] = 0
+            out = self.data
+            for i in range(UID_SIZE):
+                out[i] = data[i] if i < n else 0
+            out[eventlog.TAG_HITS_OFFSET] = min(hits, 255)
+            added = self.target.addEvent(cmd, out)
+            if added == False:
+                # report the tag with its next detection
+                self.uidLens[entry] = 0
+        if hits > 0:
+            self.event(logcodes.TAGFILTER_COALESCED, hits, self.suppressed)
+        return added
+
+    # adds one event per payload, returns the number of events not dropped
+    def addEvents(self, cmd, payloads):
+        added = 0
+        for data in payloads:
+            if self.addEvent(cmd, data) != False:
+                added = added + 1
+        return added
@@ -0,0 +1,28 @@
+"""
+ Copyright © 2019 TimeTool AG. All rights reserved.
+"""
+
+# unsigned LEB128 encoding: 7 bits per byte, high bit set if more follow
+def encode(value):
+    data = bytearray()
+    while value > 0x7F:
+        data.append((value & 0x7F) | 0x80)
+        value = value >> 7
+    data.append(value)
+    return data
+
+# returns the varint at data[i] and the index following it, or (None, end)
+# if it does not end before end
+def decode(data, i, end):
+    value = 0
+    shift = 0
+    while i < end:
+        b = data[i]
+        i = i + 1
+        value = value | ((b & 0x7F) << shift)
+        if b < 0x80:
+            return value, i
+        shift = shift + 7
+        if shift > 28:
+            break
+    return None, end
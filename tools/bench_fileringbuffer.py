@@ -0,0 +1,116 @@
+"""
+ Host-side benchmark for FileRingBuffer file handle and header usage.
+
+ Runs the same put/peek/get workload with a handle opened per operation
+ (keep_open=False), with the persistent handle (keep_open=True), with
+ batched header commits, and with put_many/get_many bursts, and reports the number of open() calls, NVS
+ writes and ops/sec.
+
+ usage: python3 tools/bench_fileringbuffer.py [events] [rounds]
+"""
+import builtins
+import os
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from sim import ubinascii
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "source")
+
+# stand-ins for the pycom specific modules imported by fileringbuffer
+nvs = {}
+nvs_writes = [0]
+def nvs_set(key, value):
+    nvs_writes[0] += 1
+    nvs[key] = value
+pycom = types.ModuleType("pycom")
+pycom.nvs_get = nvs.get
+pycom.nvs_set = nvs_set
+sys.modules.setdefault("pycom", pycom)
+sys.modules.setdefault("ubinascii", ubinascii.make_module("ubinascii"))
+sys.modules["binascii"] = ubinascii.make_module("binascii")
+if not hasattr(time, "ticks_ms"):
+    time.ticks_ms = lambda: int(time.monotonic() * 1000)
+    time.ticks_diff = lambda a, b: a - b
+sys.path.insert(0, SOURCE_DIR)
+
+from fileringbuffer import FileRingBuffer
+
+BLOCKSIZE = 18
+ITEM = bytes(range(BLOCKSIZE))
+
+
+class OpenCounter:
+    """Counts calls to the builtin open() for paths below `root`."""
+
+    def __init__(self, root):
+        self.root = root
+        self.count = 0
+        self._open = builtins.open
+
+    def __enter__(self):
+        def counting_open(path, *args, **kwargs):
+            if str(path).startswith(self.root):
+                self.count += 1
+            return self._open(path, *args, **kwargs)
+        builtins.open = counting_open
+        return self
+
+    def __exit__(self, *args):
+        builtins.open = self._open
+        return False
+
+
+def run(keep_open, commit_every, batch, events, rounds):
+    nvs.clear()
+    root = tempfile.mkdtemp()
+    path = os.path.join(root, "events.bin")
+    with OpenCounter(root) as opens:
+        ring = FileRingBuffer(path, events * (BLOCKSIZE + 4), keep_open=keep_open, commit_every=commit_every)
+        init_opens = opens.count
+        nvs_writes[0] = 0
+        ops = 0
+        start = time.perf_counter()
+        for _ in range(rounds):
+            if batch > 1:
+                for _ in range(events // batch):
+                    ring.put_many([ITEM] * batch)
+                    ops += batch
+                while not ring.empty():
+                    ops += 2 * len(ring.get_many(batch, BLOCKSIZE))
+                continue
+            for _ in range(events):
+                ring.put(ITEM)
+                ops += 1
+            while not ring.empty():
+                ring.peek()
+                ring.get()
+                ops += 2
+        elapsed = time.perf_counter() - start
+        ring.close()
+    return {
+        "ops": ops,
+        "opens": opens.count - init_opens,
+        "nvs_writes": nvs_writes[0],
+        "ops_per_sec": ops / elapsed,
+    }
+
+
+def main():
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    baseline = None
+    for keep_open, commit_every, batch in ((False, 1, 1), (True, 1, 1), (True, 16, 1), (True, 16, 30)):
+        r = run(keep_open, commit_every, batch, events, rounds)
+        if baseline is None:
+            baseline = r
+        print("keep_open=%-5s commit_every=%-3d batch=%-3d ops=%-7d opens/op=%.3f nvs_writes/op=%.3f ops/sec=%-7.0f speedup=%.2fx" % (
+            keep_open, commit_every, batch, r["ops"], r["opens"] / r["ops"], r["nvs_writes"] / r["ops"],
+            r["ops_per_sec"], r["ops_per_sec"] / baseline["ops_per_sec"]))
+
+
+if __name__ == "__main__":
+    main()
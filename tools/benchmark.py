@@ -0,0 +1,345 @@
+"""
+ Benchmark suite for the event pipeline, run on the host against the
+ stand-in flash and NVS of tools/sim.
+
+ Drives EventLog.addEvent/addEvents/peekNextEvent/pullNextEvent/events,
+ reserveEvents/commitEvents, EventQueue.addEvent and FileRingBuffer
+ put/get/peek/iterate across buffer sizes, bursts, wraparound and
+ lapping, with use_nvs True and False and the ring buffer on a file or
+ a memory map (mapped=True), and reports per case ops/sec, p50/p99
+ latency of one call, and the file opens, seeks, writes and NVS writes
+ per op. Ops are events, so a burst of 30 events counts 30 ops.
+
+ The counters are deterministic and the cases keep their names, so the
+ results of two commits can be compared:
+
+    python3 tools/benchmark.py --json before.json
+    git checkout <other commit>
+    python3 tools/benchmark.py --compare before.json
+
+ --compare fails (exit code 1) if a counter per op grew or ops/sec
+ dropped by more than --threshold.
+
+ usage: python3 tools/benchmark.py [--sizes 1000,10000,100000] [--cases PATTERN]
+            [--json FILE] [--compare FILE] [--threshold 0.25]
+"""
+import argparse
+import builtins
+import contextlib
+import fnmatch
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sim import SOURCE_DIR, Simulation
+
+simulation = Simulation(speedup = 1, persist_nvs = False).install()
+
+import config
+import eventlog
+from eventlog import EventLog
+from eventqueue import EventQueue
+from fileringbuffer import FileRingBuffer
+from fileringbufferconstants import _ITEM_SIZE_LEN
+from logger import Logger
+
+BLOCK = bytes(range(config.EVENT_LOG_BLOCKSIZE))
+UID = b"\x04\xa2\x5b\x1a"
+BURST = 30
+COUNTERS = ("opens", "seeks", "writes", "nvs_writes")
+MAPPED = "mapped"                               # engine name of the ring buffer cases with mapped=True
+
+
+class CountingFile:
+    """File proxy counting seeks and writes into `stats`."""
+
+    def __init__(self, f, stats):
+        self._f = f
+        self._stats = stats
+
+    def seek(self, *args):
+        self._stats["seeks"] += 1
+        return self._f.seek(*args)
+
+    def write(self, data):
+        self._stats["writes"] += 1
+        return self._f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._f.close()
+        return False
+
+
+class FileCounter:
+    """Counts opens, seeks and writes of files below `root`."""
+
+    def __init__(self, root):
+        self.root = root
+        self.stats = dict.fromkeys(COUNTERS[:3], 0)
+        self._open = builtins.open
+
+    def __enter__(self):
+        def counting_open(path, *args, **kwargs):
+            f = self._open(path, *args, **kwargs)
+            if str(path).startswith(self.root):
+                self.stats["opens"] += 1
+                return CountingFile(f, self.stats)
+            return f
+        builtins.open = counting_open
+        return self
+
+    def __exit__(self, *args):
+        builtins.open = self._open
+        return False
+
+    def reset(self):
+        for key in self.stats:
+            self.stats[key] = 0
+
+
+class Case:
+    """Runs `setup` untimed, then `op` `calls` times, measuring every call.
+
+    setup(env) returns the state passed to op(state, i); each call of op
+    accounts for `events_per_call` ops.
+    """
+
+    def __init__(self, name, setup, op, calls, events_per_call = 1):
+        self.name = name
+        self.setup = setup
+        self.op = op
+        self.calls = calls
+        self.events_per_call = events_per_call
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def run_case(case, size, use_nvs, engine):
+    root = tempfile.mkdtemp(prefix = "bench")
+    simulation.nvs.values.clear()
+    FileRingBuffer.use_nvs = use_nvs
+    config.EVENT_LOG_MAX_EVENTS = size
+    env = {"root": root, "size": size, "engine": engine}
+    try:
+        with FileCounter(root) as files, open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            state = case.setup(env)
+            files.reset()
+            nvs_writes = simulation.nvs.writes
+            latencies = []
+            clock = time.perf_counter
+            start = clock()
+            for i in range(case.calls):
+                t = clock()
+                case.op(state, i)
+                latencies.append(clock() - t)
+            elapsed = clock() - start
+            stats = dict(files.stats)
+            stats["nvs_writes"] = simulation.nvs.writes - nvs_writes
+    finally:
+        shutil.rmtree(root, ignore_errors = True)
+    ops = case.calls * case.events_per_call
+    latencies.sort()
+    result = {
+        "ops": ops,
+        "ops_per_sec": ops / elapsed,
+        "p50_us": percentile(latencies, 0.50) * 1e6,
+        "p99_us": percentile(latencies, 0.99) * 1e6,
+    }
+    for key in COUNTERS:
+        result[key + "_per_op"] = stats[key] / float(ops)
+    return result
+
+
+# ring buffer cases
+
+def ring_buffer(env, fill = 0.0):
+    ring = FileRingBuffer(os.path.join(env["root"], "events.bin"),
+        env["size"] * (config.EVENT_LOG_BLOCKSIZE + _ITEM_SIZE_LEN),
+        commit_every = config.EVENT_LOG_COMMIT_EVERY, commit_interval_ms = config.EVENT_LOG_COMMIT_INTERVAL_MS,
+        mapped = env["engine"] == MAPPED)
+    for _ in range(int(env["size"] * fill)):
+        ring.put(BLOCK)
+    return ring
+
+def near_end_ring_buffer(env):
+    # write position a tenth of the buffer before its end, half full
+    ring = ring_buffer(env, 0.9)
+    for _ in range(int(env["size"] * 0.5)):
+        ring.get()
+    return ring
+
+def iterate_items(ring, i):
+    ring.iterate(lambda data, pos: True)
+
+def frb_cases(size):
+    half = size // 2
+    return [
+        Case("frb_put", ring_buffer, lambda ring, i: ring.put(BLOCK), half),
+        Case("frb_peek", lambda env: ring_buffer(env, 0.5), lambda ring, i: ring.peek(), half),
+        Case("frb_get", lambda env: ring_buffer(env, 0.5), lambda ring, i: ring.get(), half),
+        Case("frb_iterate", lambda env: ring_buffer(env, 0.5), iterate_items, 1, half),
+        Case("frb_wraparound", near_end_ring_buffer,
+            lambda ring, i: (ring.put(BLOCK), ring.peek(), ring.get()), size, 1),
+        Case("frb_lapping", lambda env: ring_buffer(env, 1.0), lambda ring, i: ring.put(BLOCK), size),
+        Case("frb_burst%d" % BURST, ring_buffer,
+            lambda ring, i: (ring.put_many([BLOCK] * BURST), ring.get_many(BURST, config.EVENT_LOG_BLOCKSIZE)),
+            max(1, half // BURST), BURST),
+    ]
+
+
+# event log cases
+
+def event_log(env, fill = 0.0):
+    path = os.path.join(env["root"], "events.bin")
+    log = EventLog(Logger(), path, env["engine"])
+    for _ in range(int(env["size"] * fill)):
+        log.addEvent(eventlog.CMD_TAG_DETECTED, UID)
+    return log
+
+def send_event(log, i):
+    # what EventSender does for every event
+    log.peekNextEvent()
+    log.pullNextEvent()
+
+def send_events(log, i):
+    # what EventSender does for every uplink of BURST events
+    events, token = log.reserveEvents(BURST)
+    log.commitEvents(token, len(events))
+
+def event_queue(env):
+    log = event_log(env)
+    return EventQueue(log.logger, log)
+
+def queue_event(queue, i):
+    # what interrupt handlers do, the writer thread flushes every BURST events
+    queue.addEvent(eventlog.CMD_TAG_DETECTED, UID)
+    if i % BURST == BURST - 1:
+        queue.flush()
+
+def burst_pipeline(log, i):
+    for _ in range(BURST):
+        log.addEvent(eventlog.CMD_TAG_DETECTED, UID)
+    while log.hasEvents():
+        send_event(log, i)
+
+def eventlog_cases(size):
+    half = size // 2
+    return [
+        Case("eventlog_add", event_log, lambda log, i: log.addEvent(eventlog.CMD_TAG_DETECTED, UID), half),
+        Case("eventlog_addEvents%d" % BURST, event_log,
+            lambda log, i: log.addEvents(eventlog.CMD_TAG_DETECTED, [UID] * BURST), max(1, half // BURST), BURST),
+        Case("eventlog_peek", lambda env: event_log(env, 0.5), lambda log, i: log.peekNextEvent(), half),
+        Case("eventlog_pull", lambda env: event_log(env, 0.5), lambda log, i: log.pullNextEvent(), half),
+        Case("eventqueue_add", event_queue, queue_event, half),
+        Case("eventlog_reserve%d" % BURST, lambda env: event_log(env, 0.5), send_events, max(1, half // BURST), BURST),
+        Case("eventlog_events", lambda env: event_log(env, 0.5), lambda log, i: sum(1 for e in log.events()), 1, half),
+        Case("eventlog_pipeline", event_log,
+            lambda log, i: (log.addEvent(eventlog.CMD_TAG_DETECTED, UID), send_event(log, i)), half),
+        Case("eventlog_burst%d" % BURST, event_log, burst_pipeline, max(1, half // BURST), BURST),
+        Case("eventlog_lapping", lambda env: event_log(env, 1.0),
+            lambda log, i: log.addEvent(eventlog.CMD_TAG_DETECTED, UID), half),
+    ]
+
+
+def cases(sizes, pattern):
+    for size in sizes:
+        for use_nvs in (True, False):
+            for engine in (None, MAPPED):
+                for case in frb_cases(size):
+                    yield case, size, use_nvs, engine
+            for engine in (eventlog.ENGINE_FILE, eventlog.ENGINE_SLOTS, eventlog.ENGINE_WIRE, eventlog.ENGINE_COMPACT):
+                for case in eventlog_cases(size):
+                    yield case, size, use_nvs, engine
+
+def case_key(case, size, use_nvs, engine):
+    key = "%s/%s/nvs=%d" % (case.name, size, use_nvs)
+    if engine != None:
+        key += "/" + engine
+    return key
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd = SOURCE_DIR,
+            stderr = subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Print the changes against `baseline` and return the number of regressions."""
+    regressions = 0
+    print()
+    print("compared to", baseline["meta"].get("revision"))
+    for key, result in results.items():
+        old = baseline["results"].get(key)
+        if old == None:
+            continue
+        notes = []
+        speed = result["ops_per_sec"] / old["ops_per_sec"] - 1
+        if speed < -threshold:
+            notes.append("ops/sec %+.0f%%" % (speed * 100))
+        for counter in COUNTERS:
+            name = counter + "_per_op"
+            if result[name] > old[name] + 1e-9:
+                notes.append("%s %.3f -> %.3f" % (name, old[name], result[name]))
+        if notes:
+            regressions += 1
+            print("REGRESSION %-44s %s" % (key, ", ".join(notes)))
+        else:
+            print("ok         %-44s ops/sec %+.0f%%" % (key, speed * 100))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the event pipeline on the host.")
+    parser.add_argument("--sizes", default = "1000,10000,100000", help = "buffer sizes in events")
+    parser.add_argument("--cases", default = "*", help = "run only cases matching this pattern")
+    parser.add_argument("--json", help = "write the results to this file")
+    parser.add_argument("--compare", help = "compare with the results in this file")
+    parser.add_argument("--threshold", type = float, default = 0.25, help = "tolerated ops/sec drop")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = {}
+    print("%-44s %9s %10s %9s %9s %8s %8s %8s %8s" % (
+        "case", "ops", "ops/sec", "p50 us", "p99 us", "opens", "seeks", "writes", "nvs"))
+    for case, size, use_nvs, engine in cases(sizes, args.cases):
+        key = case_key(case, size, use_nvs, engine)
+        if not fnmatch.fnmatch(key, args.cases):
+            continue
+        r = run_case(case, size, use_nvs, engine)
+        results[key] = r
+        print("%-44s %9d %10.0f %9.1f %9.1f %8.3f %8.3f %8.3f %8.3f" % (
+            key, r["ops"], r["ops_per_sec"], r["p50_us"], r["p99_us"],
+            r["opens_per_op"], r["seeks_per_op"], r["writes_per_op"], r["nvs_writes_per_op"]))
+        sys.stdout.flush()
+
+    meta = {"revision": git_revision(), "python": platform.python_version(), "sizes": sizes}
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent = 1, sort_keys = True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
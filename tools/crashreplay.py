@@ -0,0 +1,508 @@
+"""
+ Crash replay of the ring buffers and the event log, run on the host
+ against a simulated flash device.
+
+ A workload of puts, gets, reserve/commit and syncs runs once on a
+ flash that journals every mutation: every write to a file and every
+ NVS set. Then power is cut at every write boundary, i.e. for every
+ prefix of the journal the flash state is rebuilt, and again with the
+ next write torn after half of its bytes. The store is reopened on that
+ state and checked:
+
+  - the read and write positions are in range
+  - the items are consecutive (IDs increase by one), and hold every
+    item that was pending both before and after the step the cut fell
+    into, i.e. no item that was put and not yet consumed is lost
+  - no item is newer than the last put that was started
+  - count() matches the items, and get() drains the buffer without
+    getting stuck (the 2019 stuck reader bugs)
+  - the event log continues with an ID above the recovered ones
+
+ Cuts inside the header commit are among them: with NVS, between the
+ sets of a commit record; with the file, the torn write of the record.
+
+ The "/lost" scenarios lose the file at every cut and keep NVS, as a
+ recreated file system would: the store must reopen empty and recover
+ the items put since, not the positions of the old file.
+
+ Reports the failures and the time to reopen (recover) per scenario.
+
+ usage: python3 tools/crashreplay.py [--steps 120] [--seed 1] [--capacity 40]
+            [--scenarios PATTERN] [--no-torn]
+"""
+import argparse
+import contextlib
+import fnmatch
+import io
+import os
+import random
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sim import Simulation
+
+Simulation(speedup = 1000, persist_nvs = False).install()
+
+import config
+import eventlog
+import fileringbuffer
+from eventlog import EventLog
+from fileringbuffer import FileRingBuffer
+from fileringbufferconstants import _HEADER_LEN
+from fixedslotringbuffer import FixedSlotRingBuffer
+from logger import Logger
+
+PATH = "/flash/data/events.bin"
+ID_LEN = 4
+LOST_PUTS = 5                                   # items put after the file was lost, see check_file_lost
+
+
+class Flash:
+    """Files (bytearrays) and NVS values, with a journal of the mutations."""
+
+    def __init__(self):
+        self.files = {}
+        self.nvs = {}
+        self.journal = None                     # list of mutations while recording
+
+    def copy(self):
+        flash = Flash()
+        flash.files = dict((path, bytearray(data)) for path, data in self.files.items())
+        flash.nvs = dict(self.nvs)
+        return flash
+
+    def apply(self, mutation, torn = False):
+        """Apply a journal entry; `torn` writes only half of its bytes."""
+        kind = mutation[0]
+        if kind == "create":
+            self.files.setdefault(mutation[1], bytearray())
+        elif kind == "write":
+            path, offset, data = mutation[1:]
+            if torn:
+                data = data[:len(data) // 2]
+            self._write(path, offset, data)
+        elif kind == "nvs":
+            self.nvs[mutation[1]] = mutation[2]
+
+    def record(self, mutation):
+        if self.journal != None:
+            self.journal.append(mutation)
+        self.apply(mutation)
+
+    def _write(self, path, offset, data):
+        f = self.files[path]
+        if len(f) < offset:
+            f.extend(bytes(offset - len(f)))
+        f[offset:offset + len(data)] = data
+
+    # the modules used by the ring buffers
+
+    def open(self, path, mode = "r"):
+        if path not in self.files:
+            if "w" not in mode:
+                raise OSError(2, "no such file", path)
+            self.record(("create", path))
+        elif "w" in mode:
+            raise OSError(1, "truncating is not simulated", path)
+        return FlashFile(self, path)
+
+    def os_module(self):
+        flash = self
+
+        def stat(path):
+            if path in flash.files:
+                return (0, 0, 0, 0, 0, 0, len(flash.files[path]))
+            if any(name.startswith(path + "/") for name in flash.files) or path == os.path.dirname(PATH):
+                return (0x4000, 0, 0, 0, 0, 0, 0)
+            raise OSError(2, "no such file", path)
+
+        return types.SimpleNamespace(stat = stat, mkdir = lambda path: None, remove = lambda path: None)
+
+    def pycom_module(self):
+        return types.SimpleNamespace(nvs_get = self.nvs.get, nvs_set = lambda key, value: self.record(("nvs", key, value)))
+
+
+class FlashFile:
+    def __init__(self, flash, path):
+        self.flash = flash
+        self.path = path
+        self.position = 0
+
+    def seek(self, position, whence = 0):
+        if whence == 2:
+            position += len(self.flash.files[self.path])
+        self.position = position
+        return position
+
+    def tell(self):
+        return self.position
+
+    def read(self, n = -1):
+        data = self.flash.files[self.path]
+        end = len(data) if n < 0 else self.position + n
+        chunk = bytes(data[self.position:end])
+        self.position += len(chunk)
+        return chunk
+
+    def readinto(self, buffer):
+        chunk = self.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def write(self, data):
+        self.flash.record(("write", self.path, self.position, bytes(data)))
+        self.position += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+def use_flash(flash):
+    """Route the file and NVS access of the ring buffers to `flash`."""
+    fileringbuffer.open = flash.open
+    fileringbuffer.os = flash.os_module()
+    fileringbuffer.pycom = flash.pycom_module()
+    fileringbuffer.mmap = None
+
+
+def item_id(item):
+    return int.from_bytes(bytes(item[0:ID_LEN]), "little")
+
+
+class Ring:
+    """Items carrying their ID in a ring buffer."""
+
+    def __init__(self, engine, use_nvs, commit_every, capacity):
+        self.engine = engine
+        self.use_nvs = use_nvs
+        self.commit_every = commit_every
+        self.capacity = capacity
+        self.size = config.EVENT_LOG_BLOCKSIZE
+
+    def open(self):
+        follows = lambda previous, item: item_id(item) == item_id(previous) + 1
+        if self.engine == eventlog.ENGINE_SLOTS:
+            FixedSlotRingBuffer.use_nvs = self.use_nvs
+            self.buffer = FixedSlotRingBuffer(PATH, self.capacity, self.size, commit_every = self.commit_every,
+                follows = follows, mapped = True)
+        else:
+            FileRingBuffer.use_nvs = self.use_nvs
+            self.buffer = FileRingBuffer(PATH, self.capacity * 20, commit_every = self.commit_every, mapped = True,
+                follows = follows)
+        return self.buffer
+
+    def item(self, rnd, next_id):
+        size = self.size if self.engine == eventlog.ENGINE_SLOTS else rnd.randint(8, 30)
+        return next_id.to_bytes(ID_LEN, "little") + bytes([next_id % 251]) * (size - ID_LEN)
+
+    def put(self, rnd, items):
+        if len(items) == 1 and rnd.random() < 0.5:
+            self.buffer.put(items[0])
+        else:
+            self.buffer.put_many(items)
+
+    def pending(self):
+        return [item_id(item) for item in self.buffer.peek_many(10 ** 6, 100)]
+
+    def reserve(self, n):
+        items, token = self.buffer.reserve(n, 100)
+        return len(items), token
+
+    def commit(self, token, n):
+        self.buffer.commit(token, n)
+
+    def get(self, n):
+        self.buffer.get_many(n)
+
+    def sync(self):
+        self.buffer.sync(False)
+
+    def positions_valid(self):
+        b = self.buffer
+        if self.engine == eventlog.ENGINE_SLOTS:
+            return 0 <= b.read_position < b.slots and 0 <= b.write_position < b.slots
+        if self.engine == eventlog.ENGINE_COMPACT:
+            return all(0 <= p < b.capacity * b.capacity for p in (b.read_position, b.write_position))
+        return all(_HEADER_LEN <= p < b.buffer_size - 1 for p in (b.read_position, b.write_position))
+
+    def drain(self):
+        """Return the IDs of the items got one by one until empty(), or
+        None if get() got stuck."""
+        ids = []
+        for _ in range(self.capacity * 2 + 2):
+            if self.buffer.empty():
+                return ids
+            item = self.buffer.get()
+            if item == None:
+                return None
+            ids.append(item_id(item))
+        return None
+
+    def last_id(self, next_id):
+        """Return the ID of the item put last."""
+        return next_id - 1
+
+    def next_id_valid(self, ids):
+        return True
+
+
+class Log(Ring):
+    """Events in an event log, identified by their event IDs."""
+
+    def open(self):
+        config.EVENT_LOG_MAX_EVENTS = self.capacity
+        config.EVENT_LOG_COMMIT_EVERY = self.commit_every
+        config.EVENT_LOG_COMMIT_INTERVAL_MS = 0
+        FileRingBuffer.use_nvs = self.use_nvs
+        FixedSlotRingBuffer.use_nvs = self.use_nvs
+        self.log = EventLog(Logger(), PATH, self.engine)
+        self.buffer = self.log.ringBuffer
+        return self.buffer
+
+    def item(self, rnd, next_id):
+        return next_id
+
+    def put(self, rnd, ids):
+        # the event IDs are assigned by the log
+        if len(ids) == 1:
+            self.log.addEvent(eventlog.CMD_TAG_DETECTED, b"\x04\xa2\x5b\x1a")
+        else:
+            self.log.addEvents(eventlog.CMD_TAG_DETECTED, [b"\x04\xa2\x5b\x1a"] * len(ids))
+
+    def pending(self):
+        events, token = self.log.reserveEvents(10 ** 6)
+        return [event.id for event in events]
+
+    def reserve(self, n):
+        events, token = self.log.reserveEvents(n)
+        return len(events), token
+
+    def commit(self, token, n):
+        self.log.commitEvents(token, n)
+
+    def get(self, n):
+        self.log.pullNextEvents(n)
+
+    def sync(self):
+        self.log.sync(False)
+
+    def drain(self):
+        ids = []
+        for _ in range(self.capacity * 2 + 2):
+            if not self.log.hasEvents():
+                return ids
+            event = self.log.pullNextEvent()
+            if event == None:
+                return None
+            ids.append(event.id)
+        return None
+
+    def last_id(self, next_id):
+        return self.log.eventId
+
+    def next_id_valid(self, ids):
+        # the next event must get an ID above the recovered ones
+        return len(ids) == 0 or self.log.eventId >= ids[-1]
+
+
+def record(target, steps, seed):
+    """Run the workload on a journaling flash. Returns the journal, the
+    index of the first mutation of every step, and per step the IDs
+    pending after it and the last ID put."""
+    rnd = random.Random(seed)
+    flash = Flash()
+    use_flash(flash)
+    with contextlib.redirect_stdout(io.StringIO()):
+        target.open()
+    base = flash.copy()
+    flash.journal = []
+    starts = []
+    pending = [target.pending()]
+    # ID 0 would follow an empty slot of zeros, see FixedSlotRingBuffer
+    next_id = 1
+    last_put = [target.last_id(next_id)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for step in range(steps):
+            starts.append(len(flash.journal))
+            r = rnd.random()
+            if r < 0.5:
+                n = rnd.choice((1, 1, 1, 3, 8))
+                items = [target.item(rnd, next_id + i) for i in range(n)]
+                next_id += n
+                target.put(rnd, items)
+            elif r < 0.7:
+                n, token = target.reserve(rnd.choice((1, 4, 16)))
+                if n > 0:
+                    target.commit(token, rnd.randint(1, n))
+            elif r < 0.9:
+                target.get(rnd.choice((1, 2, 5)))
+            else:
+                target.sync()
+            pending.append(target.pending())
+            last_put.append(target.last_id(next_id))
+    starts.append(len(flash.journal))
+    return base, flash.journal, starts, pending, last_put
+
+
+def check(target, base, journal, starts, pending, last_put, cut, torn):
+    """Rebuild the flash for a cut before journal entry `cut` (torn: with
+    half of it written), reopen and check the invariants. Returns an
+    error message or None, and the seconds the reopen took."""
+    flash = base.copy()
+    for mutation in journal[:cut]:
+        flash.apply(mutation)
+    if torn:
+        flash.apply(journal[cut], True)
+    use_flash(flash)
+    # the step the cut fell into
+    step = 0
+    while step + 2 < len(starts) and starts[step + 1] <= cut:
+        step += 1
+    required = set(pending[step]) & set(pending[step + 1])
+    started = last_put[step + 1]
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        start = time.perf_counter()
+        target.open()
+        seconds = time.perf_counter() - start
+        if not target.positions_valid():
+            return "positions out of range: %d, %d" % (target.buffer.read_position, target.buffer.write_position), seconds
+        count = target.buffer.count()
+        ids = target.drain()
+    failed = [line for line in output.getvalue().splitlines() if "failed" in line or "exception" in line]
+    if failed:
+        return failed[0], seconds
+    if ids == None:
+        return "get() stuck", seconds
+    if count != len(ids):
+        return "count() %d, %d items" % (count, len(ids)), seconds
+    for a, b in zip(ids, ids[1:]):
+        if b != a + 1:
+            return "items %d, %d not consecutive" % (a, b), seconds
+    missing = required - set(ids)
+    if missing:
+        return "lost items %s" % sorted(missing)[:5], seconds
+    if ids and ids[-1] > started:
+        return "item %d was never put" % ids[-1], seconds
+    if not target.next_id_valid(ids):
+        return "next event ID %d not above %d" % (target.log.eventId, ids[-1]), seconds
+    return None, seconds
+
+
+def check_file_lost(target, base, journal, cut):
+    """Rebuild the flash for a cut before journal entry `cut`, then lose
+    the file and keep NVS (a recreated file system, or the file removed
+    by a migration) and reopen twice, put items and reopen again: the
+    store must be empty without its file and recover the items put since,
+    rather than a commit record of the old file. Returns an error message or
+    None, and the seconds the first reopen took."""
+    flash = base.copy()
+    for mutation in journal[:cut]:
+        flash.apply(mutation)
+    del flash.files[PATH]
+    use_flash(flash)
+    rnd = random.Random(cut)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        start = time.perf_counter()
+        target.open()
+        seconds = time.perf_counter() - start
+        # restarted before anything else was written
+        target.open()
+        if not target.buffer.empty():
+            return "not empty without its file", seconds
+        target.put(rnd, [target.item(rnd, 1 + i) for i in range(LOST_PUTS)])
+        target.open()
+        if not target.positions_valid():
+            return "positions out of range: %d, %d" % (target.buffer.read_position, target.buffer.write_position), seconds
+        count = target.buffer.count()
+        ids = target.drain()
+    failed = [line for line in output.getvalue().splitlines() if "failed" in line or "exception" in line]
+    if failed:
+        return failed[0], seconds
+    if ids == None:
+        return "get() stuck", seconds
+    if len(ids) != LOST_PUTS:
+        return "%d of %d items put after the file was lost" % (len(ids), LOST_PUTS), seconds
+    if count != len(ids):
+        return "count() %d, %d items" % (count, len(ids)), seconds
+    for a, b in zip(ids, ids[1:]):
+        if b != a + 1:
+            return "items %d, %d not consecutive" % (a, b), seconds
+    return None, seconds
+
+
+def scenarios(capacity):
+    for name, target_class, engine in (
+        ("ring/file", Ring, eventlog.ENGINE_FILE),
+        ("ring/slots", Ring, eventlog.ENGINE_SLOTS),
+        ("eventlog/file", Log, eventlog.ENGINE_FILE),
+        ("eventlog/slots", Log, eventlog.ENGINE_SLOTS),
+        ("eventlog/wire", Log, eventlog.ENGINE_WIRE),
+        ("eventlog/compact", Log, eventlog.ENGINE_COMPACT)):
+        for use_nvs in (False, True):
+            for commit_every in (1, 8):
+                key = "%s/nvs=%d/commit=%d" % (name, use_nvs, commit_every)
+                yield key, target_class(engine, use_nvs, commit_every, capacity), False
+                if use_nvs:
+                    # the file gone, NVS kept
+                    yield key + "/lost", target_class(engine, use_nvs, commit_every, capacity), True
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Cut power at every write and check the recovered store.")
+    parser.add_argument("--steps", type = int, default = 120, help = "workload steps per scenario")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--capacity", type = int, default = 40, help = "buffer size in items")
+    parser.add_argument("--scenarios", default = "*", help = "fnmatch pattern of the scenarios to run")
+    parser.add_argument("--no-torn", action = "store_true", help = "only cut between writes")
+    args = parser.parse_args()
+
+    config.LOG_PRINT = False
+    failures = 0
+    print("%-34s %7s %7s %7s %9s %9s %9s" % ("scenario", "writes", "cuts", "failed", "ms mean", "ms p99", "ms max"))
+    for key, target, lost in scenarios(args.capacity):
+        if not fnmatch.fnmatch(key, args.scenarios):
+            continue
+        base, journal, starts, pending, last_put = record(target, args.steps, args.seed)
+        errors = []
+        times = []
+        for cut in range(len(journal) + 1):
+            if lost:
+                error, seconds = check_file_lost(target, base, journal, cut)
+                times.append(seconds * 1000)
+                if error != None:
+                    errors.append("cut %d: %s" % (cut, error))
+                continue
+            for torn in (False, True):
+                if torn and (args.no_torn or cut == len(journal) or journal[cut][0] != "write" or len(journal[cut][3]) < 2):
+                    continue
+                error, seconds = check(target, base, journal, starts, pending, last_put, cut, torn)
+                times.append(seconds * 1000)
+                if error != None:
+                    errors.append("cut %d%s: %s" % (cut, " (torn)" if torn else "", error))
+        times.sort()
+        print("%-34s %7d %7d %7d %9.2f %9.2f %9.2f" % (key, len(journal), len(times), len(errors),
+            sum(times) / len(times), times[int(len(times) * 0.99)], times[-1]))
+        for error in errors[:3]:
+            print("    " + error)
+        failures += len(errors)
+        sys.stdout.flush()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+ Renders a dump of the binary log ring (see Logger.dump, written to
+ config.LOG_DUMP_PATH when the main loop crashes) as the TRACE text the
+ firmware prints, oldest message first.
+
+ Copy the dump from the device, e.g. with `pymakr` or ftp, then:
+
+    python3 tools/logdecode.py log.bin [--ticks]
+
+ With --ticks every line starts with the ticks_ms of the message, which
+ wrap around every 2^30 ms on the device.
+"""
+import argparse
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "source"))
+
+import logcodes
+
+
+def read_dump(data):
+    """Return the records of a dump as (ticks_ms, topic, code, level, values),
+    oldest first; raises ValueError if it is no dump."""
+    if len(data) < logcodes.DUMP_HEADER_LEN:
+        raise ValueError("dump too short")
+    magic, version, record_len, size, head, count, names_len = struct.unpack_from(logcodes.DUMP_FORMAT, data)
+    if magic != logcodes.DUMP_MAGIC or version != logcodes.DUMP_VERSION:
+        raise ValueError("not a log dump of version %d" % logcodes.DUMP_VERSION)
+    if record_len != logcodes.RECORD_LEN:
+        raise ValueError("records of %d bytes, expected %d" % (record_len, logcodes.RECORD_LEN))
+    offset = logcodes.DUMP_HEADER_LEN
+    topics = data[offset:offset + names_len].decode().split("\n")
+    ring = data[offset + names_len:]
+    if len(ring) < size * record_len or count > size:
+        raise ValueError("dump truncated")
+    records = []
+    start = (head - count) % size
+    for i in range(count):
+        record = struct.unpack_from(logcodes.RECORD_FORMAT, ring, ((start + i) % size) * record_len)
+        topic = topics[record[1]] if record[1] < len(topics) else "topic %d" % record[1]
+        records.append((record[0], topic, record[2], record[3], record[5:5 + record[4]]))
+    return records
+
+
+def format_record(record, ticks = False):
+    """Return the text line of a record, as printed by the firmware."""
+    ticks_ms, topic, code, level, values = record
+    line = logcodes.LEVEL_NAMES[level] + " [" + topic + "] " + logcodes.render(code, values)
+    if ticks:
+        line = "%10d %s" % (ticks_ms, line)
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Render a binary log dump as text.")
+    parser.add_argument("dump", help = "file written by Logger.dump")
+    parser.add_argument("--ticks", action = "store_true", help = "prefix the lines with ticks_ms")
+    args = parser.parse_args()
+    with open(args.dump, "rb") as f:
+        data = f.read()
+    try:
+        records = read_dump(data)
+    except ValueError as e:
+        print("%s: %s" % (args.dump, e), file = sys.stderr)
+        sys.exit(1)
+    for record in records:
+        print(format_record(record, args.ticks))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+ Host-side simulation of the LoPy4 environment the firmware runs in.
+
+ `Simulation.install()` registers stand-ins for the device modules
+ (`pycom`, `machine`, `network`, the LoRa sockets of `socket`,
+ `_thread`, `ubinascii` and `binascii`, `utime` and `time`) so that the modules in
+ `source/` can be imported unmodified under CPython. Everything runs on
+ an accelerated virtual clock:
+
+    from sim import Simulation
+    simulation = Simulation(speedup=200)
+    simulation.install()
+    import eventsender
+
+ Paths below /flash in `config` are mapped to `flash_dir` on the host.
+"""
+import os
+import sys
+import tempfile
+
+from . import machine as _machine
+from . import network as _network
+from . import pycom as _pycom
+from . import thread as _thread
+from . import ubinascii as _ubinascii
+from .clock import SimulationStopped, VirtualClock, make_time_module
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "source")
+FLASH = "/flash"
+
+
+class Simulation:
+    def __init__(self, speedup = 100.0, flash_dir = None, epoch = 0, persist_nvs = True, **radio_options):
+        """
+        speedup : virtual seconds per host second
+        flash_dir : host directory standing in for /flash (a new temporary one if None)
+        epoch : RTC time at boot, in seconds since 1970
+        persist_nvs : keep NVS in flash_dir/nvs.json, so that it survives a restart
+        radio_options : passed on to `network.Radio`
+        """
+        self.flash_dir = flash_dir or tempfile.mkdtemp(prefix = "flash")
+        self.clock = VirtualClock(speedup, epoch)
+        self.nvs = _pycom.NVS(os.path.join(self.flash_dir, "nvs.json") if persist_nvs else None)
+        self.radio = _network.Radio(self.clock, **radio_options)
+        self.modules = {
+            "pycom": _pycom.make_module(self.nvs),
+            "machine": _machine.make_module(self.clock),
+            "network": _network.make_module(self.radio),
+            "socket": _network.make_socket_module(self.radio),
+            "_thread": _thread.make_module(self.clock),
+            "time": make_time_module(self.clock, "time"),
+            "utime": make_time_module(self.clock, "utime"),
+            "ubinascii": _ubinascii.make_module("ubinascii"),
+            "binascii": _ubinascii.make_module("binascii"),
+        }
+
+    def install(self, source_dir = SOURCE_DIR):
+        """Register the stand-in modules, put `source_dir` on the path and
+        map the /flash paths of `config`."""
+        sys.modules.update(self.modules)
+        source_dir = os.path.abspath(source_dir)
+        if source_dir not in sys.path:
+            sys.path.insert(0, source_dir)
+        import config
+        for name in dir(config):
+            value = getattr(config, name)
+            if isinstance(value, str) and value.startswith(FLASH + "/"):
+                setattr(config, name, self.flash_path(value))
+        return self
+
+    def flash_path(self, path):
+        """Host path of a path below /flash."""
+        return os.path.join(self.flash_dir, path[len(FLASH) + 1:])
+
+    def run_script(self, path, duration = None):
+        """Run a firmware script as __main__ until it returns, the
+        simulation is stopped, or `duration` virtual seconds passed.
+
+        Returns the globals of the script, also when it was stopped.
+        """
+        if duration != None:
+            self.modules["machine"].Timer.Alarm(lambda alarm: self.clock.stop("duration elapsed"), duration)
+        namespace = {"__name__": "__main__", "__file__": path}
+        with open(path) as f:
+            code = compile(f.read(), path, "exec")
+        try:
+            exec(code, namespace)
+        except SimulationStopped:
+            pass
+        return namespace
+
+    def summary(self):
+        """Return the counters of the simulation run as a dict."""
+        uplinks = self.radio.uplinks
+        return {
+            "virtual_seconds": round(self.clock.now(), 1),
+            "stop_reason": self.clock.stop_reason(),
+            "failed": self.clock.failed,
+            "uplinks": len(uplinks),
+            "failed_uplinks": sum(1 for u in uplinks if u.failed),
+            "downlinks": sum(1 for u in uplinks if u.downlink != None),
+            "tx_time_on_air_ms": self.radio.total_time_on_air,
+            "nvram_saves": self.radio.nvram_saves,
+            "nvs_writes": self.nvs.writes,
+            "wdt_feeds": sum(w.feeds for w in self.modules["machine"].watchdogs),
+        }
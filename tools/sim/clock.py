@@ -0,0 +1,118 @@
+"""
+ Accelerated virtual clock shared by all stand-in modules, and the
+ `time`/`utime` stand-in built on it.
+
+ Virtual time runs `speedup` times faster than the host clock, so every
+ thread of the firmware sees the same time without a scheduler: a
+ `time.sleep(5)` on the device takes 5 / speedup seconds on the host.
+"""
+import calendar
+import threading
+import time as _host_time
+import types
+
+TICKS_PERIOD = 1 << 30                          # MicroPython ticks_* wrap around here
+_MAX_REAL_SLEEP = 0.05                          # poll interval for stop requests (host seconds)
+
+
+class SimulationStopped(SystemExit):
+    """Raised by `sleep()` in every thread once the simulation is stopped.
+
+    Derived from SystemExit so that `except Exception` blocks in the
+    firmware do not swallow it and threads end silently.
+    """
+
+
+class VirtualClock:
+    def __init__(self, speedup = 100.0, epoch = 0):
+        """
+        speedup : virtual seconds per host second
+        epoch : RTC time (seconds since 1970) at virtual time 0
+        """
+        self.speedup = float(speedup)
+        self.epoch = epoch
+        self._host_start = _host_time.monotonic()
+        self._stop_reason = None
+        self.failed = False
+        self._lock = threading.Lock()
+
+    def now(self):
+        """Virtual seconds since the simulated boot."""
+        return (_host_time.monotonic() - self._host_start) * self.speedup
+
+    def time(self):
+        """RTC time as int, like time.time() on the device."""
+        return int(self.epoch + self.now())
+
+    def set_time(self, seconds):
+        """Set the RTC so that time() returns `seconds` now."""
+        self.epoch = seconds - self.now()
+
+    def ticks_ms(self):
+        return int(self.now() * 1000) % TICKS_PERIOD
+
+    def ticks_us(self):
+        return int(self.now() * 1000000) % TICKS_PERIOD
+
+    def stopped(self):
+        return self._stop_reason != None
+
+    def stop(self, reason, failed = False):
+        """Stop the simulation: every following sleep() raises
+        SimulationStopped. The first reason given is kept."""
+        with self._lock:
+            if self._stop_reason == None:
+                self._stop_reason = reason
+                self.failed = failed
+
+    def stop_reason(self):
+        return self._stop_reason
+
+    def check(self):
+        if self._stop_reason != None:
+            raise SimulationStopped(self._stop_reason)
+
+    def sleep(self, seconds):
+        """Sleep `seconds` of virtual time."""
+        self.check()
+        deadline = self.now() + seconds
+        while True:
+            remaining = deadline - self.now()
+            if remaining <= 0:
+                return
+            _host_time.sleep(min(remaining / self.speedup, _MAX_REAL_SLEEP))
+            self.check()
+
+    def sleep_until(self, deadline):
+        self.sleep(max(0, deadline - self.now()))
+
+
+def ticks_diff(new, old):
+    """Signed difference of two ticks values, as in MicroPython."""
+    return ((new - old + TICKS_PERIOD // 2) % TICKS_PERIOD) - TICKS_PERIOD // 2
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) % TICKS_PERIOD
+
+
+def make_time_module(clock, name = "time"):
+    """Return a module with the host `time` attributes, where the ones
+    used on the device run on `clock`."""
+    module = types.ModuleType(name)
+    for attr in dir(_host_time):
+        if not attr.startswith("__"):
+            setattr(module, attr, getattr(_host_time, attr))
+    module.time = clock.time
+    module.sleep = clock.sleep
+    module.sleep_ms = lambda ms: clock.sleep(ms / 1000.0)
+    module.sleep_us = lambda us: clock.sleep(us / 1000000.0)
+    module.ticks_ms = clock.ticks_ms
+    module.ticks_us = clock.ticks_us
+    module.ticks_cpu = clock.ticks_us
+    module.ticks_diff = ticks_diff
+    module.ticks_add = ticks_add
+    module.gmtime = lambda secs = None: _host_time.gmtime(clock.time() if secs == None else secs)
+    module.localtime = module.gmtime
+    module.mktime = lambda t: calendar.timegm(tuple(t[:6]) + (0, 0, 0))
+    return module
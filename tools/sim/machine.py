@@ -0,0 +1,147 @@
+"""
+ Stand-in for the `machine` module: RTC, Timer.Alarm and WDT on the
+ virtual clock, plus the few other members the firmware touches.
+"""
+import calendar
+import threading
+import time as _host_time
+import types
+
+from .clock import SimulationStopped
+
+
+def make_module(clock, unique_id = b"\x70\xb3\xd5\x49\x00\x01"):
+    module = types.ModuleType("machine")
+    module.watchdogs = []
+
+    class RTC:
+        INTERNAL_RC = 0
+        XTAL_32KHZ = 1
+
+        def __init__(self, id = 0, datetime = None, source = INTERNAL_RC):
+            if datetime != None:
+                self.init(datetime)
+
+        def init(self, datetime = None, source = INTERNAL_RC):
+            """datetime : (year, month, day[, hour[, minute[, second[, usecond[, tzinfo]]]]])
+            or seconds since 1970"""
+            if datetime == None:
+                clock.set_time(0)
+            elif isinstance(datetime, int):
+                clock.set_time(datetime)
+            else:
+                t = tuple(datetime) + (0,) * (6 - len(datetime))
+                clock.set_time(calendar.timegm(t[:6] + (0, 0, 0)))
+
+        def now(self):
+            t = _host_time.gmtime(clock.time())
+            return (t[0], t[1], t[2], t[3], t[4], t[5], 0, None)
+
+        def ntp_sync(self, server, update_period = 3600):
+            pass
+
+        def synced(self):
+            return True
+
+    class Alarm:
+        """Calls `handler(alarm)` after the given virtual time, from a
+        thread of its own."""
+
+        def __init__(self, handler, s = None, ms = None, us = None, arg = None, periodic = False):
+            self.handler = handler
+            self.arg = arg
+            self.periodic = periodic
+            self.interval = (s or 0) + (ms or 0) / 1000.0 + (us or 0) / 1000000.0
+            self._cancelled = False
+            self._thread = threading.Thread(target = self._run, daemon = True)
+            self._thread.start()
+
+        def _run(self):
+            try:
+                while not self._cancelled:
+                    clock.sleep(self.interval)
+                    if self._cancelled:
+                        return
+                    self.handler(self if self.arg == None else self.arg)
+                    if not self.periodic:
+                        return
+            except SimulationStopped:
+                pass
+
+        def callback(self, handler, arg = None):
+            self.handler = handler
+            self.arg = arg
+
+        def cancel(self):
+            self._cancelled = True
+
+    class Timer:
+        pass
+    Timer.Alarm = Alarm
+
+    class WDT:
+        """Fails the simulation if not fed within `timeout` ms of virtual time."""
+
+        def __init__(self, id = 0, timeout = 5000):
+            self.timeout = timeout
+            self.feeds = 0
+            self.expired = False
+            self._last_feed = clock.now()
+            module.watchdogs.append(self)
+            threading.Thread(target = self._watch, daemon = True).start()
+
+        def feed(self):
+            self.feeds += 1
+            self._last_feed = clock.now()
+
+        def init(self, timeout):
+            self.timeout = timeout
+            self.feed()
+
+        def _watch(self):
+            try:
+                while True:
+                    deadline = self._last_feed + self.timeout / 1000.0
+                    if clock.now() >= deadline:
+                        self.expired = True
+                        clock.stop("watchdog not fed for %d ms" % self.timeout, True)
+                        return
+                    clock.sleep_until(deadline)
+            except SimulationStopped:
+                pass
+
+    class Pin:
+        IN = 0
+        OUT = 1
+        OPEN_DRAIN = 2
+        PULL_UP = 1
+        PULL_DOWN = 2
+
+        def __init__(self, id, mode = OUT, pull = None, value = 0):
+            self.id = id
+            self._value = value
+
+        def __call__(self, value = None):
+            return self.value(value)
+
+        def value(self, value = None):
+            if value == None:
+                return self._value
+            self._value = value
+
+        def callback(self, trigger, handler = None, arg = None):
+            pass
+
+    def reset():
+        clock.stop("machine.reset()")
+        clock.check()
+
+    module.RTC = RTC
+    module.Timer = Timer
+    module.WDT = WDT
+    module.Pin = Pin
+    module.reset = reset
+    module.unique_id = lambda: unique_id
+    module.idle = lambda: clock.sleep(0.001)
+    module.freq = lambda: 160000000
+    return module
@@ -0,0 +1,337 @@
+"""
+ Stand-ins for `network` (LoRa, WLAN) and for the LoRa sockets of the
+ `socket` module.
+
+ All LoRa objects and sockets share one `Radio`, like the single radio
+ of the device. An uplink occupies the radio for its time on air
+ (computed for EU868/125 kHz from the spreading factor and payload
+ length, or fixed with `Radio.airtime`), optionally delayed by a duty
+ cycle limit. Downlinks are produced by `Radio.downlink_handler(payload)`
+ or taken from `Radio.downlinks`, and become receivable in the RX1
+ window one second after the uplink ended. Like the LoRaWAN stack of
+ the firmware, TX_PACKET_EVENT (or TX_FAILED_EVENT) is only raised once
+ the receive windows are done.
+"""
+import collections
+import errno
+import math
+import random
+import socket as _host_socket
+import threading
+import types
+
+from .clock import SimulationStopped
+
+# LoRaWAN overhead: MHDR + DevAddr + FCtrl + FCnt + FPort + MIC
+LORAWAN_OVERHEAD = 13
+RX1_DELAY = 1.0
+RX2_DELAY = 2.0
+RX_WINDOW = 0.3                                 # seconds a receive window stays open
+
+# max application payload per spreading factor (EU868, no FOpts)
+MAX_PAYLOAD = {12: 51, 11: 51, 10: 51, 9: 115, 8: 222, 7: 222}
+
+lora_stats = collections.namedtuple("lora_stats", (
+    "rx_timestamp", "rssi", "snr", "sfrx", "sftx", "tx_trials",
+    "tx_power", "tx_time_on_air", "tx_counter", "tx_frequency"))
+
+Uplink = collections.namedtuple("Uplink", ("time", "payload", "airtime", "failed", "downlink"))
+
+
+def time_on_air(payload_len, sf, bw = 125000, preamble = 8, coding_rate = 1):
+    """Seconds on air of a LoRa frame carrying `payload_len` PHY bytes
+    (explicit header, CRC on)."""
+    t_sym = (2 ** sf) / float(bw)
+    low_dr = 1 if sf >= 11 and bw == 125000 else 0
+    n = math.ceil((8 * payload_len - 4 * sf + 28 + 16) / (4.0 * (sf - 2 * low_dr))) * (coding_rate + 4)
+    return (preamble + 4.25) * t_sym + (8 + max(n, 0)) * t_sym
+
+
+class Radio:
+    def __init__(self, clock, sf = 12, join_delay = 6.0, airtime = None,
+                 duty_cycle = 0.0, tx_fail_rate = 0.0, seed = None):
+        """
+        sf : spreading factor used for uplinks, until the firmware sets one
+        join_delay : virtual seconds until an OTAA join completes
+        airtime : fixed time on air per uplink in seconds (None to compute it)
+        duty_cycle : max fraction of time on air (0.01 for the EU868 1%, 0 disables)
+        tx_fail_rate : probability that an uplink ends with TX_FAILED_EVENT
+        """
+        self.clock = clock
+        self.sf = sf
+        self.join_delay = join_delay
+        self.airtime = airtime
+        self.duty_cycle = duty_cycle
+        self.tx_fail_rate = tx_fail_rate
+        self.random = random.Random(seed)
+        self.downlinks = collections.deque()    # payloads sent with the next uplinks
+        self.downlink_handler = None            # f(uplink payload) -> downlink payload or None
+        self.uplinks = []                       # Uplink records
+        self.joined_at = None
+        self.nvram = None                       # state saved by nvram_save()
+        self.nvram_saves = 0
+        self.tx_counter = 0
+        self.tx_time_on_air = 0                 # ms, of the last uplink (as in stats())
+        self.total_time_on_air = 0              # ms, of all uplinks
+        self.busy_until = 0.0
+        self.next_tx_allowed = 0.0
+        self.lock = threading.Lock()
+        self._rx = None                         # (available at, payload) of the pending downlink
+        self._events = 0
+        self._callback = None
+        self._trigger = 0
+
+    def joined(self):
+        return self.joined_at != None and self.clock.now() >= self.joined_at
+
+    def mtu(self):
+        return MAX_PAYLOAD[self.sf]
+
+    def _airtime(self, payload):
+        if self.airtime != None:
+            return self.airtime
+        return time_on_air(len(payload) + LORAWAN_OVERHEAD, self.sf)
+
+    def transmit(self, payload):
+        """Schedule an uplink and return the virtual time it ends."""
+        if len(payload) > self.mtu():
+            raise OSError(errno.EMSGSIZE, "payload exceeds %d bytes" % self.mtu())
+        with self.lock:
+            now = self.clock.now()
+            start = max(now, self.busy_until, self.next_tx_allowed)
+            airtime = self._airtime(payload)
+            end = start + airtime
+            self.busy_until = end + RX2_DELAY + RX_WINDOW
+            if self.duty_cycle > 0:
+                self.next_tx_allowed = start + airtime / self.duty_cycle
+            self.tx_counter += 1
+            self.tx_time_on_air = int(airtime * 1000)
+            self.total_time_on_air += self.tx_time_on_air
+            failed = self.random.random() < self.tx_fail_rate
+            downlink = None
+            if not failed:
+                if self.downlink_handler != None:
+                    downlink = self.downlink_handler(payload)
+                elif len(self.downlinks) > 0:
+                    downlink = self.downlinks.popleft()
+            self._rx = None
+            if downlink != None:
+                self._rx = (end + RX1_DELAY, downlink)
+            self.uplinks.append(Uplink(start, payload, airtime, failed, downlink))
+        threading.Thread(target = self._complete, args = (end, failed, downlink), daemon = True).start()
+        return end
+
+    def _complete(self, end, failed, downlink):
+        try:
+            if failed:
+                self.clock.sleep_until(end + RX2_DELAY + RX_WINDOW)
+                self._fire(Radio.TX_FAILED_EVENT)
+                return
+            if downlink != None:
+                self.clock.sleep_until(end + RX1_DELAY)
+                self._fire(Radio.RX_PACKET_EVENT)
+            else:
+                self.clock.sleep_until(end + RX2_DELAY + RX_WINDOW)
+            self._fire(Radio.TX_PACKET_EVENT)
+        except SimulationStopped:
+            pass
+
+    def _fire(self, event):
+        with self.lock:
+            self._events |= event
+            callback = self._callback if self._trigger & event else None
+        if callback != None:
+            callback[0](callback[1])
+
+    def take_events(self):
+        with self.lock:
+            events = self._events
+            self._events = 0
+            return events
+
+    def receive(self):
+        """Return the downlink if its RX window opened, else None."""
+        with self.lock:
+            if self._rx != None and self.clock.now() >= self._rx[0]:
+                payload = self._rx[1]
+                self._rx = None
+                return payload
+            return None
+
+    RX_PACKET_EVENT = 1
+    TX_PACKET_EVENT = 2
+    TX_FAILED_EVENT = 4
+
+
+def make_module(radio):
+    module = types.ModuleType("network")
+    module.radio = radio
+
+    class LoRa:
+        LORA = 0
+        LORAWAN = 1
+        OTAA = 0
+        ABP = 1
+        ALWAYS_ON = 0
+        TX_ONLY = 1
+        SLEEP = 2
+        CLASS_A = 0
+        CLASS_C = 2
+        AS923 = 0
+        AU915 = 1
+        EU868 = 5
+        US915 = 8
+        RX_PACKET_EVENT = Radio.RX_PACKET_EVENT
+        TX_PACKET_EVENT = Radio.TX_PACKET_EVENT
+        TX_FAILED_EVENT = Radio.TX_FAILED_EVENT
+
+        def __init__(self, mode = LORAWAN, region = EU868, sf = None, **kwargs):
+            self.mode = mode
+            if sf != None:
+                radio.sf = sf
+
+        def init(self, mode = LORAWAN, sf = None, **kwargs):
+            self.__init__(mode, sf = sf, **kwargs)
+
+        def join(self, activation = OTAA, auth = None, timeout = None, dr = None):
+            if activation == LoRa.ABP:
+                radio.joined_at = radio.clock.now()
+            else:
+                radio.joined_at = radio.clock.now() + radio.join_delay
+                if timeout:
+                    radio.clock.sleep(min(timeout / 1000.0, radio.join_delay))
+
+        def has_joined(self):
+            return radio.joined()
+
+        def mac(self):
+            return b"\x70\xb3\xd5\x49\x9a\x00\x00\x01"
+
+        def nvram_save(self):
+            radio.nvram_saves += 1
+            radio.nvram = {"joined": radio.joined()}
+
+        def nvram_restore(self):
+            if radio.nvram != None and radio.nvram["joined"]:
+                radio.joined_at = radio.clock.now()
+
+        def nvram_erase(self):
+            radio.nvram = None
+
+        def callback(self, trigger, handler = None, arg = None):
+            with radio.lock:
+                radio._trigger = trigger
+                radio._callback = None if handler == None else (handler, self if arg == None else arg)
+
+        def events(self):
+            return radio.take_events()
+
+        def stats(self):
+            return lora_stats(0, -80, 7.0, radio.sf, radio.sf, 1, 14,
+                              radio.tx_time_on_air, radio.tx_counter, 868100000)
+
+        def sf(self, sf = None):
+            if sf == None:
+                return radio.sf
+            radio.sf = sf
+
+        def power_mode(self, mode = None):
+            return LoRa.ALWAYS_ON
+
+    class WLAN:
+        STA = 1
+        AP = 2
+
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def init(self, *args, **kwargs):
+            pass
+
+        def deinit(self):
+            pass
+
+        def isconnected(self):
+            return False
+
+        def mode(self, mode = None):
+            return WLAN.AP
+
+    module.LoRa = LoRa
+    module.WLAN = WLAN
+    return module
+
+
+def make_socket_module(radio):
+    """Return a module with the host `socket` attributes and LoRa sockets
+    for `socket.socket(socket.AF_LORA, socket.SOCK_RAW)`."""
+    module = types.ModuleType("socket")
+    for attr in dir(_host_socket):
+        if not attr.startswith("__"):
+            setattr(module, attr, getattr(_host_socket, attr))
+    module.AF_LORA = 160
+    module.SOL_LORA = 1
+    module.SO_CONFIRMED = 2
+    module.SO_DR = 3
+
+    class LoRaSocket:
+        def __init__(self):
+            self.blocking = True
+            self.timeout = None
+            self.port = 2
+            self.closed = False
+
+        def setblocking(self, flag):
+            self.blocking = flag
+            self.timeout = None if flag else 0
+
+        def settimeout(self, value):
+            self.timeout = value
+            self.blocking = value != 0
+
+        def setsockopt(self, level, option, value):
+            if option == module.SO_DR:
+                radio.sf = 12 - value
+
+        def bind(self, port):
+            self.port = port
+
+        def _check(self):
+            if self.closed:
+                raise OSError(errno.EBADF, "socket closed")
+            if not radio.joined():
+                raise OSError(errno.ENETDOWN, "not joined")
+
+        def send(self, data):
+            self._check()
+            end = radio.transmit(bytes(data))
+            if self.blocking:
+                radio.clock.sleep_until(end)
+            return len(data)
+
+        def recv(self, bufsize):
+            self._check()
+            deadline = None
+            if self.timeout != None:
+                deadline = radio.clock.now() + self.timeout
+            while True:
+                payload = radio.receive()
+                if payload != None:
+                    return payload[:bufsize]
+                if not self.blocking:
+                    return b""
+                if deadline != None and radio.clock.now() >= deadline:
+                    raise OSError(errno.ETIMEDOUT, "timed out")
+                radio.clock.sleep(0.01)
+
+        def close(self):
+            self.closed = True
+
+    def socket(family = _host_socket.AF_INET, type = _host_socket.SOCK_STREAM, proto = 0, *args):
+        if family == module.AF_LORA:
+            return LoRaSocket()
+        return _host_socket.socket(family, type, proto, *args)
+
+    module.socket = socket
+    module.LoRaSocket = LoRaSocket
+    return module
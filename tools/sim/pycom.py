@@ -0,0 +1,80 @@
+"""
+ Stand-in for the `pycom` module: NVS backed by a dict, optionally
+ persisted to a JSON file so that it survives simulated reboots, and
+ the RGB LED.
+"""
+import json
+import os
+import threading
+import types
+
+
+class NVS:
+    def __init__(self, path = None):
+        """path : JSON file the values are persisted to (None keeps them in RAM only)"""
+        self.path = path
+        self.values = {}
+        self.reads = 0
+        self.writes = 0
+        self._lock = threading.Lock()
+        if path != None and os.path.exists(path):
+            with open(path) as f:
+                self.values = json.load(f)
+
+    def _persist(self):
+        if self.path != None:
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(self.values, f)
+            os.replace(self.path + ".tmp", self.path)
+
+    def get(self, key):
+        # firmware 1.20 returns None for keys that were never set
+        with self._lock:
+            self.reads += 1
+            return self.values.get(key)
+
+    def set(self, key, value):
+        if len(key) > 15:
+            raise ValueError("nvs keys are limited to 15 characters")
+        if not isinstance(value, int) or value < 0 or value >= 1 << 32:
+            raise ValueError("nvs values must be unsigned 32-bit integers")
+        with self._lock:
+            self.writes += 1
+            self.values[key] = value
+            self._persist()
+
+    def erase(self, key):
+        with self._lock:
+            if key not in self.values:
+                raise KeyError(key)
+            del self.values[key]
+            self._persist()
+
+    def erase_all(self):
+        with self._lock:
+            self.values = {}
+            self._persist()
+
+
+def make_module(nvs):
+    module = types.ModuleType("pycom")
+    module.nvs = nvs
+    module.nvs_get = nvs.get
+    module.nvs_set = nvs.set
+    module.nvs_erase = nvs.erase
+    module.nvs_erase_all = nvs.erase_all
+    module.led_color = 0
+    module.led_changes = 0
+
+    def heartbeat(enable = None):
+        if enable == None:
+            return module.heartbeat_enabled
+        module.heartbeat_enabled = enable
+    module.heartbeat_enabled = True
+    module.heartbeat = heartbeat
+
+    def rgbled(color):
+        module.led_color = color
+        module.led_changes += 1
+    module.rgbled = rgbled
+    return module
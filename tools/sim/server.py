@@ -0,0 +1,101 @@
+"""
+ Stand-in for the network server side of the event uplinks, answering
+ them with the ack downlinks of `LoraController.decodeAck`.
+
+ It decodes the tag events of CMD 0x01, 0x06 and 0x07 uplinks, acknowledges
+ the events received without gap (the cumulative ack) and reports the
+ missing ones after it in the NACK bitmap. With `loss`, uplinks are lost
+ silently, as if no gateway heard them, so the device learns about the
+ missing events only from a later ack. The detections suppressed by the
+ tag filter, reported with 0x07, are summed up.
+
+    server = AckServer(loss=0.1)
+    simulation.radio.downlink_handler = server
+"""
+import random
+
+CMD_TAG = 0x01
+CMD_TAG_BATCH = 0x06
+CMD_TAG_REPEATED = 0x07
+CMD_ACK = 0x10
+MAX_EVENT_ID = 0xFFFE
+MAX_NACK_BYTES = 8
+
+
+def decode_event_ids(payload):
+    """Return the event IDs carried by a tag uplink, [] for other uplinks."""
+    if len(payload) < 7 or payload[0] not in (CMD_TAG, CMD_TAG_BATCH, CMD_TAG_REPEATED):
+        return []
+    event_id = payload[1] | (payload[2] << 8)
+    if payload[0] != CMD_TAG_BATCH:
+        return [event_id]
+    ids = []
+    pos = 7
+    while pos < len(payload):
+        entry = payload[pos]
+        pos += 1
+        while payload[pos] & 0x80:
+            pos += 1
+        pos += 1 + (entry & 0x0F)
+        event_id = (event_id + (entry >> 4)) % (MAX_EVENT_ID + 1)
+        ids.append(event_id)
+    return ids
+
+
+def decode_hits(payload):
+    """Return the detections suppressed before the tag event of a 0x07
+    uplink, 0 for other uplinks."""
+    if len(payload) < 8 or payload[0] != CMD_TAG_REPEATED:
+        return 0
+    return payload[7]
+
+
+class AckServer:
+    def __init__(self, loss = 0.0, seed = None):
+        """
+        loss : probability that an uplink is lost without the device noticing
+        """
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.ack = None                         # ID of the last event received without gap
+        self.received = set()                   # IDs received after the ack
+        self.events = 0                         # distinct events received
+        self.duplicates = 0                     # events received again
+        self.hits = 0                           # detections suppressed before the events received
+        self.lost = 0                           # uplinks lost
+
+    def _after_ack(self, event_id):
+        return (event_id - self.ack) % (MAX_EVENT_ID + 1)
+
+    def __call__(self, payload):
+        ids = decode_event_ids(payload)
+        if len(ids) == 0:
+            return None
+        if self.random.random() < self.loss:
+            self.lost += 1
+            return None
+        if self.ack == None:
+            self.ack = (ids[0] - 1) % (MAX_EVENT_ID + 1)
+        for event_id in ids:
+            distance = self._after_ack(event_id)
+            if distance == 0 or distance > MAX_EVENT_ID // 2 or event_id in self.received:
+                self.duplicates += 1
+            else:
+                self.received.add(event_id)
+                self.events += 1
+                self.hits += decode_hits(payload)
+        while (self.ack + 1) % (MAX_EVENT_ID + 1) in self.received:
+            self.ack = (self.ack + 1) % (MAX_EVENT_ID + 1)
+            self.received.discard(self.ack)
+        return self.downlink()
+
+    def downlink(self):
+        """Return the ack downlink for the events received so far."""
+        bitmap = bytearray()
+        if len(self.received) > 0:
+            last = max(self._after_ack(event_id) for event_id in self.received)
+            bitmap = bytearray(min((last + 6) // 8, MAX_NACK_BYTES))
+            for i in range(min(last - 1, len(bitmap) * 8)):
+                if (self.ack + 1 + i) % (MAX_EVENT_ID + 1) not in self.received:
+                    bitmap[i // 8] |= 1 << (i % 8)
+        return bytes([CMD_ACK, self.ack & 0xFF, self.ack >> 8]) + bytes(bitmap)
@@ -0,0 +1,63 @@
+"""
+ Stand-in for `_thread` whose lock timeouts run on the virtual clock.
+
+ Blocking acquires wake up periodically, so that they raise
+ SimulationStopped once the simulation is stopped instead of hanging.
+ Thread stack sizes are raised to the minimum of the host.
+"""
+import _thread as _host_thread
+import types
+
+_POLL = 0.05                                    # host seconds between checks of a blocked acquire
+
+
+def make_module(clock):
+    module = types.ModuleType("_thread")
+    for attr in dir(_host_thread):
+        if not attr.startswith("__"):
+            setattr(module, attr, getattr(_host_thread, attr))
+
+    class Lock:
+        def __init__(self):
+            self._lock = _host_thread.allocate_lock()
+
+        def acquire(self, waitflag = 1, timeout = -1):
+            if self._lock.acquire(False):
+                return True
+            if not waitflag or timeout == 0:
+                return False
+            deadline = None if timeout < 0 else clock.now() + timeout
+            while True:
+                clock.check()
+                wait = _POLL
+                if deadline != None:
+                    remaining = deadline - clock.now()
+                    if remaining <= 0:
+                        return False
+                    wait = min(wait, remaining / clock.speedup)
+                if self._lock.acquire(True, wait):
+                    return True
+
+        def release(self):
+            self._lock.release()
+
+        def locked(self):
+            return self._lock.locked()
+
+        def __enter__(self):
+            return self.acquire()
+
+        def __exit__(self, *args):
+            self.release()
+            return False
+
+    def stack_size(size = 0):
+        # the host rejects the small stacks of the device threads
+        if size != 0:
+            size = max(size, 32768)
+        return _host_thread.stack_size(size)
+
+    module.stack_size = stack_size
+    module.LockType = Lock
+    module.allocate_lock = Lock
+    return module
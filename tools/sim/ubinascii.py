@@ -0,0 +1,17 @@
+"""
+ Stand-in for the `ubinascii` (and `binascii`) module of the firmware.
+
+ Only the functions of the LoPy4 firmware's module are exposed, so that
+ code using one it lacks (e.g. `crc32`) fails on the host as well.
+"""
+import binascii as _binascii
+import types
+
+FUNCTIONS = ("hexlify", "unhexlify", "a2b_base64", "b2a_base64")
+
+
+def make_module(name = "ubinascii"):
+    module = types.ModuleType(name)
+    for function in FUNCTIONS:
+        setattr(module, function, getattr(_binascii, function))
+    return module
@@ -0,0 +1,71 @@
+"""
+ Runs a firmware script (main.py by default) under CPython with the
+ stand-in device modules of tools/sim, at accelerated virtual time, and
+ prints the counters of the run. Exits with 1 if the watchdog expired.
+
+ usage: python3 tools/simulate.py [--duration 600] [--speedup 100] [--flash DIR]
+            [--airtime S] [--duty-cycle 0.01] [--tx-fail-rate P] [--ack]
+            [--ack-events] [--uplink-loss P] [--engine E] [--log FILE] [script]
+"""
+import argparse
+import contextlib
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sim import SOURCE_DIR, Simulation
+from sim.server import AckServer
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Run the firmware on the host.")
+    parser.add_argument("script", nargs = "?", default = os.path.join(SOURCE_DIR, "main.py"))
+    parser.add_argument("--duration", type = float, default = 600, help = "virtual seconds to run")
+    parser.add_argument("--speedup", type = float, default = 100, help = "virtual seconds per host second")
+    parser.add_argument("--flash", help = "host directory standing in for /flash (kept between runs)")
+    parser.add_argument("--airtime", type = float, help = "fixed time on air per uplink, in seconds")
+    parser.add_argument("--duty-cycle", type = float, default = 0.0, help = "max fraction of time on air")
+    parser.add_argument("--tx-fail-rate", type = float, default = 0.0, help = "probability of TX_FAILED_EVENT")
+    parser.add_argument("--ack", action = "store_true", help = "answer every uplink with a one byte downlink")
+    parser.add_argument("--ack-events", action = "store_true",
+                        help = "run with LORA_ACK_MODE, answering the event uplinks with ack downlinks")
+    parser.add_argument("--uplink-loss", type = float, default = 0.0,
+                        help = "with --ack-events, probability that the server misses an uplink")
+    parser.add_argument("--engine", help = "event log engine (config.EVENT_LOG_ENGINE)")
+    parser.add_argument("--log", help = "write the firmware output to this file")
+    args = parser.parse_args()
+
+    simulation = Simulation(args.speedup, args.flash, airtime = args.airtime,
+                            duty_cycle = args.duty_cycle, tx_fail_rate = args.tx_fail_rate)
+    if args.ack:
+        simulation.radio.downlink_handler = lambda payload: b"\x01"
+    server = None
+    if args.ack_events:
+        server = AckServer(args.uplink_loss)
+        simulation.radio.downlink_handler = server
+    simulation.install()
+    import config
+    if server != None:
+        config.LORA_ACK_MODE = True
+    if args.engine:
+        config.EVENT_LOG_ENGINE = args.engine
+
+    with contextlib.ExitStack() as stack:
+        if args.log:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(args.log, "w"))))
+        simulation.run_script(args.script, args.duration)
+
+    summary = simulation.summary()
+    if server != None:
+        summary["events_acked"] = server.events
+        summary["events_duplicate"] = server.duplicates
+        summary["tag_hits"] = server.hits
+        summary["uplinks_lost"] = server.lost
+    for key in summary:
+        print("%-18s %s" % (key, summary[key]))
+    sys.exit(1 if summary["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+ Stress test of the single producer, single consumer use of the ring
+ buffers and the event log, run on the host with `_thread` workers.
+
+ Producer threads put items (or add events) with put/put_many (or
+ addEvent/addEvents) while a consumer thread takes them with
+ reserve/commit (or reserveEvents/commitEvents), committing random
+ parts of every reservation. The consumer checks that the items it
+ commits are in order without duplicates; once the producers are done
+ and the buffer is drained, that the last item was consumed, and that
+ no item went missing unless the producers lapped the consumer.
+
+ Every target runs twice: with a buffer of --capacity items and paced
+ producers, which wait while the buffer is half full and so must never
+ lap the consumer, and with a twentieth of it and producers running
+ flat out, which lap it all the time.
+
+ usage: python3 tools/stress_eventlog.py [--items 20000] [--capacity 1000]
+            [--producers 1] [--seed 1]
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sim import Simulation
+
+simulation = Simulation(speedup = 1000, persist_nvs = False).install()
+
+import _thread
+import config
+import eventlog
+from eventlog import EventLog
+from fileringbuffer import FileRingBuffer
+from fileringbufferconstants import _ITEM_SIZE_LEN
+from fixedslotringbuffer import FixedSlotRingBuffer
+from logger import Logger
+
+UID = b"\x04\xa2\x5b\x1a"
+
+
+class Ring:
+    """Items carrying their sequence number, in a ring buffer."""
+
+    def __init__(self, root, engine, mapped, capacity):
+        path = os.path.join(root, "events.bin")
+        size = config.EVENT_LOG_BLOCKSIZE
+        if engine == eventlog.ENGINE_SLOTS:
+            self.buffer = FixedSlotRingBuffer(path, capacity, size, commit_every = 16, mapped = mapped)
+        else:
+            self.buffer = FileRingBuffer(path, capacity * (size + _ITEM_SIZE_LEN), commit_every = 16, mapped = mapped)
+        self.lock = _thread.allocate_lock()
+        self.next = 0
+
+    def produce(self, rnd, n):
+        # one producer at a time, like EventLog.bufferLock
+        with self.lock:
+            items = []
+            for _ in range(n):
+                items.append(self.next.to_bytes(4, "little") + bytes(config.EVENT_LOG_BLOCKSIZE - 4))
+                self.next += 1
+            if len(items) == 1 and rnd.random() < 0.5:
+                self.buffer.put(items[0])
+            else:
+                self.buffer.put_many(items)
+
+    def reserve(self, n):
+        items, token = self.buffer.reserve(n, config.EVENT_LOG_BLOCKSIZE)
+        return [int.from_bytes(bytes(item[0:4]), "little") for item in items], token
+
+    def commit(self, token, n):
+        return self.buffer.commit(token, n)
+
+    def laps(self):
+        return self.buffer.laps
+
+
+class Log:
+    """Events, whose IDs are their sequence numbers, in an event log."""
+
+    def __init__(self, root, engine, mapped, capacity):
+        config.EVENT_LOG_MAX_EVENTS = capacity
+        self.log = EventLog(Logger(), os.path.join(root, "events.bin"), engine)
+        self.first = self.log.eventId + 1
+
+    def produce(self, rnd, n):
+        if n == 1:
+            self.log.addEvent(eventlog.CMD_TAG_DETECTED, UID)
+        else:
+            self.log.addEvents(eventlog.CMD_TAG_DETECTED, [UID] * n)
+
+    def reserve(self, n):
+        events, token = self.log.reserveEvents(n)
+        return [event.id - self.first for event in events], token
+
+    def commit(self, token, n):
+        return self.log.commitEvents(token, n)
+
+    def laps(self):
+        return self.log.ringBuffer.laps
+
+
+def run(target, items, producers, seed, pace = None):
+    """Run the producers and the consumer and return the counters; raises
+    AssertionError if an item was consumed out of order. With `pace`, the
+    producers wait while that many items are pending."""
+    done = _thread.allocate_lock()
+    finished = [0]
+    errors = []
+    counters = {"produced": 0, "consumed": 0, "reservations": 0, "failed_commits": 0}
+    per_producer = items // producers
+
+    def producer(index):
+        rnd = random.Random(seed * 100 + index)
+        try:
+            left = per_producer
+            while left > 0:
+                n = min(left, rnd.choice((1, 1, 1, 4, 30)))
+                while pace != None and counters["produced"] - counters["consumed"] > pace:
+                    time.sleep(0)
+                target.produce(rnd, n)
+                with done:
+                    counters["produced"] += n
+                left -= n
+        except Exception as e:
+            errors.append(e)
+        with done:
+            finished[0] += 1
+
+    def consumer():
+        rnd = random.Random(seed)
+        last = -1
+        try:
+            while True:
+                producing = finished[0] < producers
+                ids, token = target.reserve(rnd.choice((1, 8, 32)))
+                if len(ids) == 0:
+                    if not producing:
+                        break
+                    continue
+                counters["reservations"] += 1
+                assert ids[0] > last, "item %d consumed after %d" % (ids[0], last)
+                for a, b in zip(ids, ids[1:]):
+                    assert b == a + 1, "reserved items %d, %d not in order" % (a, b)
+                n = rnd.randint(1, len(ids))
+                if target.commit(token, n):
+                    last = ids[n - 1]
+                    counters["consumed"] += n
+                else:
+                    counters["failed_commits"] += 1
+        except Exception as e:
+            errors.append(e)
+        counters["last"] = last
+        with done:
+            finished[0] += 1
+
+    start = time.perf_counter()
+    for index in range(producers):
+        _thread.start_new_thread(producer, (index,))
+    _thread.start_new_thread(consumer, ())
+    while finished[0] < producers + 1:
+        time.sleep(0.01)
+    counters["seconds"] = time.perf_counter() - start
+    counters["laps"] = target.laps()
+    if errors:
+        raise errors[0]
+    assert counters["last"] == counters["produced"] - 1, "last item %d not consumed" % (counters["produced"] - 1)
+    assert pace == None or counters["laps"] == 0, "paced producers lapped the consumer"
+    if counters["laps"] == 0:
+        assert counters["consumed"] == counters["produced"], "%d of %d items consumed without lapping" % (
+            counters["consumed"], counters["produced"])
+    return counters
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Stress the ring buffers with concurrent producers and a consumer.")
+    parser.add_argument("--items", type = int, default = 20000, help = "items per run")
+    parser.add_argument("--capacity", type = int, default = 1000, help = "buffer size in items")
+    parser.add_argument("--producers", type = int, default = 1, help = "producer threads")
+    parser.add_argument("--seed", type = int, default = 1)
+    args = parser.parse_args()
+
+    # switch threads often, to interleave them at many points
+    sys.setswitchinterval(1e-5)
+    failures = 0
+    print("%-26s %9s %9s %9s %8s %8s %9s" % ("run", "items", "consumed", "commits", "failed", "laps", "items/s"))
+    for name, target_class, engine, mapped in (
+        ("ring/file", Ring, eventlog.ENGINE_FILE, False),
+        ("ring/file/mapped", Ring, eventlog.ENGINE_FILE, True),
+        ("ring/slots", Ring, eventlog.ENGINE_SLOTS, False),
+        ("ring/slots/mapped", Ring, eventlog.ENGINE_SLOTS, True),
+        ("eventlog/file", Log, eventlog.ENGINE_FILE, False),
+        ("eventlog/slots", Log, eventlog.ENGINE_SLOTS, False),
+        ("eventlog/wire", Log, eventlog.ENGINE_WIRE, False),
+        ("eventlog/compact", Log, eventlog.ENGINE_COMPACT, False)):
+        for capacity, pace in ((args.capacity, args.capacity // 2), (args.capacity // 20, None)):
+            root = tempfile.mkdtemp(prefix = "stress")
+            simulation.nvs.values.clear()
+            key = "%s/%d" % (name, capacity)
+            output = io.StringIO()
+            try:
+                with contextlib.redirect_stdout(output):
+                    target = target_class(root, engine, mapped, capacity)
+                    c = run(target, args.items, args.producers, args.seed, pace)
+                failed = [line for line in output.getvalue().splitlines() if "failed" in line or "exception" in line]
+                assert not failed, failed[0]
+                print("%-26s %9d %9d %9d %8d %8d %9.0f" % (key, c["produced"], c["consumed"], c["reservations"],
+                    c["failed_commits"], c["laps"], c["produced"] / c["seconds"]))
+            except AssertionError as e:
+                failures += 1
+                print("%-26s FAILED: %s" % (key, e))
+            finally:
+                shutil.rmtree(root, ignore_errors = True)
+            sys.stdout.flush()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+ Host-side test of the tag filter: repeated detections within the window
+ are suppressed and counted, and the count written into the event by
+ TagFilter must reach the server decoder (tools/sim/server.py) with every
+ event log engine.
+
+ usage: python3 tools/test_tagfilter.py  (or pytest tools/test_tagfilter.py)
+"""
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sim import Simulation
+
+simulation = Simulation(speedup = 1000, persist_nvs = False).install()
+
+import eventlog
+import time
+from eventlog import EventLog
+from logger import Logger
+from loracontroller import LoraController
+from sim.server import AckServer, decode_event_ids, decode_hits
+from tagfilter import TagFilter
+
+UID = b"\x04\xa2\x5b\x1a\x80\x01\x02"
+OTHER_UID = b"\xde\xad\xbe\xef"
+WINDOW = 10
+
+
+class Target:
+    def __init__(self):
+        self.events = []
+        self.result = True
+
+    def addEvent(self, cmd, data = None):
+        self.events.append((cmd, bytes(data)))
+        return self.result
+
+
+class TagFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.output = contextlib.redirect_stdout(io.StringIO())
+        self.output.__enter__()
+        self.target = Target()
+        self.tagFilter = TagFilter(Logger(), self.target, window = WINDOW)
+
+    def tearDown(self):
+        self.output.__exit__(None, None, None)
+
+    def test_repeats_are_counted(self):
+        for i in range(3):
+            self.tagFilter.addEvent(eventlog.CMD_TAG_DETECTED, UID)
+        self.tagFilter.addEvent(eventlog.CMD_TAG_DETECTED, OTHER_UID)
+        time.sleep(WINDOW + 1)
+        self.tagFilter.addEvent(eventlog.CMD_TAG_DETECTED, UID)
+        padded = lambda uid: uid + bytes(10 - len(uid))
+        self.assertEqual([data[:10] for cmd, data in self.target.events], [padded(UID), padded(OTHER_UID), padded(UID)])
+        self.assertEqual([data[10] for cmd, data in self.target.events], [0, 0, 2])
+        self.assertEqual(self.tagFilter.suppressed, 2)
+
+    def test_window_zero_reports_every_detection(self):
+        tagFilter = TagFilter(Logger(), self.target, window = 0)
+        for i in range(3):
+            tagFilter.addEvent(eventlog.CMD_TAG_DETECTED, UID)
+        self.assertEqual(len(self.target.events), 3)
+        self.assertEqual(self.target.events[0][1], UID)
+
+    def test_dropped_event_is_reported_again(self):
+        self.target.result = False
+        self.tagFilter.addEvent(eventlog.CMD_TAG_DETECTED, UID)
+        self.target.result = True
+        self.tagFilter.addEvent(eventlog.CMD_TAG_DETECTED, UID)
+        self.assertEqual(len(self.target.events), 2)
+
+
+class TagHitsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix = "tagfilter")
+        simulation.nvs.values.clear()
+        self.output = contextlib.redirect_stdout(io.StringIO())
+        self.output.__enter__()
+        self.logger = Logger()
+        self.lora = LoraController.__new__(LoraController)
+        self.lora.logger = self.logger
+        self.logs = []
+
+    def tearDown(self):
+        for log in self.logs:
+            log.ringBuffer.close()
+        self.output.__exit__(None, None, None)
+        shutil.rmtree(self.root, ignore_errors = True)
+
+    def open(self, engine):
+        log = EventLog(self.logger, os.path.join(self.root, "events." + engine), engine)
+        self.logs.append(log)
+        return log, TagFilter(self.logger, log, window = WINDOW)
+
+    def detect(self, tagFilter):
+        # one event, two repeats suppressed, then the tag again after the window
+        for i in range(3):
+            tagFilter.addEvent(eventlog.CMD_TAG_DETECTED, UID)
+        tagFilter.addEvent(eventlog.CMD_TAG_DETECTED, OTHER_UID)
+        time.sleep(WINDOW + 1)
+        tagFilter.addEvent(eventlog.CMD_TAG_DETECTED, UID)
+
+    def test_single_uplinks(self):
+        for engine in (eventlog.ENGINE_FILE, eventlog.ENGINE_SLOTS, eventlog.ENGINE_WIRE, eventlog.ENGINE_COMPACT):
+            with self.subTest(engine = engine):
+                log, tagFilter = self.open(engine)
+                self.detect(tagFilter)
+                events = list(log.events())
+                self.assertEqual(len(events), 3)
+                server = AckServer()
+                payloads = [self.lora.makePayload(event) for event in events]
+                for payload in payloads:
+                    server(payload)
+                self.assertEqual([decode_hits(payload) for payload in payloads], [0, 0, 2])
+                self.assertEqual([payload[0] for payload in payloads],
+                    [eventlog.UPLINK_TAG_DETECTED, eventlog.UPLINK_TAG_DETECTED, eventlog.UPLINK_TAG_REPEATED])
+                self.assertEqual(payloads[2][8:], UID)
+                self.assertEqual(decode_event_ids(payloads[2]), [events[2].id])
+                self.assertEqual(server.events, 3)
+                self.assertEqual(server.hits, 2)
+
+    def test_batch_stops_before_repeated_tag(self):
+        for engine in (eventlog.ENGINE_FILE, eventlog.ENGINE_WIRE):
+            with self.subTest(engine = engine):
+                log, tagFilter = self.open(engine)
+                self.detect(tagFilter)
+                events = list(log.events())
+                payload, count = self.lora.makeBatchPayload(events, 222)
+                self.assertEqual(count, 2)
+                self.assertEqual(decode_hits(payload), 0)
+                self.assertEqual(decode_hits(self.lora.makePayload(events[2])), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()